@@ -26,8 +26,22 @@ from scipy.sparse import lil_matrix
 # 1.20: Warns about determinant
 # 1.21: Secder automatic sign flip if it sees the fit is up against a bound
 # 1.22: Improved version of save_patches
-
-version = 1.22
+# 1.23: miniLM accepts a jacobian_fn (e.g., exact columns for linear parameters)
+# 1.24: miniLM accepts a jacobian_sparsity; columns touching disjoint rows are differenced together
+# 1.25: miniLM accepts local_blocks; block-arrow normal equations are solved with a Schur complement
+# 1.26: miniLM reuse_factorization: one eigendecomposition of the scaled JtJ per Jacobian serves every lam
+# 1.27: miniLM lambda_ladder: several damping values evaluated together, best improving step accepted
+# 1.28: Added miniLM_matrix_free: Krylov-subspace LM steps from J.v and J^T.u products, J never stored
+# 1.29: miniLM accepts a normal_eq_fn that accumulates JtJ and J^T r itself (streaming), J never formed
+# 1.30: miniLM broyden_updates: rank-one Jacobian updates between rebuilds while J predicts the chi2 change
+# 1.31: miniNM_new with a residfn gets its Cmat from Gauss-Newton JtJ; secderiv only with use_secderiv (or no residfn)
+# 1.32: miniNM takes a pool or batch_chi2fn: trial points, shrink vertices and starting vertices evaluated together
+# 1.33: miniLM_matrix_free gets the column norms from the same vjp_fn pass as J^T r, and its wmat from normal_eq_fn
+# 1.34: miniLM rebuilds a Broyden-updated J before returning its JtJ, however the loop ends
+# 1.35: miniLM keeps JtJ, the gradient and the factorization through failed lambda searches (only lam changes)
+# 1.36: miniLM turns Broyden updates off when local_blocks is set
+
+version = 1.36
 
 print(f"DavidsNM Version {version}")
 
@@ -658,7 +672,72 @@ def get_start(P0, displ_list, merged_list):
 
 
 
-def miniNM(P0, e, merged_list, displ_list, verbose, maxruncount = 15, negativewarning = True, maxiter = 100000):
+def f_batch(P_list, merged_list, pool = None, batch_chi2fn = None):
+    """f for several points: batch_chi2fn(P_list, merged_list[2:]) if given, else over the pool (chi2fn must pickle)."""
+    if batch_chi2fn != None:
+        return list(batch_chi2fn(P_list, merged_list[2:]))
+    if pool == None:
+        return [f(P, merged_list) for P in P_list]
+    return pool.starmap(f, [(P, [merged_list[0], None] + list(merged_list[2:])) for P in P_list])
+
+
+def parallel_improve(pf, merged_list, pool = None, batch_chi2fn = None):
+    """improve, with the expansion, reflection and both contractions evaluated together (then the shrunk vertices
+    together). Same choices as improve, so the same simplex path; more evaluations, fewer rounds."""
+    [P, F] = pf
+
+    M = sum(P[:-1], axis = 0)/len(P[:-1])
+    W = P[-1]
+    fW = F[-1]
+
+    R = M + M - W
+    E = R + (R - M)
+    C1 = 0.5*(M + W)
+    C2 = 0.5*(M + R)
+
+    trials = [trial for trial in [E, R, C1, C2] if merged_list[1](trial)]
+    for trial, ftrial in zip(trials, f_batch(trials, merged_list, pool = pool, batch_chi2fn = batch_chi2fn)):
+        if ftrial < fW:
+            P[-1] = trial
+            F[-1] = ftrial
+            return [P, F]
+
+    for i in range(1,len(P)):
+        P[i] = 0.5*(P[0] + P[i])
+    F[1:] = f_batch(list(P[1:]), merged_list, pool = pool, batch_chi2fn = batch_chi2fn)
+
+    return [P, F]
+
+
+def parallel_get_start(P0, displ_list, merged_list, pool = None, batch_chi2fn = None):
+    """get_start, with all the starting vertices evaluated together."""
+    P = array([P0]*(len(displ_list) - displ_list.count(0.) + 1), dtype=float64)
+
+    j = 1
+    for i in range(len(displ_list)):
+        if displ_list[i] != 0.:
+
+            P[j,i] += displ_list[i]
+
+            if merged_list[1](P[j]) != 1: # merged_list[1] is inlimit
+                print("Changing sign! ", displ_list[i])
+                P[j,i] -= 2.*displ_list[i]
+
+                if merged_list[1](P[j]) == 1:
+                    print("Change worked!")
+                else:
+                    print("start out of range!")
+                    print(P[j])
+                    return [P, f_batch(list(P[:j]), merged_list, pool = pool, batch_chi2fn = batch_chi2fn)]
+            j += 1
+
+    F = f_batch(list(P), merged_list, pool = pool, batch_chi2fn = batch_chi2fn)
+    [P, F] = listsort([P, F])
+
+    return [P, F]
+
+
+def miniNM(P0, e, merged_list, displ_list, verbose, maxruncount = 15, negativewarning = True, maxiter = 100000, pool = None, batch_chi2fn = None):
     runcount = 0
 
     print("maxruncount ", maxruncount)
@@ -668,7 +747,10 @@ def miniNM(P0, e, merged_list, displ_list, verbose, maxruncount = 15, negativewa
     F = [-2.]
 
     while runcount < maxruncount and old_F != F[0]:
-        [P, F] = get_start(P0, displ_list, merged_list)
+        if pool == None and batch_chi2fn == None:
+            [P, F] = get_start(P0, displ_list, merged_list)
+        else:
+            [P, F] = parallel_get_start(P0, displ_list, merged_list, pool = pool, batch_chi2fn = batch_chi2fn)
         if len(F) != len(P): # Started against a limit
             print("Returning starting value!")
             return [array([P0], dtype=float64),
@@ -694,7 +776,10 @@ def miniNM(P0, e, merged_list, displ_list, verbose, maxruncount = 15, negativewa
                max(abs(  (P[0] - P[-1])/max(max(P[0]), 1.e-10)  )) > tmpe2 ) or k < 2:
 
             last_F = F[0]
-            [P, F] = improve([P, F], merged_list) # Run an iteration
+            if pool == None and batch_chi2fn == None:
+                [P, F] = improve([P, F], merged_list) # Run an iteration
+            else:
+                [P, F] = parallel_improve([P, F], merged_list, pool = pool, batch_chi2fn = batch_chi2fn)
             [P, F] = listsort([P, F])
 
 
@@ -728,7 +813,18 @@ def miniNM(P0, e, merged_list, displ_list, verbose, maxruncount = 15, negativewa
 
     return [P, F]
 
-def miniNM_new(ministart, miniscale, passdata, chi2fn = None, residfn = None, inlimit = lambda x: True, verbose = False, maxruncount = 15, negativewarning = False, maxiter = 10000, tolerance = [1.e-8, 0], compute_Cmat = True):
+def gauss_newton_wmat(residfn, P, displ_list, merged_list):
+    """JtJ over the free parameters from one finite-difference Jacobian of residfn(P, merged_list) (steps of
+    displ*1e-6): the Gauss-Newton version of secderiv's weight matrix (chi2 Hessian/2), for n + 2 evaluations."""
+    P = array(P, dtype=float64)
+    displ_list = array(displ_list, dtype=float64)
+    modelfn = lambda x, y, pool = None: residfn(x, y)
+    J = Jacobian(modelfn, get_unpad_params(displ_list, displ_list)*1.e-6, [merged_list], get_unpad_params(P, displ_list),
+                 displ_list, P, len(residfn(P, merged_list)), use_dense_J = True)
+    return dot(transpose(J), J)
+
+
+def miniNM_new(ministart, miniscale, passdata, chi2fn = None, residfn = None, inlimit = lambda x: True, verbose = False, maxruncount = 15, negativewarning = False, maxiter = 10000, tolerance = [1.e-8, 0], compute_Cmat = True, use_secderiv = False, pool = None, batch_chi2fn = None):
     if chi2fn == None:
         chi2fn = lambda x, y: (residfn(x, y)**2.).sum()
 
@@ -742,9 +838,11 @@ def miniNM_new(ministart, miniscale, passdata, chi2fn = None, residfn = None, in
     except:
         pass
 
-    [P, F] = miniNM(ministart, tolerance, [chi2fn, inlimit, passdata], miniscale, verbose = verbose, maxruncount = maxruncount, negativewarning = negativewarning, maxiter = maxiter)
+    [P, F] = miniNM(ministart, tolerance, [chi2fn, inlimit, passdata], miniscale, verbose = verbose, maxruncount = maxruncount, negativewarning = negativewarning, maxiter = maxiter, pool = pool, batch_chi2fn = batch_chi2fn)
 
-    if compute_Cmat:
+    if compute_Cmat and residfn != None and not use_secderiv:
+        Wmat = gauss_newton_wmat(residfn, P[0], miniscale, [passdata])
+    elif compute_Cmat:
         [Wmat, NA, NA] = secderiv(P, [chi2fn, inlimit, passdata], miniscale, 1.e-1, verbose = verbose)
     else:
         Wmat = []
@@ -769,6 +867,55 @@ def err_from_cov(matrix):
 
 
 # Start L-M
+def color_columns(sparsity, datalen):
+    """Greedy coloring of Jacobian columns. sparsity[j] holds the rows column j can be nonzero in; columns in
+    the same group share no rows, so one model evaluation gives all of them. Returns a list of groups."""
+
+    groups = []
+    group_rows = []
+    for j in range(len(sparsity)):
+        for k in range(len(groups)):
+            if not any(group_rows[k][sparsity[j]]):
+                groups[k].append(j)
+                group_rows[k][sparsity[j]] = True
+                break
+        else:
+            groups.append([j])
+            group_rows.append(zeros(datalen, dtype=bool))
+            group_rows[-1][sparsity[j]] = True
+    return groups
+
+
+def grouped_Jacobian(modelfn, unpad_offsetparams, merged_list, unpad_params,
+    displ_list, params, datalen, use_dense_J, sparsity, column_groups, pool = None):
+    """Jacobian with all the columns in each of column_groups (see color_columns) perturbed at once."""
+
+    J = zeros([datalen, len(unpad_params)], dtype=float64, order = 'F')
+
+    arg_list = []
+    for group in column_groups:
+        dparams = copy.deepcopy(unpad_params)
+        dparams[group] += unpad_offsetparams[group]
+        arg_list.append((get_pad_params(dparams, displ_list, params), *merged_list))
+
+    if pool == None:
+        base_mod_list = modelfn(get_pad_params(unpad_params, displ_list, params), *merged_list)
+        dmod_lists = [modelfn(*args) for args in arg_list]
+    else:
+        base_mod_list = modelfn(get_pad_params(unpad_params, displ_list, params), *merged_list, pool=pool)
+        dmod_lists = pool.starmap(modelfn, arg_list)
+
+    for group, dmod_list in zip(column_groups, dmod_lists):
+        for j in group:
+            J[sparsity[j], j] = (dmod_list[sparsity[j]] - base_mod_list[sparsity[j]])/unpad_offsetparams[j]
+
+    if not use_dense_J:
+        J = lil_matrix(J)
+        J = J.tocsr()
+
+    return J
+
+
 def Jacobian(modelfn, unpad_offsetparams, merged_list, unpad_params,
     displ_list, params, datalen, use_dense_J, pool = None):
 
@@ -809,6 +956,138 @@ def Jacobian(modelfn, unpad_offsetparams, merged_list, unpad_params,
 
 
 
+class block_arrow_system():
+    """Normal equations whose parameters split into global ones and many small local blocks that only couple to the
+    global ones (e.g., per-image offsets). The local blocks are eliminated (Schur complement), so a solve costs
+    O(n_global^3 + n_blocks*n_global^2) instead of O(n_param^3). Each local block is eigendecomposed once (in the
+    variables where miniLM's damping, diagonal*(1 + lam), is the identity*lam), so any lam reuses it."""
+
+    def __init__(self, JtJ, local_blocks):
+        JtJ = array(JtJ, dtype=float64)
+        self.n_param = len(JtJ)
+        self.blocks = [array(block, dtype=int64) for block in local_blocks if len(block) > 0]
+        self.glob = setdiff1d(arange(self.n_param), concatenate(self.blocks + [zeros(0, dtype=int64)]))
+
+        self.G = JtJ[ix_(self.glob, self.glob)]
+        self.B = [JtJ[ix_(self.glob, block)] for block in self.blocks]
+
+        self.D_scale = []
+        self.D_eig = []
+        for block in self.blocks:
+            D = JtJ[ix_(block, block)]
+            D_scale = sqrt(diag(D))
+            if any(D_scale <= 0):
+                # A parameter with no effect: singular for any lam, like the dense solve
+                raise linalg.LinAlgError("Singular local block")
+            self.D_scale.append(D_scale)
+            self.D_eig.append(linalg.eigh(D/outer(D_scale, D_scale)))
+
+    def D_inv(self, k, lam):
+        eigvals, eigvecs = self.D_eig[k]
+        if any(eigvals + lam <= 0):
+            raise linalg.LinAlgError("Singular local block")
+        return dot(eigvecs/(eigvals + lam), eigvecs.T)/outer(self.D_scale[k], self.D_scale[k])
+
+    def solve(self, rhs, lam = 0.):
+        rhs = array(rhs, dtype=float64).ravel()
+
+        S = self.G.copy()
+        S[diag_indices(len(S))] *= 1. + lam
+        rhs_glob = rhs[self.glob].copy()
+
+        D_invs = []
+        for k, block in enumerate(self.blocks):
+            D_invs.append(self.D_inv(k, lam))
+            BD_inv = dot(self.B[k], D_invs[-1])
+            S -= dot(BD_inv, self.B[k].T)
+            rhs_glob -= dot(BD_inv, rhs[block])
+
+        x = zeros(self.n_param, dtype=float64)
+        x[self.glob] = linalg.solve(S, rhs_glob)
+        for k, block in enumerate(self.blocks):
+            x[block] = dot(D_invs[k], rhs[block] - dot(self.B[k].T, x[self.glob]))
+        return x
+
+    def inverse(self):
+        """Inverse of the undamped JtJ; the global block is just the inverse Schur complement."""
+        S = self.G.copy()
+        D_invs = [self.D_inv(k, 0.) for k in range(len(self.blocks))]
+        for k in range(len(self.blocks)):
+            S -= dot(dot(self.B[k], D_invs[k]), self.B[k].T)
+        S_inv = linalg.inv(S)
+
+        Cmat = zeros([self.n_param]*2, dtype=float64)
+        Cmat[ix_(self.glob, self.glob)] = S_inv
+        if len(self.blocks) == 0:
+            return Cmat
+
+        local = concatenate(self.blocks)
+        W = concatenate([dot(D_invs[k], self.B[k].T) for k in range(len(self.blocks))])
+        Cmat[ix_(self.glob, local)] = -dot(S_inv, W.T)
+        Cmat[ix_(local, self.glob)] = -dot(W, S_inv)
+        Cmat[ix_(local, local)] = dot(dot(W, S_inv), W.T)
+        for k, block in enumerate(self.blocks):
+            Cmat[ix_(block, block)] += D_invs[k]
+        return Cmat
+
+
+class scaled_eigen_system():
+    """JtJ with miniLM's damping (diagonal*(1 + lam)) for any lam from one eigendecomposition: with
+    s = sqrt(diag(JtJ)), JtJ_lam = s (N + lam) s with N = JtJ/(s s^T) = Q L Q^T, so each solve is O(n^2)."""
+
+    def __init__(self, JtJ):
+        JtJ = array(JtJ, dtype=float64)
+        self.scale = sqrt(diag(JtJ))
+        if any(self.scale <= 0):
+            raise linalg.LinAlgError("Singular matrix")
+        self.eigvals, self.eigvecs = linalg.eigh(JtJ/outer(self.scale, self.scale))
+
+    def solve(self, rhs, lam = 0.):
+        if any(self.eigvals + lam <= 0):
+            raise linalg.LinAlgError("Singular matrix")
+        rhs = array(rhs, dtype=float64).ravel()
+        return dot(self.eigvecs, dot(self.eigvecs.T, rhs/self.scale)/(self.eigvals + lam))/self.scale
+
+
+def evaluate_trials(modelfn, P_list, merged_list, pool = None, batch_residfn = None):
+    """Residuals for several parameter vectors: batch_residfn(P_list, *merged_list) if given, else over the pool."""
+    if batch_residfn != None:
+        return batch_residfn(P_list, *merged_list)
+    if pool == None:
+        return [modelfn(P, *merged_list) for P in P_list]
+    return pool.starmap(modelfn, [(P, *merged_list) for P in P_list])
+
+
+def damped_solve(JtJ, lam, rhs, system = None):
+    """Solve (JtJ with its diagonal scaled by 1 + lam) x = rhs. With a block_arrow_system, by Schur complement."""
+    if system != None:
+        return system.solve(rhs, lam)
+
+    JtJ_lam = copy.deepcopy(JtJ)
+    for i in range(len(JtJ)):
+        JtJ_lam[i,i] *= (1. + lam)
+    return linalg.solve(JtJ_lam, rhs)
+
+
+def broyden_update(Jacob, delta, dresid, use_dense_J):
+    """Rank-one (Broyden) update of Jacob after a step delta (free parameters) changed the residuals by dresid."""
+    J = Jacob if use_dense_J else array(Jacob.todense())
+    J = J + outer(dresid - J.dot(delta), delta)/dot(delta, delta)
+    return J if use_dense_J else lil_matrix(J).tocsr()
+
+
+def chi2_prediction_ratio(Jacob, delta, resid, new_resid, Wmat):
+    """Actual chi2 reduction of the step delta over the one predicted by the linearization Jacob."""
+    predicted = chi2fromresid(resid, Wmat) - chi2fromresid(resid + Jacob.dot(delta), Wmat)
+    return (chi2fromresid(resid, Wmat) - chi2fromresid(new_resid, Wmat))/predicted
+
+
+def unpad_blocks(local_blocks, displ_list):
+    """local_blocks in terms of all parameters -> in terms of the free ones (displ_list != 0)."""
+    free = list(where(array(displ_list) != 0)[0])
+    return [[free.index(j) for j in block if j in free] for block in local_blocks]
+
+
 def get_pad_params(unpad_params, displ_list, params):
     pad_params = copy.deepcopy(params)
 
@@ -840,10 +1119,35 @@ def chi2fromresid(resid, Wmat):
         return chi2
 
 
+def normal_matrix(Jacob, Wmat, use_dense_J, verbose):
+    """J^T J (or J^T W J) for miniLM."""
+    Jacobt = transpose(Jacob)
+
+    if verbose:
+        print("Dot start ", time.asctime())
+    if Wmat == None:
+        JtJ = Jacobt.dot(Jacob)
+        if not use_dense_J:
+            JtJ = JtJ.todense()
+    else:
+        try:
+            JtJ = Jacobt.dot(transpose(Jacobt.dot(Wmat)))
+        except:
+            print("Couldn't do dot product!")
+            print("Sizes ", Jacobt.shape, Wmat.shape)
+            sys.exit(1)
+    if verbose:
+        print("Dot end ", time.asctime())
+    return JtJ
+
+
 def miniLM(params, merged_list, displ_list, verbose, maxiter = 150,
     maxlam = 100000, Wmat = None, jacobian_name = "Jacob.fits",
     return_wmat = False, use_dense_J = False, pool = None,
-    save_jacobian = True):
+    save_jacobian = True, jacobian_fn = None, jacobian_sparsity = None,
+    local_blocks = None, reuse_factorization = False, lambda_ladder = 0,
+    batch_residfn = None, normal_eq_fn = None, broyden_updates = 0,
+    broyden_tolerance = 0.5):
 
     params = array(params, dtype=float64)
     displ_list = array(displ_list, dtype=float64)
@@ -853,6 +1157,11 @@ def miniLM(params, merged_list, displ_list, verbose, maxiter = 150,
     modelfn = merged_list[0]
     del merged_list[0]
 
+    if broyden_updates > 0 and local_blocks != None:
+        # A rank-one update couples the local blocks, which block_arrow_system assumes are independent
+        print("Broyden updates don't keep the block-arrow structure; turning them off, as local_blocks is set.")
+        broyden_updates = 0
+
     lam = 1.e-6
     lamscale = 2.
 
@@ -860,6 +1169,11 @@ def miniLM(params, merged_list, displ_list, verbose, maxiter = 150,
 
     curchi2 = modelfn(params, *merged_list, pool=pool)
 
+    if jacobian_sparsity != None:
+        column_groups = color_columns(jacobian_sparsity, len(curchi2))
+        if verbose:
+            print("Jacobian columns in", len(column_groups), "groups")
+
     unpad_offsetparams = get_unpad_params(array(displ_list, dtype=float64),
         displ_list)*1.e-6
 
@@ -868,8 +1182,27 @@ def miniLM(params, merged_list, displ_list, verbose, maxiter = 150,
     if verbose:
         print("unpad_params ", unpad_params)
 
+    def build_jacobian(unpad_params):
+        if jacobian_fn == None and jacobian_sparsity != None:
+            return grouped_Jacobian(modelfn, unpad_offsetparams, merged_list,
+                unpad_params, displ_list, params, len(curchi2),
+                use_dense_J, jacobian_sparsity, column_groups, pool = pool)
+        elif jacobian_fn == None:
+            return Jacobian(modelfn, unpad_offsetparams, merged_list,
+                unpad_params, displ_list, params, len(curchi2),
+                use_dense_J, pool = pool)
+
+        # Caller-supplied Jacobian (e.g., exact columns for linear parameters)
+        Jacob = jacobian_fn(get_pad_params(unpad_params, displ_list,
+            params), displ_list, merged_list)
+        if not use_dense_J:
+            Jacob = lil_matrix(Jacob).tocsr()
+        return Jacob
+
     itercount = 0
     was_just_searching = 0
+    last_params = None
+    n_broyden = 0
     while lam < maxlam and itercount < maxiter:
         itercount += 1
 
@@ -877,45 +1210,49 @@ def miniLM(params, merged_list, displ_list, verbose, maxiter = 150,
             print(len(unpad_offsetparams), len(unpad_params),
                 len(displ_list), len(params), len(curchi2))
         if not was_just_searching:
-            Jacob = Jacobian(modelfn, unpad_offsetparams, merged_list,
-                unpad_params, displ_list, params, len(curchi2),
-                use_dense_J, pool = pool)
-        was_just_searching = 0
-
-        if verbose:
-            print("Jacob.shape ", Jacob.shape)
-        Jacobt = transpose(Jacob)
-
-        if verbose:
-            print("Dot start ", time.asctime())
-        if Wmat == None:
-            JtJ = Jacobt.dot(Jacob)
-            if not use_dense_J:
-                JtJ = JtJ.todense()
-        else:
-            try:
-                JtJ = Jacobt.dot(transpose(Jacobt.dot(Wmat)))
-            except:
-                print("Couldn't do dot product!")
-                print("Sizes ", Jacobt.shape, Wmat.shape)
-                sys.exit(1)
-        if verbose:
-            print("Dot end ", time.asctime())
-
+            if (broyden_updates > 0 and last_params is not None and n_broyden < broyden_updates and normal_eq_fn == None
+                and not (return_wmat and itercount == maxiter)
+                and abs(chi2_prediction_ratio(Jacob, unpad_params - last_params, last_chi2, curchi2, Wmat) - 1.) <= broyden_tolerance):
+                # J predicted the last step well: rank-one update instead of a new Jacobian (not on the last allowed
+                # iteration; if the fit stops on maxlam instead, J is rebuilt after the loop for the returned JtJ)
+                Jacob = broyden_update(Jacob, unpad_params - last_params, curchi2 - last_chi2, use_dense_J)
+                n_broyden += 1
+            else:
+                n_broyden = 0
+                if normal_eq_fn != None:
+                    # Caller-accumulated JtJ and J^T r (e.g., streamed over chunks of images); J is never formed
+                    JtJ, grad = normal_eq_fn(get_pad_params(unpad_params, displ_list,
+                        params), displ_list, merged_list)
+                else:
+                    Jacob = build_jacobian(unpad_params)
 
+            if normal_eq_fn == None:
+                if verbose:
+                    print("Jacob.shape ", Jacob.shape)
+                Jacobt = transpose(Jacob)
+                JtJ = normal_matrix(Jacob, Wmat, use_dense_J, verbose)
 
-        JtJ_lam = copy.deepcopy(JtJ)
+            system = None
 
-        for i in range(len(JtJ)):
-            JtJ_lam[i,i] *= (1. + lam)
         try:
-            if Wmat == None:
-                delta1 = -linalg.solve(JtJ_lam, Jacobt.dot(curchi2))
-            else:
-                delta1 = -linalg.solve(JtJ_lam, Jacobt.dot(dot(Wmat, curchi2)))
+            if not was_just_searching:
+                # After a failed search, J, JtJ, grad and the factorization are unchanged: only lam moved
+                if normal_eq_fn == None and Wmat == None:
+                    grad = Jacobt.dot(curchi2)
+                elif normal_eq_fn == None:
+                    grad = Jacobt.dot(dot(Wmat, curchi2))
+                if local_blocks != None:
+                    system = block_arrow_system(JtJ, unpad_blocks(local_blocks, displ_list))
+                elif reuse_factorization:
+                    system = scaled_eigen_system(JtJ)
+            delta1 = -damped_solve(JtJ, lam, grad, system)
         except:
 
             print("Uninvertible Matrix!")
+            if normal_eq_fn != None:
+                return [array([get_pad_params(unpad_params, displ_list, params)], dtype=float64),
+                        array([chi2fromresid(curchi2, Wmat), -1], dtype=float64)] + [JtJ]*return_wmat
+
             if save_jacobian:
                 if not use_dense_J:
                     save_img(Jacob.todense(), jacobian_name)
@@ -924,15 +1261,38 @@ def miniLM(params, merged_list, displ_list, verbose, maxiter = 150,
 
             return [array([get_pad_params(unpad_params, displ_list, params)], dtype=float64),
                     array([chi2fromresid(curchi2, Wmat), -1], dtype=float64)] + [Jacob.todense()]*return_wmat
+        was_just_searching = 0
 
-        JtJ_lam2 = copy.deepcopy(JtJ)
+        last_params = unpad_params
+        last_chi2 = curchi2
 
-        for i in range(len(JtJ)):
-            JtJ_lam2[i,i] *= (1. + lam/lamscale)
-        if Wmat == None:
-            delta2 = -linalg.solve(JtJ_lam2, Jacobt.dot(curchi2))
-        else:
-            delta2 = -linalg.solve(JtJ_lam2, Jacobt.dot(dot(Wmat, curchi2)))
+        if lambda_ladder > 0:
+            # Speculative: steps for lam/lamscale, lam, ..., lam*lamscale**(lambda_ladder - 2), evaluated together
+            trial_lams = lam*lamscale**arange(-1, lambda_ladder - 1)
+            trial_deltas = [-damped_solve(JtJ, trial_lam, grad, system) for trial_lam in trial_lams]
+            trial_params = [get_pad_params(unpad_params + trial_delta, displ_list, params) for trial_delta in trial_deltas]
+            trial_chi2s = evaluate_trials(modelfn, trial_params, merged_list, pool = pool, batch_residfn = batch_residfn)
+
+            trial_F = array([chi2fromresid(trial_chi2, Wmat) for trial_chi2 in trial_chi2s])
+            trial_F[isnan(trial_F)] = inf
+            best = argmin(trial_F)
+
+            if trial_F[best] < chi2fromresid(curchi2, Wmat):
+                curchi2 = trial_chi2s[best]
+                unpad_params = unpad_params + trial_deltas[best]
+                lam = trial_lams[best]
+            else:
+                itercount -= 1
+                was_just_searching = 1
+                lam = trial_lams[-1]*lamscale
+                if verbose:
+                    print("Searching... ", lam)
+
+            if verbose:
+                print("itercount, unpad_params, lam, curchi2 ", itercount, unpad_params, lam, chi2fromresid(curchi2, Wmat))
+            continue
+
+        delta2 = -damped_solve(JtJ, lam/lamscale, grad, system)
 
         unpad_params1 = get_pad_params(unpad_params + delta1, displ_list, params)
         unpad_params2 = get_pad_params(unpad_params + delta2, displ_list, params)
@@ -959,15 +1319,7 @@ def miniLM(params, merged_list, displ_list, verbose, maxiter = 150,
                     print("Searching... ", lam)
                 lam *= lamscale
 
-                JtJ_lam = copy.deepcopy(JtJ)
-
-                for i in range(len(JtJ)):
-                    JtJ_lam[i,i] *= (1. + lam)
-
-                if Wmat == None:
-                    delta1 = -linalg.solve(JtJ_lam, Jacobt.dot(curchi2))
-                else:
-                    delta1 = -linalg.solve(JtJ_lam, Jacobt.dot(dot(Wmat, curchi2)))
+                delta1 = -damped_solve(JtJ, lam, grad, system)
 
                 unpad_params1 = get_pad_params(unpad_params + delta1, displ_list, params)
                 chi2_1 = modelfn(unpad_params1, *merged_list, pool=pool)
@@ -975,7 +1327,12 @@ def miniLM(params, merged_list, displ_list, verbose, maxiter = 150,
         if verbose:
             print("itercount, unpad_params, lam, curchi2 ", itercount, unpad_params, lam, chi2fromresid(curchi2, Wmat))
 
-    if save_jacobian:
+    if return_wmat and n_broyden > 0:
+        # The last J was a Broyden update: rebuild it for the returned JtJ (Cmat)
+        Jacob = build_jacobian(unpad_params)
+        JtJ = normal_matrix(Jacob, Wmat, use_dense_J, verbose)
+
+    if save_jacobian and normal_eq_fn == None:
         if not use_dense_J:
             save_img(Jacob.todense(), jacobian_name)
         else:
@@ -986,11 +1343,217 @@ def miniLM(params, merged_list, displ_list, verbose, maxiter = 150,
               array([chi2fromresid(curchi2, Wmat)],dtype=float64)] + [JtJ]*return_wmat
 
 
-def miniLM_new(ministart, miniscale, residfn, all_data, passdata, verbose = False, maxiter = 150, maxlam = 100000, Wmat = None, jacobian_name = "Jacob.fits", use_dense_J = False, return_Cmat = True, pad_Cmat = False, pool = None, save_jacobian = False):
-    [P, F, param_wmat] = miniLM(ministart, [residfn, passdata, all_data], miniscale, verbose, maxiter = maxiter, maxlam = maxlam, Wmat = Wmat, jacobian_name = jacobian_name, return_wmat = True, use_dense_J = use_dense_J, pool = pool, save_jacobian = save_jacobian)
+def fd_jvp(modelfn, P, v, displ_list, merged_list, resid, pool = None):
+    """J.v (v over all parameters) from one finite difference along v, with the step scaled so that no parameter
+    moves more than displ*1e-6 (as in Jacobian). resid is modelfn at P."""
+    free = displ_list != 0
+    scale = max(abs(v[free]/displ_list[free]))
+    if scale == 0:
+        return zeros(len(resid), dtype=float64)
+
+    step = 1.e-6/scale
+    dresid = modelfn(P + step*v, *merged_list, pool=pool)
+    return (dresid - resid)/step
+
+
+def fd_vjp(modelfn, P, u, displ_list, merged_list, resid, pool = None, colnorms = False):
+    """J^T.u (u can have several columns) one finite-difference column of J at a time; each column is used and
+    dropped, so J is never stored. With colnorms, also returns the column norms of J (zero for fixed parameters).
+    Costs one model evaluation per free parameter, i.e., as much as a dense Jacobian."""
+    JTu = zeros((len(P),) + u.shape[1:], dtype=float64)
+    norms = zeros(len(P), dtype=float64)
+    for j in where(displ_list != 0)[0]:
+        v = zeros(len(P), dtype=float64)
+        v[j] = 1.
+        column = fd_jvp(modelfn, P, v, displ_list, merged_list, resid, pool = pool)
+        JTu[j] = dot(column, u)
+        norms[j] = sqrt(dot(column, column))
+    if colnorms:
+        return JTu, norms
+    return JTu
+
+
+class krylov_system():
+    """krylov_dim steps of Golub-Kahan bidiagonalization of J D^-1 (D = column norms of J), started from the
+    residuals, for matrix-free LM. The damping lam ||D x||^2 is miniLM's diag*(1 + lam); each lam is then a small
+    (k + 1) x k least-squares problem. Only the k right vectors (one per free parameter each) are kept. JTr is J^T.resid
+    (it comes with the column norms), so the k-step build costs k J.v and k - 1 J^T.u products."""
+
+    def __init__(self, Jv, JTu, resid, JTr, colnorms, krylov_dim):
+        self.colnorms = colnorms
+        n_free = len(colnorms)
+
+        self.beta1 = sqrt(dot(resid, resid))
+        u = -resid/self.beta1
+        v = -JTr/self.beta1/colnorms
+        alpha = sqrt(dot(v, v))
+
+        V = []
+        alphas = []
+        betas = []
+        while alpha > 1.e-12*self.beta1 and len(V) < min(krylov_dim, n_free):
+            v /= alpha
+            V.append(v)
+            alphas.append(alpha)
+
+            u = Jv(v/colnorms) - alpha*u
+            beta = sqrt(dot(u, u))
+            betas.append(beta)
+            if beta <= 1.e-12*self.beta1:
+                break
+            u /= beta
+
+            v = JTu(u)/colnorms - beta*v
+            for old_v in V:
+                # Reorthogonalize (n_free is small, the pixels aren't stored)
+                v -= dot(old_v, v)*old_v
+            alpha = sqrt(dot(v, v))
+
+        self.V = array(V)
+        k = len(V)
+        self.B = zeros([k + 1, k], dtype=float64)
+        for j in range(k):
+            self.B[j, j] = alphas[j]
+            self.B[j + 1, j] = betas[j]
+
+    def solve(self, lam):
+        """The LM step for damping lam."""
+        k = len(self.V)
+        if k == 0:
+            return zeros(len(self.colnorms), dtype=float64)
+
+        lhs = concatenate((self.B, sqrt(lam)*identity(k)))
+        rhs = zeros(2*k + 1, dtype=float64)
+        rhs[0] = self.beta1
+        z = linalg.lstsq(lhs, rhs, rcond = None)[0]
+        return dot(z, self.V)/self.colnorms
+
+
+def miniLM_matrix_free(params, merged_list, displ_list, verbose, maxiter = 150,
+    maxlam = 100000, return_wmat = False, pool = None, jvp_fn = None, vjp_fn = None,
+    krylov_dim = 20, normal_eq_fn = None):
+    """miniLM without a stored Jacobian: each step solves the damped normal equations in a Krylov subspace built
+    from J.v and J^T.u products (krylov_system), so memory is O(data + params). jvp_fn(P, v, displ_list, merged_list)
+    and vjp_fn(P, u, displ_list, merged_list, colnorms = False) (with colnorms, returning J^T.u and the column norms
+    of J, from the same pass) should be cheap products. The finite-difference defaults (fd_jvp, fd_vjp) work, but
+    every J^T.u costs one model evaluation per free parameter, so they are slower than the dense miniLM.
+    With return_wmat, JtJ (free parameters only) comes from normal_eq_fn(P, displ_list, merged_list) if given,
+    otherwise it is assembled from n_free J.v products."""
+
+    params = array(params, dtype=float64)
+    displ_list = array(displ_list, dtype=float64)
+
+    modelfn = merged_list[0]
+    del merged_list[0]
+
+    lam = 1.e-6
+    lamscale = 2.
 
+    curchi2 = modelfn(params, *merged_list, pool=pool)
+
+    unpad_params = get_unpad_params(params, displ_list)
+    n_free = len(unpad_params)
+    directions = zeros(len(params), dtype=float64)
+
+    def products(P, resid, with_norms = True):
+        # J.v and J^T.u in terms of the free parameters
+        if jvp_fn == None:
+            Jv = lambda v: fd_jvp(modelfn, P, get_pad_params(v, displ_list, directions), displ_list, merged_list, resid, pool = pool)
+        else:
+            Jv = lambda v: jvp_fn(P, get_pad_params(v, displ_list, directions), displ_list, merged_list)
+        if vjp_fn == None:
+            JTu_fn = lambda u, colnorms = False: fd_vjp(modelfn, P, u, displ_list, merged_list, resid, pool = pool, colnorms = colnorms)
+        else:
+            JTu_fn = lambda u, colnorms = False: vjp_fn(P, u, displ_list, merged_list, colnorms = colnorms)
+        JTu = lambda u: JTu_fn(u)[displ_list != 0]
+        if not with_norms:
+            return Jv, JTu
 
-    if len(param_wmat) > 0 and return_Cmat:
+        # J^T r and the column norms in one pass
+        JTr, colnorms = JTu_fn(resid, colnorms = True)
+        return Jv, JTu, JTr[displ_list != 0], colnorms[displ_list != 0]
+
+    itercount = 0
+    was_just_searching = 0
+    while lam < maxlam and itercount < maxiter:
+        itercount += 1
+
+        if not was_just_searching:
+            P = get_pad_params(unpad_params, displ_list, params)
+            Jv, JTu, JTr, colnorms = products(P, curchi2)
+
+            if any(colnorms == 0) or any(isnan(colnorms)):
+                print("Uninvertible Matrix!")
+                return [array([P], dtype=float64), array([dot(curchi2, curchi2), -1], dtype=float64)] + [zeros([n_free]*2, dtype=float64)]*return_wmat
+            system = krylov_system(Jv, JTu, curchi2, JTr, colnorms, krylov_dim)
+            if verbose:
+                print("Krylov dimension ", len(system.V))
+        was_just_searching = 0
+
+        delta1 = system.solve(lam)
+        delta2 = system.solve(lam/lamscale)
+
+        unpad_params1 = get_pad_params(unpad_params + delta1, displ_list, params)
+        unpad_params2 = get_pad_params(unpad_params + delta2, displ_list, params)
+
+        chi2_1 = modelfn(unpad_params1, *merged_list, pool=pool)
+        chi2_2 = modelfn(unpad_params2, *merged_list, pool=pool)
+
+        if dot(chi2_2, chi2_2) < dot(curchi2, curchi2):
+            curchi2 = chi2_2
+            unpad_params = unpad_params + delta2
+            lam /= lamscale
+
+        elif dot(chi2_1, chi2_1) < dot(curchi2, curchi2):
+            curchi2 = chi2_1
+            unpad_params = unpad_params + delta1
+        else:
+            itercount -= 1
+            was_just_searching = 1
+
+            while (dot(chi2_1, chi2_1) >= dot(curchi2, curchi2) and lam < maxlam) or isnan(dot(chi2_1, chi2_1)):
+                if verbose:
+                    print("Searching... ", lam)
+                lam *= lamscale
+
+                unpad_params1 = get_pad_params(unpad_params + system.solve(lam), displ_list, params)
+                chi2_1 = modelfn(unpad_params1, *merged_list, pool=pool)
+
+        if verbose:
+            print("itercount, unpad_params, lam, curchi2 ", itercount, unpad_params, lam, dot(curchi2, curchi2))
+
+    P = get_pad_params(unpad_params, displ_list, params)
+
+    JtJ = []
+    if return_wmat and normal_eq_fn != None:
+        JtJ = normal_eq_fn(P, displ_list, merged_list)[0]
+    elif return_wmat:
+        Jv, JTu = products(P, curchi2, with_norms = False)
+        JtJ = zeros([n_free]*2, dtype=float64)
+        for start in range(0, n_free, krylov_dim):
+            cols = arange(start, min(start + krylov_dim, n_free))
+            J_cols = transpose(array([Jv(identity(n_free)[j]) for j in cols]))
+            JtJ[:, cols] = JTu(J_cols)
+
+    return [array([P], dtype=float64), array([dot(curchi2, curchi2)], dtype=float64)] + [JtJ]*return_wmat
+
+
+def miniLM_new(ministart, miniscale, residfn, all_data, passdata, verbose = False, maxiter = 150, maxlam = 100000, Wmat = None, jacobian_name = "Jacob.fits", use_dense_J = False, return_Cmat = True, pad_Cmat = False, pool = None, save_jacobian = False, jacobian_fn = None, jacobian_sparsity = None, local_blocks = None, reuse_factorization = False, lambda_ladder = 0, batch_residfn = None, matrix_free = 0, jvp_fn = None, vjp_fn = None, normal_eq_fn = None, broyden_updates = 0, broyden_tolerance = 0.5):
+    if matrix_free:
+        # matrix_free is the Krylov dimension
+        [P, F, param_wmat] = miniLM_matrix_free(ministart, [residfn, passdata, all_data], miniscale, verbose, maxiter = maxiter, maxlam = maxlam, return_wmat = True, pool = pool, jvp_fn = jvp_fn, vjp_fn = vjp_fn, krylov_dim = matrix_free, normal_eq_fn = normal_eq_fn)
+    else:
+        [P, F, param_wmat] = miniLM(ministart, [residfn, passdata, all_data], miniscale, verbose, maxiter = maxiter, maxlam = maxlam, Wmat = Wmat, jacobian_name = jacobian_name, return_wmat = True, use_dense_J = use_dense_J, pool = pool, save_jacobian = save_jacobian, jacobian_fn = jacobian_fn, jacobian_sparsity = jacobian_sparsity, local_blocks = local_blocks, reuse_factorization = reuse_factorization, lambda_ladder = lambda_ladder, batch_residfn = batch_residfn, normal_eq_fn = normal_eq_fn, broyden_updates = broyden_updates, broyden_tolerance = broyden_tolerance)
+
+
+    if len(param_wmat) > 0 and return_Cmat and local_blocks != None:
+        # Global (galaxy + SN) block straight from the Schur complement
+        try:
+            Cmat = block_arrow_system(param_wmat, unpad_blocks(local_blocks, miniscale)).inverse()
+        except linalg.LinAlgError:
+            print("Determinant is zero!")
+            Cmat = None
+    elif len(param_wmat) > 0 and return_Cmat:
         if linalg.det(param_wmat) != 0.:
             Cmat = linalg.inv(param_wmat)
         else:
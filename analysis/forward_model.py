@@ -4,7 +4,7 @@ from astropy.io import fits
 import multiprocessing
 import sys
 import os
-from scipy.ndimage.interpolation import map_coordinates
+from scipy.ndimage.interpolation import map_coordinates, spline_filter
 from scipy.interpolate import interp2d, SmoothBivariateSpline
 from scipy.stats import scoreatpercentile
 from astropy import wcs
@@ -15,6 +15,10 @@ try:
     from analysis.NM import save_img, miniLM_new, miniNM_new
 except:
     from NM import save_img, miniLM_new, miniNM_new
+try:
+    from analysis.model_tools import psf_phase_table
+except:
+    from model_tools import psf_phase_table
 import gzip
 import pickle
 import time
@@ -55,7 +59,11 @@ def message(msg):
 # 1.33 01-16-2021: Dumps json of parsed to result file
 # 1.34 07-24-2022: Refactored to run inside of pipeline and streamline code
 # 1.35 08-17-2022: Created forward_model class to run within pipeline
-version = 1.35
+# 1.36 10-17-2026: Spline coeffs are prefiltered once per model, PSFs once in
+#                  get_PSFs (not in every map_coordinates call)
+# 1.37 10-17-2026: Added psf_phases: pixelized PSFs looked up in a table of
+#                  sub-pixel phases instead of resampled each call
+version = 1.37
 
 def robust_index(dat, i1, i2, j1, j2, fill_value = 0):
     sh = dat.shape
@@ -152,10 +160,13 @@ def make_pixelized_PSF(parsed, data, i):
     icoord = data["RADec_to_i"](parsed["pt_RA"][i], parsed["pt_Dec"][i])[0,0]
     jcoord = data["RADec_to_j"](parsed["pt_RA"][i], parsed["pt_Dec"][i])[0,0]
 
+    if data["psf_table"] is not None:
+        return data["psf_table"](icoord, jcoord, data["patch"])
+
     j2d, i2d = meshgrid(arange(data["patch"], dtype=float64)*data["oversample"],
                         arange(data["patch"], dtype=float64)*data["oversample"])
 
-    psf_subpix = data["psf_subpixelized"]
+    psf_subpix = data["psf_subpixelized_filtered"]
     psfsize = len(psf_subpix)
 
     i2d -= icoord*data["oversample"] - floor(psfsize/2.)
@@ -170,7 +181,7 @@ def make_pixelized_PSF(parsed, data, i):
                                     order=2,
                                     mode="constant",
                                     cval=0,
-                                    prefilter=True)
+                                    prefilter=False)
 
     pixelized_psf = reshape(pixelized_psf, [data["patch"], data["patch"]])
 
@@ -217,6 +228,12 @@ def pull_FN(parsed, im_ind, all_data, pool=None):
 def modelfn(parsed, data, just_pt_flux = False, pool=None):
     """Construct the model."""
 
+    # Spline-filter the coefficients once here instead of in every
+    # indiv_model call (map_coordinates then runs with prefilter=False)
+    parsed = dict(parsed)
+    parsed["filtered_coeffs"] = spline_filter(parsed["coeffs"], order=2,
+        mode="constant")
+
     output = []
     tasks = [(d, parsed, just_pt_flux) for d in data]
     if pool==None:
@@ -261,12 +278,12 @@ def indiv_model(args):
 
     coords = array([xs1D, ys1D])
 
-    subsampled_model = map_coordinates(parsed["coeffs"],
+    subsampled_model = map_coordinates(parsed["filtered_coeffs"],
                                            coordinates=coords,
                                            order=2,
                                            mode="constant",
                                            cval=0,
-                                           prefilter=True)
+                                           prefilter=False)
     subsampled_model = reshape(subsampled_model,
         [data["padsize"], data["padsize"]])
 
@@ -411,6 +428,11 @@ class forward_model():
         except:
             settings["iterative_centroid"] = 0
 
+        try:
+            settings["psf_phases"]
+        except:
+            settings["psf_phases"] = 0
+
         if settings["iterative_centroid"] and settings["fitSNoffset"]:
             assert 0, "Can't iterate a SN centroid. All images must be fit!"
 
@@ -669,7 +691,8 @@ class forward_model():
         msg='Must have a single PSF for all images or one PSF per image'
         assert n_psf==settings['n_img'], msg
 
-        psf_data = {'psf_FFTs':{}, 'psf_subpixelized':{}}
+        psf_data = {'psf_FFTs':{}, 'psf_subpixelized':{},
+            'psf_subpixelized_filtered':{}, 'psf_tables':{}}
 
         for psf in unique(settings["psfs"]):
             print(f'psf name: {psf}')
@@ -740,6 +763,11 @@ class forward_model():
             psfdata = array(real(ft.ifft2(psf_fft)), dtype=float64)
 
             psf_data["psf_subpixelized"][psf] = psfdata
+            psf_data["psf_subpixelized_filtered"][psf] = spline_filter(psfdata,
+                order=2, mode="constant")
+            if settings["psf_phases"]:
+                psf_data["psf_tables"][psf] = psf_phase_table(psfdata,
+                    settings["oversample"], settings["psf_phases"])
 
             save_img(psf_data["psf_subpixelized"][psf],
                 os.path.join(basedir, "psf_subpixelized.fits"))
@@ -752,6 +780,10 @@ class forward_model():
             all_data[i]['psf']=psfs[i]
             all_data[i]['psf_subpixelized']=psf_data['psf_subpixelized'][
                 all_data[i]['psf']]
+            all_data[i]['psf_subpixelized_filtered']=psf_data[
+                'psf_subpixelized_filtered'][all_data[i]['psf']]
+            all_data[i]['psf_table']=psf_data['psf_tables'].get(
+                all_data[i]['psf'])
             all_data[i]['psf_FFTs']=psf_data['psf_FFTs'][all_data[i]['psf']]
             all_data[i]['oversample']=settings['oversample']
             all_data[i]['oversample2']=settings['oversample2']
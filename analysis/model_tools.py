@@ -0,0 +1,449 @@
+from numpy import *
+from scipy.ndimage import spline_filter1d, map_coordinates
+from scipy.sparse import csr_matrix
+from scipy import fftpack as ft
+from scipy import fft as sp_fft
+
+# Helpers shared by the forward-model scripts (new_phot_elliptical.py etc.).
+# Everything in here reproduces what those scripts already compute with
+# map_coordinates(order = 2, mode = "constant") and the padded PSF FFTs, but in
+# a form that can be reused (explicit linear operators, caches, ...).
+
+# version history:
+# 1.0 10-17-2026: First release. Spline sampling/prefilter matrices and linear galaxy operator.
+# 1.1 10-17-2026: Added the batched real-FFT convolution backend (fft_backend = "rfft") and a benchmark.
+# 1.2 10-17-2026: Added local_linear_map and shift-theorem helpers (fourier_shift rendering).
+# 1.3 10-17-2026: Added psf_phase_table (pixelized PSFs tabulated on sub-pixel phases).
+# 1.4 10-17-2026: Added closed-form (quadratic) sky-to-pixel transforms, evaluated for all images at once.
+# 1.5 10-17-2026: Added fit_grid_to_sky/grid_to_sky (oversampled RA/Dec grids regenerated from six numbers per axis).
+# 1.6 10-17-2026: Added spline_gradient (analytic first derivatives of the order-2 spline interpolant).
+# 1.7 10-17-2026: Moved in oneD_spline (segment table form) with its derivative and amplitude basis, from new_phot_elliptical.py.
+# 1.8 10-17-2026: shift_phase_ramp zeroes the Nyquist term of even axes; dropped shift_derivative_factors (fourier_shift no longer feeds linear_jacobian).
+
+version = 1.8
+
+
+def spline_prefilter_matrix(n, order = 2):
+    """Matrix form of the 1D prefilter map_coordinates(prefilter = True, mode = "constant") applies along each axis."""
+    return spline_filter1d(eye(n), order = order, axis = 0, mode = "constant")
+
+
+def quadratic_bspline_weights(x):
+    """Stencil centre and the three order-2 B-spline weights for coordinates x."""
+    centre = floor(x + 0.5)
+    t = x - centre
+    return array(centre, dtype=int64), [0.5*(0.5 - t)**2, 0.75 - t**2, 0.5*(0.5 + t)**2]
+
+
+def spline_sampling_matrix(xs, ys, shape):
+    """Sparse matrix S with S.dot(ravel(filtered)) == map_coordinates(filtered, [xs, ys], order = 2, mode = "constant", prefilter = False).
+
+    Samples outside [0, n - 1] are zero (cval = 0), and the stencil is mirrored at the edges, as in scipy."""
+
+    xs = ravel(xs)
+    ys = ravel(ys)
+
+    inside = (xs >= 0) & (xs <= shape[0] - 1) & (ys >= 0) & (ys <= shape[1] - 1)
+
+    xc, xw = quadratic_bspline_weights(xs)
+    yc, yw = quadratic_bspline_weights(ys)
+
+    rows = []
+    cols = []
+    vals = []
+    for a in range(3):
+        ii = mirror_index(xc + a - 1, shape[0])
+        for b in range(3):
+            jj = mirror_index(yc + b - 1, shape[1])
+            rows.append(where(inside)[0])
+            cols.append((ii*shape[1] + jj)[inside])
+            vals.append((xw[a]*yw[b])[inside])
+
+    # Duplicate (row, col) entries from mirroring are summed by csr_matrix.
+    return csr_matrix((concatenate(vals), (concatenate(rows), concatenate(cols))), shape = (len(xs), shape[0]*shape[1]))
+
+
+def quadratic_bspline_derivative_weights(x):
+    """Stencil centre and d/dx of the three quadratic_bspline_weights."""
+    centre = floor(x + 0.5)
+    t = x - centre
+    return array(centre, dtype=int64), [t - 0.5, -2.*t, 0.5 + t]
+
+
+def spline_gradient(filtered, xs, ys):
+    """(d/dxs, d/dys) of map_coordinates(filtered, [xs, ys], order = 2, mode = "constant", prefilter = False), with the
+    same edge handling as spline_sampling_matrix. xs, ys can have any (matching) shape."""
+
+    shape = filtered.shape
+    inside = (xs >= 0) & (xs <= shape[0] - 1) & (ys >= 0) & (ys <= shape[1] - 1)
+
+    xc, xw = quadratic_bspline_weights(xs)
+    NA, dxw = quadratic_bspline_derivative_weights(xs)
+    yc, yw = quadratic_bspline_weights(ys)
+    NA, dyw = quadratic_bspline_derivative_weights(ys)
+
+    d_dxs = zeros(xs.shape, dtype=float64)
+    d_dys = zeros(xs.shape, dtype=float64)
+    for a in range(3):
+        ii = mirror_index(xc + a - 1, shape[0])
+        for b in range(3):
+            vals = filtered[ii, mirror_index(yc + b - 1, shape[1])]
+            d_dxs += dxw[a]*yw[b]*vals
+            d_dys += xw[a]*dyw[b]*vals
+
+    return d_dxs*inside, d_dys*inside
+
+
+def mirror_index(ind, n):
+    ind = where(ind < 0, -ind, ind)
+    ind = where(ind > n - 1, 2*(n - 1) - ind, ind)
+    return clip(ind, 0, n - 1)
+
+
+class galaxy_operator():
+    """Linear response of one image to a 2D spline coefficient grid.
+
+    xs, ys are the spline-grid coordinates of the padsize x padsize oversampled grid
+    (exactly what indiv_model hands to map_coordinates). matvec(coeffs) reproduces the
+    convolved, pixel-sampled galaxy model; rmatvec is its adjoint; dense() returns the
+    patch**2 x n_coeff matrix whose columns are the exact Jacobian columns."""
+
+    def __init__(self, xs, ys, radius, psf_FFT, oversample, patch):
+        self.radius = radius
+        self.shape = (2*radius + 1, 2*radius + 1)
+        self.padsize = xs.shape[0]
+        self.oversample = oversample
+        self.oversample2 = int(floor(oversample/2.))
+        self.patch = patch
+
+        self.prefilter = spline_prefilter_matrix(self.shape[0])
+        self.sampling = spline_sampling_matrix(xs, ys, self.shape)
+        self.psf_FFT = psf_FFT
+
+        pix_i, pix_j = meshgrid(self.oversample2 + arange(patch)*oversample,
+                                self.oversample2 + arange(patch)*oversample, indexing = "ij")
+        self.pix_i = ravel(pix_i)
+        self.pix_j = ravel(pix_j)
+
+    def filter(self, coeffs):
+        return dot(dot(self.prefilter, coeffs), transpose(self.prefilter))
+
+    def filter_adjoint(self, grid):
+        return dot(dot(transpose(self.prefilter), grid), self.prefilter)
+
+    def convolve(self, subsampled_model):
+        convolved = array(real(ft.ifft2(ft.fft2(subsampled_model) * self.psf_FFT)), dtype=float64)
+        return convolved[self.pix_i, self.pix_j].reshape(self.patch, self.patch)
+
+    def matvec(self, coeffs):
+        subsampled_model = reshape(self.sampling.dot(ravel(self.filter(coeffs))), [self.padsize]*2)
+        return self.convolve(subsampled_model)
+
+    def rmatvec(self, pixels):
+        upsampled = zeros([self.padsize]*2, dtype=float64)
+        upsampled[self.pix_i, self.pix_j] = ravel(pixels)
+        correlated = real(ft.ifft2(ft.fft2(upsampled) * conj(self.psf_FFT)))
+        grid = reshape(self.sampling.T.dot(ravel(correlated)), self.shape)
+        return self.filter_adjoint(grid)
+
+    def dense(self, mask = None, chunk = 64):
+        """Rows are rmatvec of each output pixel; columns follow unreshape_coeffs order."""
+        if mask is None:
+            mask = coeff_mask(self.radius)
+        flat_mask = ravel(mask)
+
+        # The adjoint of convolving with the (circular) PSF and sampling pixel p is the
+        # flipped PSF rolled onto p, so build those directly instead of doing one FFT per pixel.
+        flipped = array(real(ft.ifft2(conj(self.psf_FFT))), dtype=float64)
+        # Tile it so the circular shifts become plain offsets into the flattened array
+        N = self.padsize
+        flipped = ravel(tile(flipped, (2, 2)))
+
+        # Only the oversampled points that the spline reaches contribute.
+        support = where(diff(self.sampling.indptr) > 0)[0]
+        support_offset = (support // N + N)*2*N + support % N + N
+        pix_offset = self.pix_i*2*N + self.pix_j
+        sampling_T = self.sampling[support].T.tocsr()
+
+        G = zeros([self.patch**2, sum(flat_mask)], dtype=float64)
+        for start in range(0, self.patch**2, chunk):
+            stop = min(start + chunk, self.patch**2)
+            rolled = flipped[support_offset[:, None] - pix_offset[None, start:stop]]
+            sampled = sampling_T.dot(rolled)
+            sampled = reshape(sampled, (self.shape[0], self.shape[1], stop - start))
+            filtered = einsum("ai,abk,bj->kij", self.prefilter, sampled, self.prefilter)
+            G[start:stop] = reshape(filtered, (stop - start, self.shape[0]*self.shape[1]))[:, flat_mask]
+        return G
+
+
+def coeff_mask(radius):
+    """Grid points that carry a coefficient (same test as reshape_coeffs)."""
+    i, j = meshgrid(arange(2*radius + 1), arange(2*radius + 1), indexing = "ij")
+    return (i - radius)**2. + (j - radius)**2. < radius**2.
+
+
+def oneD_spline_table(spacingarray):
+    """The quadratic segments A r^2 + B r + C of oneD_spline, as linear maps of the amplitudes: shape [nseg + 2, 3, n_ampl].
+    Row 0 is r < spacingarray[0] (zero), rows 1..nseg the segments, the last row the constant after the last space, so
+    searchsorted(spacingarray, r, side = "right") indexes it directly."""
+
+    # amplarr =     [2., 1., 0.5, 0.4, 0.3, 0.2, 0.1, 0.05, 0.0] # should end with about 0
+    # spacingrarray = [0., 1., 2.,  3.,  5.,  8.,  15., 20.,  50.] # should start with 0.
+    # len = 9
+    n_ampl = len(spacingarray)
+    nseg = n_ampl - 1
+
+    amplarr = identity(n_ampl) # column k: the spline of amplitude k alone
+    table = zeros([nseg + 2, 3, n_ampl], dtype=float64)
+    table[-1, 2] = amplarr[-1] # constant after last space
+
+    # fit from the outside in
+    deriv = zeros(n_ampl, dtype=float64) # flat at infinity
+
+    for i in range(nseg)[::-1]:
+        d2 = deriv
+
+        x1 = spacingarray[i]
+        x2 = spacingarray[i + 1] # larger
+
+        y1 = amplarr[i]
+        y2 = amplarr[i + 1]
+
+        table[i + 1, 0] = (d2*(-x1 + x2) + y1 - y2)/(x1 - x2)**2.
+        table[i + 1, 1] = (d2*(x1**2. - x2**2.) + 2.*x2*(-y1 + y2))/(x1 - x2)**2.
+        table[i + 1, 2] = (d2*x1*x2*(-x1 + x2) + x2**2.*y1 + x1**2.*y2 - 2.*x1*x2*y2)/(x1 - x2)**2.
+
+        deriv = (-(d2*x1) + d2*x2 + 2.*y1 - 2.*y2)/(x1 - x2)
+
+    return table
+
+
+def oneD_spline_segments(amplarray, spacingarray, rarray):
+    """A, B, C of the segment each radius falls in (oneD_spline_table), for these amplitudes."""
+    ABC = dot(oneD_spline_table(spacingarray), amplarray)
+    ABC = ABC[searchsorted(spacingarray, rarray, side = "right")]
+    return ABC[..., 0], ABC[..., 1], ABC[..., 2]
+
+
+def oneD_spline(amplarray, spacingarray, rarray):
+    """Piecewise-quadratic profile through amplarray at radii spacingarray, flat at infinity, evaluated at rarray."""
+    A, B, C = oneD_spline_segments(amplarray, spacingarray, rarray)
+    return A*rarray**2. + B*rarray + C
+
+
+def oneD_spline_deriv(amplarray, spacingarray, rarray):
+    """d(oneD_spline)/dr: the same quadratic segments, differentiated."""
+    A, B, C = oneD_spline_segments(amplarray, spacingarray, rarray)
+    return 2.*A*rarray + B
+
+
+def oneD_spline_basis(spacingarray, rarray):
+    """oneD_spline is linear in the amplitudes: basis[k] is d(oneD_spline)/d(amplarray[k]), shape [n_ampl] + rarray.shape."""
+    ABC = oneD_spline_table(spacingarray)[searchsorted(spacingarray, rarray, side = "right")]
+    return moveaxis(ABC[..., 0, :]*(rarray**2.)[..., None] + ABC[..., 1, :]*rarray[..., None] + ABC[..., 2, :], -1, 0)
+
+
+class psf_phase_table():
+    """Pixelized PSFs (what make_pixelized_PSF computes) tabulated on an (n_phase + 1)^2 grid of sub-pixel phases.
+
+    Built once per PSF. A lookup blends the four nearest phases bilinearly and drops the stamp into the patch;
+    derivs() returns the derivatives of the same interpolant with respect to the SN pixel coordinates."""
+
+    def __init__(self, psf_subpixelized, oversample, n_phase = 32):
+        self.n_phase = n_phase
+
+        half = floor(len(psf_subpixelized)/2.)
+        self.H = int(ceil(half/oversample)) + 1
+        self.stamp_size = 2*self.H + 2
+
+        # Patch pixel k of an SN at pixel coordinate n + phase is stamp pixel m = k - n + H, i.e.,
+        # make_pixelized_PSF samples the oversampled PSF at oversample*(m - H - phase) + half.
+        phases = arange(n_phase + 1, dtype=float64)/n_phase
+        coords1D = oversample*(arange(self.stamp_size, dtype=float64)[None, :] - self.H - phases[:, None]) + half
+
+        shape = (n_phase + 1, n_phase + 1, self.stamp_size, self.stamp_size)
+        icoords = broadcast_to(coords1D[:, None, :, None], shape)
+        jcoords = broadcast_to(coords1D[None, :, None, :], shape)
+
+        self.table = map_coordinates(psf_subpixelized, coordinates = [ravel(icoords), ravel(jcoords)], order = 2, mode = "constant", cval = 0, prefilter = True)
+        self.table = reshape(self.table, shape)
+
+    def phase(self, coord):
+        n = int(floor(coord))
+        p = min(int((coord - n)*self.n_phase), self.n_phase - 1)
+        t = (coord - n)*self.n_phase - p
+        return n, p, t
+
+    def place(self, stamp, n_i, n_j, patch):
+        pixelized_psf = zeros([patch, patch], dtype=float64)
+
+        i0 = max(0, n_i - self.H) ; i1 = min(patch, n_i - self.H + self.stamp_size)
+        j0 = max(0, n_j - self.H) ; j1 = min(patch, n_j - self.H + self.stamp_size)
+        if i1 > i0 and j1 > j0:
+            pixelized_psf[i0:i1, j0:j1] = stamp[i0 - n_i + self.H: i1 - n_i + self.H, j0 - n_j + self.H: j1 - n_j + self.H]
+        return pixelized_psf
+
+    def __call__(self, icoord, jcoord, patch):
+        n_i, p_i, t_i = self.phase(icoord)
+        n_j, p_j, t_j = self.phase(jcoord)
+        T = self.table
+
+        stamp = ((1 - t_i)*(1 - t_j)*T[p_i, p_j] + t_i*(1 - t_j)*T[p_i + 1, p_j] +
+                 (1 - t_i)*t_j*T[p_i, p_j + 1] + t_i*t_j*T[p_i + 1, p_j + 1])
+        return self.place(stamp, n_i, n_j, patch)
+
+    def derivs(self, icoord, jcoord, patch):
+        """d(pixelized PSF)/d(icoord), d(pixelized PSF)/d(jcoord)."""
+        n_i, p_i, t_i = self.phase(icoord)
+        n_j, p_j, t_j = self.phase(jcoord)
+        T = self.table
+
+        dstamp_i = self.n_phase*((1 - t_j)*(T[p_i + 1, p_j] - T[p_i, p_j]) + t_j*(T[p_i + 1, p_j + 1] - T[p_i, p_j + 1]))
+        dstamp_j = self.n_phase*((1 - t_i)*(T[p_i, p_j + 1] - T[p_i, p_j]) + t_i*(T[p_i + 1, p_j + 1] - T[p_i + 1, p_j]))
+        return [self.place(dstamp_i, n_i, n_j, patch), self.place(dstamp_j, n_i, n_j, patch)]
+
+
+def fft_padsize(psf_shape, model_shape, fft_backend = "fftpack"):
+    """Size of the (square) oversampled model grid.
+
+    "fftpack" is the original power of two; "rfft" uses the smallest fast size that holds
+    the patch plus the PSF (so the circular convolution doesn't wrap onto the patch)."""
+
+    if fft_backend == "fftpack":
+        return int(2**ceil(log2(max(max(psf_shape), model_shape))))
+    elif fft_backend == "rfft":
+        return int(sp_fft.next_fast_len(model_shape + max(psf_shape) - 1, real = True))
+    else:
+        assert 0, "Unknown fft_backend " + str(fft_backend)
+
+
+def half_spectrum(psf_FFT):
+    """The part of a real image's full 2D FFT that rfft2 keeps."""
+    return array(psf_FFT[:, :psf_FFT.shape[1]//2 + 1])
+
+
+def batch_convolve(subsampled_models, psf_names, psf_rFFTs, workers = 1):
+    """Convolve each model with its PSF. All models sharing a PSF go through one 3D rfft2/irfft2."""
+
+    convolved = [None]*len(subsampled_models)
+
+    for psf in unique(psf_names):
+        inds = [k for k in range(len(subsampled_models)) if psf_names[k] == psf]
+        stack = array([subsampled_models[k] for k in inds], dtype=float64)
+
+        stack_convolved = sp_fft.irfft2(sp_fft.rfft2(stack, workers = workers) * psf_rFFTs[psf], s = stack.shape[1:], workers = workers)
+        for k, this_convolved in zip(inds, stack_convolved):
+            convolved[k] = this_convolved
+
+    return convolved
+
+
+def local_linear_map(RAs, Decs):
+    """Least-squares linear fit [RA, Dec] = const + M.dot([index0, index1]) over a grid of (RAs, Decs). Returns M (degrees per grid step)."""
+    ind0, ind1 = meshgrid(arange(RAs.shape[0], dtype=float64), arange(RAs.shape[1], dtype=float64), indexing = "ij")
+    design = transpose([ones(RAs.size, dtype=float64), ravel(ind0), ravel(ind1)])
+    fit = linalg.lstsq(design, transpose([ravel(RAs), ravel(Decs)]), rcond = None)[0]
+    return transpose(fit[1:])
+
+
+def sky_offsets_arcsec(RAs, Decs, RA0, Dec0):
+    """Tangent-plane offsets (arcsec) of (RAs, Decs) from (RA0, Dec0)."""
+    return (RAs - RA0)*cos(Dec0/(180./pi))*3600., (Decs - Dec0)*3600.
+
+
+def quadratic_terms(dx, dy):
+    return array([ones(shape(dx), dtype=float64), dx, dy, dx*dx, dx*dy, dy*dy])
+
+
+def fit_sky_to_pixel(RAs, Decs, RA0, Dec0):
+    """Least-squares quadratic [i, j] = C.dot(quadratic_terms(dx, dy)) over a grid of (RAs, Decs) sampled at pixel
+    indices i (axis 0) and j (axis 1), with dx, dy from sky_offsets_arcsec. Returns C (2 x 6)."""
+    pix_is, pix_js = meshgrid(arange(RAs.shape[0], dtype=float64), arange(RAs.shape[1], dtype=float64), indexing = "ij")
+    dx, dy = sky_offsets_arcsec(ravel(RAs), ravel(Decs), RA0, Dec0)
+    fit = linalg.lstsq(transpose(quadratic_terms(dx, dy)), transpose([ravel(pix_is), ravel(pix_js)]), rcond = None)[0]
+    return transpose(fit)
+
+
+def sky_to_pixel(sky_to_pix, RA0s, Dec0s, RAs, Decs):
+    """Pixel coordinates of one position per image. sky_to_pix is (n_img x 2 x 6), everything else n_img long.
+    Returns icoords, jcoords."""
+    dx, dy = sky_offsets_arcsec(asarray(RAs, dtype=float64), asarray(Decs, dtype=float64), RA0s, Dec0s)
+    coords = einsum("nab,bn->an", sky_to_pix, quadratic_terms(dx, dy))
+    return coords[0], coords[1]
+
+
+def sky_to_pixel_derivs(sky_to_pix, RA0s, Dec0s, RAs, Decs):
+    """d[icoord, jcoord]/d[RA, Dec] (degrees) for one position per image; returns n_img x 2 x 2."""
+    dx, dy = sky_offsets_arcsec(asarray(RAs, dtype=float64), asarray(Decs, dtype=float64), RA0s, Dec0s)
+    zero = zeros(shape(dx), dtype=float64)
+    one = ones(shape(dx), dtype=float64)
+    dterms_dx = array([zero, one, zero, 2*dx, dy, zero])
+    dterms_dy = array([zero, zero, one, zero, dx, 2*dy])
+
+    derivs = zeros([len(dx), 2, 2], dtype=float64)
+    derivs[:, :, 0] = einsum("nab,bn->na", sky_to_pix, dterms_dx)*(cos(Dec0s/(180./pi))*3600.)[:, None]
+    derivs[:, :, 1] = einsum("nab,bn->na", sky_to_pix, dterms_dy)*3600.
+    return derivs
+
+
+def centered_grid_indices(shape):
+    ind0, ind1 = meshgrid(arange(shape[0], dtype=float64), arange(shape[1], dtype=float64), indexing = "ij")
+    return ind0 - (shape[0] - 1)/2., ind1 - (shape[1] - 1)/2.
+
+
+def fit_grid_to_sky(RAs, Decs, RA0, Dec0):
+    """Least-squares quadratic [RA - RA0, Dec - Dec0] (arcsec) = C.dot(quadratic_terms(index0, index1)), indices
+    measured from the center of the grid. Returns C (2 x 6)."""
+    ind0, ind1 = centered_grid_indices(RAs.shape)
+    fit = linalg.lstsq(transpose(quadratic_terms(ravel(ind0), ravel(ind1))),
+                       transpose([(ravel(RAs) - RA0)*3600., (ravel(Decs) - Dec0)*3600.]), rcond = None)[0]
+    return transpose(fit)
+
+
+def grid_to_sky(grid_to_sky_coeffs, RA0, Dec0, shape):
+    """Regenerate the (RAs, Decs) grid that fit_grid_to_sky was fit to."""
+    ind0, ind1 = centered_grid_indices(shape)
+    offsets = einsum("ab,bij->aij", grid_to_sky_coeffs, quadratic_terms(ind0, ind1))
+    return RA0 + offsets[0]/3600., Dec0 + offsets[1]/3600.
+
+
+def shift_phase_ramp(shape, shift):
+    """rfft2-layout phase ramp that translates an image by shift = (d0, d1) grid steps: f(x) -> f(x - shift).
+    The Nyquist term of an even axis is zeroed, as a complex ramp there isn't the transform of a real image."""
+    ramp0 = exp(-2j*pi*sp_fft.fftfreq(shape[0])*shift[0])
+    ramp1 = exp(-2j*pi*sp_fft.rfftfreq(shape[1])*shift[1])
+    if shape[0] % 2 == 0:
+        ramp0[shape[0]//2] = 0.
+    if shape[1] % 2 == 0:
+        ramp1[-1] = 0.
+    return ramp0[:, None]*ramp1[None, :]
+
+
+def benchmark_fft_backends(n_img = 50, n_psf = 1, patch = 15, oversample = 5, psfsize = 41, n_trial = 10):
+    """Time the original per-image complex fftpack convolution against batch_convolve."""
+    import time
+
+    model_shape = patch*oversample
+    results = {}
+
+    for fft_backend in ["fftpack", "rfft"]:
+        padsize = fft_padsize([psfsize]*2, model_shape, fft_backend)
+        psf_names = ["psf%i" % (k % n_psf) for k in range(n_img)]
+        psf_FFTs = dict([(name, ft.fft2(random.random(size = [padsize]*2))) for name in unique(psf_names)])
+        psf_rFFTs = dict([(name, half_spectrum(psf_FFTs[name])) for name in psf_FFTs])
+        models = random.random(size = [n_img, padsize, padsize])
+
+        t = time.time()
+        for trial in range(n_trial):
+            if fft_backend == "fftpack":
+                convolved = [array(real(ft.ifft2(ft.fft2(models[k]) * psf_FFTs[psf_names[k]])), dtype=float64) for k in range(n_img)]
+            else:
+                convolved = batch_convolve(models, psf_names, psf_rFFTs)
+        results[fft_backend] = (padsize, (time.time() - t)/n_trial)
+        print(fft_backend, "padsize", padsize, "seconds for", n_img, "images", results[fft_backend][1])
+
+    return results
+
+
+if __name__ == "__main__":
+    benchmark_fft_backends()
@@ -10,6 +10,7 @@ from scipy.stats import scoreatpercentile
 from astropy import wcs
 from scipy import fftpack as ft
 from DavidsNM import save_img, miniLM_new, miniNM_new
+from model_tools import psf_phase_table
 import gzip
 import pickle as pickle
 import time
@@ -18,7 +19,7 @@ import json
 import warnings
 warnings.filterwarnings('ignore')
 
-version = 1.34
+version = 1.35
 
 # version history:
 # 1.0 05-01-2018: First release
@@ -43,6 +44,7 @@ version = 1.34
 # 1.32 01-02-2019: Fixed epochs bug when starting with non-zero epoch
 # 1.33 01-16-2021: Dumps json of parsed to result file
 # 1.34 07-24-2022: Refactored for running inside of pipeline and streamlined code
+# 1.35 10-17-2026: Added psf_phases: pixelized PSFs looked up in a table of sub-pixel phases instead of resampled each call
 
 
 print("version: ", version)
@@ -107,6 +109,11 @@ def finish_settings(settings):
     except:
         settings["iterative_centroid"] = 0
 
+    try:
+        settings["psf_phases"]
+    except:
+        settings["psf_phases"] = 0
+
     if settings["iterative_centroid"] and settings["fitSNoffset"]:
         assert 0, "Can't iterate a SN centroid. All images must be fit!"
 
@@ -293,6 +300,7 @@ def get_PSFs(settings):
 
     all_data["psf_FFTs"] = {}
     all_data["psf_subpixelized"] = {}
+    all_data["psf_tables"] = {}
 
     basedir = settings["base_dir"]
 
@@ -358,6 +366,8 @@ def get_PSFs(settings):
         psfdata = array(real(ft.ifft2(ft.fft2(psfdata_odd) * ft.fft2(recenter))), dtype=float64)
 
         all_data["psf_subpixelized"][psf] = psfdata
+        if settings["psf_phases"]:
+            all_data["psf_tables"][psf] = psf_phase_table(psfdata, settings["oversample"], settings["psf_phases"])
 
         save_img(all_data["psf_subpixelized"][psf], os.path.join(basedir, "psf_subpixelized.fits"))
 
@@ -452,6 +462,9 @@ def make_pixelized_PSF(parsed, i):
     icoord = all_data["RADec_to_i"][i](parsed["pt_RA"][i], parsed["pt_Dec"][i])[0,0]
     jcoord = all_data["RADec_to_j"][i](parsed["pt_RA"][i], parsed["pt_Dec"][i])[0,0]
 
+    if settings["psf_phases"]:
+        return all_data["psf_tables"][settings["psfs"][i]](icoord, jcoord, settings["patch"])
+
     j2d, i2d = meshgrid(arange(settings["patch"], dtype=float64)*settings["oversample"],
                         arange(settings["patch"], dtype=float64)*settings["oversample"])
 
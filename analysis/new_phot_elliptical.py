@@ -4,21 +4,26 @@ multiprocessing.set_start_method("fork")
 from numpy import *
 from astropy.io import fits
 import sys
-from scipy.ndimage.interpolation import map_coordinates
+from collections import OrderedDict
+from scipy.ndimage.interpolation import map_coordinates, spline_filter
 from scipy.interpolate import interp2d, SmoothBivariateSpline
 from scipy.stats import scoreatpercentile
 from astropy import wcs
 from scipy import fftpack as ft
-from DavidsNM import save_img, miniLM_new, miniNM_new
+from DavidsNM import save_img, miniLM_new, miniNM_new, Jacobian, grouped_Jacobian, color_columns
+from scipy import fft as sp_fft
+from scipy.linalg import cho_factor, cho_solve
+from model_tools import galaxy_operator, coeff_mask, oneD_spline, oneD_spline_deriv, oneD_spline_basis, fft_padsize, half_spectrum, batch_convolve, local_linear_map, shift_phase_ramp, psf_phase_table, fit_sky_to_pixel, sky_to_pixel, sky_to_pixel_derivs, fit_grid_to_sky, grid_to_sky, spline_gradient
 import gzip
 import pickle as pickle
+import hashlib
 import time
 import json
 
 import warnings
 warnings.filterwarnings('ignore')
 
-version = 1.4
+version = 1.78
 
 # version history:
 # 1.0 05-01-2018: First release
@@ -44,6 +49,44 @@ version = 1.4
 # 1.33 01-16-2021: Dumps json of parsed to result file
 # 1.34 03-15-2021: Multiprocessing fix
 # 1.4 09-16-2022: Added option for elliptical-spline galaxies (usueful for reference-less photometry)
+# 1.41 10-17-2026: Added linear_jacobian: exact Jacobian columns for 2D spline coeffs and SN amplitudes
+# 1.42 10-17-2026: Added varpro: variable-projection fit (LM over positions only, linear parameters solved exactly)
+# 1.43 10-17-2026: Added fft_backend: "rfft" convolves all images sharing a PSF in one batched real FFT
+# 1.44 10-17-2026: Spline coeffs are prefiltered once per model, PSFs once in get_PSFs (not in every map_coordinates call)
+# 1.45 10-17-2026: Added fourier_shift: galaxy rendered once per image at zero offset, dRA/dDec applied as a phase ramp
+# 1.46 10-17-2026: Added convolve_once: with a single PSF, convolve the galaxy once and resample it into each image
+# 1.47 10-17-2026: Added psf_phases: pixelized PSFs looked up in a table of sub-pixel phases instead of resampled each call
+# 1.48 10-17-2026: Added local_wcs: closed-form quadratic sky-to-pixel transforms (one array for all images) replace the RADec_to_i/j splines
+# 1.49 10-17-2026: Added lazy_grids: oversampled RA/Dec grids regenerated from a quadratic per image, kept in a bounded LRU
+# 1.50 10-17-2026: Added packed_pulls: pulls and Jacobian rows only for pixels with invvar > 0; images with none aren't rendered
+# 1.51 10-17-2026: Added sparse_jacobian: finite-difference columns only re-render the images each parameter affects
+# 1.52 10-17-2026: Added color_jacobian: parameters touching disjoint pulls are differenced in one model evaluation
+# 1.53 10-17-2026: Added schur_solver: LM steps eliminate the per-image (dRA, dDec) blocks with a Schur complement
+# 1.54 10-17-2026: Added reuse_factorization: one eigendecomposition per LM Jacobian serves every damping trial
+# 1.55 10-17-2026: Added lambda_ladder: LM tries several damping values per Jacobian, all rendered in one pool.map
+# 1.56 10-17-2026: Added matrix_free: Krylov-subspace LM from J.v and J^T.u (pull_vjp), the Jacobian is never stored
+# 1.57 10-17-2026: Added stream_jacobian_MB: LM normal equations accumulated over chunks of images by the workers
+# 1.58 10-17-2026: Added broyden_updates, broyden_tolerance: rank-one LM Jacobian updates between full rebuilds
+# 1.59 10-17-2026: 1D pre-fit reports uncertainties from miniNM_new's Gauss-Newton covariance
+# 1.60 10-17-2026: Added parallel_simplex: the 1D pre-fit's simplex trial points are rendered together in one pool.map
+# 1.61 10-17-2026: Added analytic_centroids: dRA/dDec and SN-offset Jacobian columns from spline and PSF gradients
+# 1.62 10-17-2026: Added component_cache: LRU of convolved galaxies and pixelized PSFs, keyed on the parameters they use
+# 1.63 10-17-2026: Vectorized oneD_spline (one searchsorted, segment table); exact 1D amplitude Jacobian columns (oneD_spline_basis)
+# 1.64 10-17-2026: Added gradient_1D_prefit: the 1D pre-fit is an LM fit with analytic axis ratio / orientation columns
+# 1.65 10-17-2026: Added parallel_centroid: iterative_centroid's per-image fits run concurrently, one per worker
+# 1.66 10-17-2026: varpro solves the normal equations (Cholesky) from per-image JtJ, J^T r blocks, cached up to varpro_cache_MB
+# 1.67 10-17-2026: linear_jacobian, analytic_centroids, varpro, gradient_1D_prefit are turned off with convolve_once
+# 1.68 10-17-2026: matrix_free gets J.v and J^T.u from galaxy_operator / PSF products (pull_jvp, pull_vjp), column norms with J^T r, wmat from streamed_normal_equations
+# 1.69 10-17-2026: stream_jacobian_MB is turned off with fourier_shift or convolve_once (its rows come from indiv_model)
+# 1.70 10-17-2026: component_cache keys galaxies on a digest of the coeffs (hashed once per model evaluation)
+# 1.71 10-17-2026: oneD_spline and its table / derivative / basis moved to model_tools.py
+# 1.72 10-17-2026: parallel_centroid is turned off with fourier_shift or convolve_once (its fits render with indiv_model)
+# 1.73 10-17-2026: The driver only runs as a script (under if __name__ == "__main__"), so tests can import the functions
+# 1.74 10-17-2026: fourier_shift renders each spectrum pre-shifted to the middle of the padded box (so the phase ramp never wraps the galaxy onto the patch), zeroes the Nyquist term, and turns off the per-image Jacobian options
+# 1.75 10-17-2026: convolve_once falls back to convolving each image unless all images share image 0's orientation on the sky
+# 1.76 10-17-2026: matrix_free is turned off with fourier_shift or convolve_once (pull_jvp / pull_vjp render with indiv_model)
+# 1.77 10-17-2026: The simplex 1D pre-fit skips its covariance again (compute_Cmat = False); only gradient_1D_prefit reports one
+# 1.78 10-17-2026: component_cache is kept in the main process (only misses go to the pool) and only hashes the coeffs when it's on; pixelized PSFs aren't cached
 
 
 print("version: ", version)
@@ -112,6 +155,13 @@ def finish_settings(settings):
     if settings["iterative_centroid"] and settings["fitSNoffset"]:
         assert 0, "Can't iterate a SN centroid. All images must be fit!"
 
+    # Optional speed-ups; all default to the original behavior.
+    for key, default in [("linear_jacobian", 0), ("varpro", 0), ("fft_backend", "fftpack"), ("fourier_shift", 0), ("convolve_once", 0), ("psf_phases", 0), ("local_wcs", 0), ("lazy_grids", 0), ("packed_pulls", 0), ("sparse_jacobian", 0), ("color_jacobian", 0), ("schur_solver", 0), ("reuse_factorization", 0), ("lambda_ladder", 0), ("matrix_free", 0), ("stream_jacobian_MB", 0), ("broyden_updates", 0), ("broyden_tolerance", 0.5), ("parallel_simplex", 0), ("analytic_centroids", 0), ("component_cache", 0), ("gradient_1D_prefit", 0), ("parallel_centroid", 0), ("varpro_cache_MB", 1000)]:
+        try:
+            settings[key]
+        except:
+            settings[key] = default
+
     for key in ["sciext", "errext", "dqext", "errscale", "pixel_area_map", "bad_pixel_list", "RA0", "Dec0", "psfs"]:
         if type(settings[key]) != list:
             settings[key] = [settings[key]]*settings["n_img"]
@@ -120,6 +170,33 @@ def finish_settings(settings):
         if type(settings[key]) != list:
             settings[key] = [settings[key]]*settings["n_gal"]
 
+    if settings["varpro"]:
+        assert all(array(settings["gal_type"]) == "2D"), "varpro needs 2D galaxy models (1D models aren't linear)!"
+
+    assert not (settings["fourier_shift"] and settings["convolve_once"]), "Choose fourier_shift or convolve_once!"
+    if settings["convolve_once"] and len(unique(settings["psfs"])) > 1:
+        print("convolve_once needs one PSF for all images; falling back to convolving each image.")
+        settings["convolve_once"] = 0
+    if settings["convolve_once"]:
+        # convolve_once renders on image 0's grid, so every image would see the PSF at image 0's orientation and scale
+        maps = [local_sky_map(settings["images"][i], settings["sciext"][i], settings["RA0"][i], settings["Dec0"][i]) for i in range(settings["n_img"])]
+        if any([abs(dot(linalg.inv(maps[0]), sky_map) - identity(2)).max() > 1.e-3 for sky_map in maps[1:]]):
+            print("convolve_once needs all images at image 0's orientation on the sky; falling back to convolving each image.")
+            settings["convolve_once"] = 0
+
+    # The exact Jacobian columns (indiv_linear_jacobian) are for per-image convolution and resampling, not for
+    # phase-ramp shifts or convolve-once-then-resample
+    for key in ["linear_jacobian", "analytic_centroids", "varpro", "gradient_1D_prefit"]:
+        if (settings["fourier_shift"] or settings["convolve_once"]) and settings[key]:
+            print(key, "needs per-image convolution; turning it off, as fourier_shift or convolve_once is on.")
+            settings[key] = 0
+
+    # These render each image alone with indiv_model, not modelfn's fourier_shift / convolve_once dispatch
+    for key in ["matrix_free", "stream_jacobian_MB", "parallel_centroid"]:
+        if (settings["fourier_shift"] or settings["convolve_once"]) and settings[key]:
+            print(key, "renders images with indiv_model; turning it off, as fourier_shift or convolve_once is on.")
+            settings[key] = 0
+
 
     if len(settings["psfs"]) == 1:
         settings["psfs"] = [settings["psfs"][0] for i in range(settings["n_img"])]
@@ -155,6 +232,15 @@ def robust_index(dat, i1, i2, j1, j2, fill_value = 0):
                   j1 + (j2 - j1):j2 + (j2 - j1)]
 
 
+def local_sky_map(im, ext, RA0, Dec0):
+    """d(RA, Dec)/d(pixel x, y) of an image at (RA0, Dec0), from its WCS."""
+    w = wcs.WCS(fits.open(im)[ext].header)
+    pix_xy = w.all_world2pix([[RA0, Dec0]], 1)[0]
+    xs, ys = meshgrid(pix_xy[0] + arange(-1., 2.), pix_xy[1] + arange(-1., 2.), indexing = "ij")
+    RAs, Decs = w.all_pix2world(xs, ys, 1)
+    return local_linear_map(RAs, Decs)
+
+
 def read_image(im, pam, bad_pix_list, exts, settings, RA0, Dec0):
     """Reads patches from image files."""
 
@@ -227,12 +313,16 @@ def read_image(im, pam, bad_pix_list, exts, settings, RA0, Dec0):
     #                      z = reshape(pixel_sampled_js, settings["patch"]**2), kind = 'linear')
 
     
-    RADec_to_i = SmoothBivariateSpline(x = reshape(pixel_sampled_RAs, settings["patch"]**2),
-                                       y = reshape(pixel_sampled_Decs, settings["patch"]**2),
-                                       z = reshape(pixel_sampled_is, settings["patch"]**2), kx = 1, ky = 1)
-    RADec_to_j = SmoothBivariateSpline(x = reshape(pixel_sampled_RAs, settings["patch"]**2),
-                                       y = reshape(pixel_sampled_Decs, settings["patch"]**2),
-                                       z = reshape(pixel_sampled_js, settings["patch"]**2), kx = 1, ky = 1)
+    if settings["local_wcs"]:
+        # get_data fits the closed-form transform instead
+        RADec_to_i, RADec_to_j = None, None
+    else:
+        RADec_to_i = SmoothBivariateSpline(x = reshape(pixel_sampled_RAs, settings["patch"]**2),
+                                           y = reshape(pixel_sampled_Decs, settings["patch"]**2),
+                                           z = reshape(pixel_sampled_is, settings["patch"]**2), kx = 1, ky = 1)
+        RADec_to_j = SmoothBivariateSpline(x = reshape(pixel_sampled_RAs, settings["patch"]**2),
+                                           y = reshape(pixel_sampled_Decs, settings["patch"]**2),
+                                           z = reshape(pixel_sampled_js, settings["patch"]**2), kx = 1, ky = 1)
 
     tmp_bad_pix = zeros(f[exts[0]].data.shape, dtype=int32)
     for k in range(len(badx)):
@@ -281,6 +371,8 @@ def get_data(settings, all_data):
     all_data["pixel_sampled_RAs"] = []
     all_data["pixel_sampled_Decs"] = []
     all_data["pixelranges"] = []
+    all_data["subpix_to_sky"] = []
+    all_data["grid_to_sky"] = []
 
     for i in range(settings["n_img"]):
         print("Image ", i)
@@ -310,10 +402,25 @@ def get_data(settings, all_data):
 
         all_data["invvars"].append(invvars)
 
-        all_data["RAs"].append(RAs)
-        all_data["Decs"].append(Decs)
+        if settings["lazy_grids"]:
+            # Keep only the transform; sky_grid regenerates the grids
+            all_data["grid_to_sky"].append(fit_grid_to_sky(RAs, Decs, settings["RA0"][i], settings["Dec0"][i]))
+        else:
+            all_data["RAs"].append(RAs)
+            all_data["Decs"].append(Decs)
         all_data["scidata"].append(data[0])
 
+        # d(RA, Dec)/d(oversampled grid index) for turning dRA, dDec into a grid shift (fourier_shift)
+        all_data["subpix_to_sky"].append(local_linear_map(RAs, Decs))
+
+    # n_img x 2 x 6: pixel coordinates as quadratics in the offset (arcsec) from (RA0, Dec0)
+    all_data["sky_to_pix"] = array([fit_sky_to_pixel(all_data["pixel_sampled_RAs"][i], all_data["pixel_sampled_Decs"][i],
+                                                     settings["RA0"][i], settings["Dec0"][i]) for i in range(settings["n_img"])])
+
+    # Flattened indices of the pixels that enter the pulls (packed_pulls)
+    all_data["valid_pix"] = [where(ravel(invvars) > 0)[0] for invvars in all_data["invvars"]]
+    all_data["flag_invvars"] = [len(valid_pix) > 0 for valid_pix in all_data["valid_pix"]]
+
     all_data["mjd"] = array(all_data["mjd"])
 
     return all_data
@@ -324,7 +431,10 @@ def get_PSFs(settings):
     all_data = dict(scidata = [], invvars = [], RAs = [], Decs = [])
 
     all_data["psf_FFTs"] = {}
+    all_data["psf_rFFTs"] = {}
     all_data["psf_subpixelized"] = {}
+    all_data["psf_subpixelized_filtered"] = {}
+    all_data["psf_tables"] = {}
 
     for psf in unique(settings["psfs"]):
         f = fits.open(psf)
@@ -336,7 +446,7 @@ def get_PSFs(settings):
         print("psf shape ", psfdata.shape)
         model_shape = settings["patch"]*settings["oversample"]
         print("model shape ", model_shape)
-        padsize = int(2**ceil(log2(max(max(psfdata.shape), model_shape))))
+        padsize = fft_padsize(psfdata.shape, model_shape, settings["fft_backend"])
         print("padsize ", padsize)
         settings["padsize"] = padsize
 
@@ -379,6 +489,7 @@ def get_PSFs(settings):
         assert psf_test[0,0] == psf_test.max()
         
         all_data["psf_FFTs"][psf] = psfdata_fft
+        all_data["psf_rFFTs"][psf] = half_spectrum(psfdata_fft)
 
         maxinds = where(psfdata_odd == psfdata_odd.max())
         print("maxinds ", maxinds)
@@ -388,6 +499,10 @@ def get_PSFs(settings):
         psfdata = array(real(ft.ifft2(ft.fft2(psfdata_odd) * ft.fft2(recenter))), dtype=float64)
         
         all_data["psf_subpixelized"][psf] = psfdata
+        # Same prefilter map_coordinates(prefilter = True) would apply on every call
+        all_data["psf_subpixelized_filtered"][psf] = spline_filter(psfdata, order = 2, mode = "constant")
+        if settings["psf_phases"]:
+            all_data["psf_tables"][psf] = psf_phase_table(psfdata, settings["oversample"], settings["psf_phases"])
         
         save_img(all_data["psf_subpixelized"][psf], "psf_subpixelized.fits")
 
@@ -498,14 +613,45 @@ def unparseP(parsed, settings):
 #def indiv_model(args):
 #    [RAs, Decs, settings, parsed] = args
 
+def pt_pixel_coords(parsed, im_ind):
+    """Pixel coordinates (icoords, jcoords) of the SN in images im_ind."""
+    im_ind = array(im_ind)
+
+    if settings["local_wcs"]:
+        return sky_to_pixel(all_data["sky_to_pix"][im_ind], settings["RA0"][im_ind], settings["Dec0"][im_ind],
+                            parsed["pt_RA"][im_ind], parsed["pt_Dec"][im_ind])
+
+    return (array([all_data["RADec_to_i"][i](parsed["pt_RA"][i], parsed["pt_Dec"][i])[0,0] for i in im_ind]),
+            array([all_data["RADec_to_j"][i](parsed["pt_RA"][i], parsed["pt_Dec"][i])[0,0] for i in im_ind]))
+
+
+def pt_pixel_derivs(parsed, i):
+    """d[icoord, jcoord]/d[pt_RA, pt_Dec] (2 x 2) for image i."""
+
+    if settings["local_wcs"]:
+        return sky_to_pixel_derivs(all_data["sky_to_pix"][[i]], settings["RA0"][[i]], settings["Dec0"][[i]],
+                                   parsed["pt_RA"][[i]], parsed["pt_Dec"][[i]])[0]
+
+    # The (linear) spline can't return its own first derivatives, so difference the coordinates
+    RA, Dec = parsed["pt_RA"][i], parsed["pt_Dec"][i]
+    step = 1.e-7
+    derivs = zeros([2, 2], dtype=float64)
+    for k, spline in enumerate([all_data["RADec_to_i"][i], all_data["RADec_to_j"][i]]):
+        derivs[k, 0] = (spline(RA + step, Dec)[0,0] - spline(RA - step, Dec)[0,0])/(2.*step)
+        derivs[k, 1] = (spline(RA, Dec + step)[0,0] - spline(RA, Dec - step)[0,0])/(2.*step)
+    return derivs
+
+
 def make_pixelized_PSF(parsed, i):
     
-    icoord = all_data["RADec_to_i"][i](parsed["pt_RA"][i], parsed["pt_Dec"][i])[0,0]
-    jcoord = all_data["RADec_to_j"][i](parsed["pt_RA"][i], parsed["pt_Dec"][i])[0,0]
+    icoords, jcoords = pt_pixel_coords(parsed, [i])
+    icoord, jcoord = icoords[0], jcoords[0]
     
 
     #print "i, icoord, jcoord", i, icoord, jcoord
 
+    if settings["psf_phases"]:
+        return all_data["psf_tables"][settings["psfs"][i]](icoord, jcoord, settings["patch"])
 
     j2d, i2d = meshgrid(arange(settings["patch"], dtype=float64)*settings["oversample"],
                         arange(settings["patch"], dtype=float64)*settings["oversample"])
@@ -520,56 +666,48 @@ def make_pixelized_PSF(parsed, i):
     j1d = reshape(j2d, settings["patch"]**2)
     coords = array([i1d, j1d])
     
-    pixelized_psf = map_coordinates(all_data["psf_subpixelized"][settings["psfs"][i]], coordinates = coords, order = 2, mode="constant", cval = 0, prefilter = True)
+    pixelized_psf = map_coordinates(all_data["psf_subpixelized_filtered"][settings["psfs"][i]], coordinates = coords, order = 2, mode="constant", cval = 0, prefilter = False)
     pixelized_psf = reshape(pixelized_psf, [settings["patch"], settings["patch"]])
 
     return pixelized_psf
-    
 
-def oneD_spline(amplarray, spacingarray, rarray):
 
-    #amplarr[1:] = amplarr[1:]*amplarr[0] # everything is relative to 0th element
-    # amplarr =     [2., 1., 0.5, 0.4, 0.3, 0.2, 0.1, 0.05, 0.0] # should end with about 0
-    # spacingrarray = [0., 1., 2.,  3.,  5.,  8.,  15., 20.,  50.] # should start with 0.
-    # len = 9
-    amplarr = amplarray*1. #ampl_fit_to_physical(amplarray)
-    
-    nseg = len(amplarr) - 1
-
-    # fit from the outside in
-
-    deriv = 0. # flat at infinity
-
-    sarray = 0.*rarray # start at 0.
+def pixelized_PSF_derivs(parsed, i):
+    """d(pixelized PSF)/d(pt_RA[i]), d(pixelized PSF)/d(pt_Dec[i]). Analytic with psf_phases (the table) or
+    analytic_centroids (the order-2 spline), otherwise differenced."""
 
-    # 7, 6, 5, 4, 3, 2, 1, 0
-
-    rarray2 = rarray**2.
-    
-    for i in range(nseg)[::-1]:
-        # A r^2 + B r + C
-        
-        d2 = deriv
-
-        x1 = spacingarray[i]
-        x2 = spacingarray[i + 1] # larger
-
-        y1 = amplarr[i]
-        y2 = amplarr[i + 1]
-
-        A = (d2*(-x1 + x2) + y1 - y2)/(x1 - x2)**2.
-        B = (d2*(x1**2. - x2**2.) + 2.*x2*(-y1 + y2))/(x1 - x2)**2.
-        C = (d2*x1*x2*(-x1 + x2) + x2**2.*y1 + x1**2.*y2 - 2.*x1*x2*y2)/(x1 - x2)**2.
-
-        sarray += (A*rarray2 + B*(rarray) + C)*(rarray >= x1)*(rarray < x2)
-
-
-        deriv = (-(d2*x1) + d2*x2 + 2.*y1 - 2.*y2)/(x1 - x2)
+    if settings["psf_phases"] or settings["analytic_centroids"]:
+        icoords, jcoords = pt_pixel_coords(parsed, [i])
+        if settings["psf_phases"]:
+            dpsf_di, dpsf_dj = all_data["psf_tables"][settings["psfs"][i]].derivs(icoords[0], jcoords[0], settings["patch"])
+        else:
+            # Same sampling points as make_pixelized_PSF, which move by -oversample per pixel of icoord, jcoord
+            j2d, i2d = meshgrid(arange(settings["patch"], dtype=float64)*settings["oversample"],
+                                arange(settings["patch"], dtype=float64)*settings["oversample"])
+            psfsize = len(all_data["psf_subpixelized"][settings["psfs"][i]])
+            i2d -= icoords[0]*settings["oversample"] - floor(psfsize/2.)
+            j2d -= jcoords[0]*settings["oversample"] - floor(psfsize/2.)
+
+            dpsf_di, dpsf_dj = spline_gradient(all_data["psf_subpixelized_filtered"][settings["psfs"][i]], i2d, j2d)
+            dpsf_di *= -settings["oversample"]
+            dpsf_dj *= -settings["oversample"]
+        dij_dsky = pt_pixel_derivs(parsed, i)
+
+        return [dpsf_di*dij_dsky[0, 0] + dpsf_dj*dij_dsky[1, 0], dpsf_di*dij_dsky[0, 1] + dpsf_dj*dij_dsky[1, 1]]
+
+    step = 1.e-7
+    derivs = []
+    for pt_name in ["pt_RA", "pt_Dec"]:
+        pixelized_psfs = []
+        for sign in [1., -1.]:
+            dparsed = dict(parsed)
+            dparsed[pt_name] = array(parsed[pt_name], dtype=float64)
+            dparsed[pt_name][i] += sign*step
+            pixelized_psfs.append(make_pixelized_PSF(dparsed, i))
+        derivs.append((pixelized_psfs[0] - pixelized_psfs[1])/(2.*step))
+    return derivs
     
 
-    sarray += amplarr[-1]*(rarray >= spacingarray[-1]) # constant after last space
-
-    return sarray
 """
 import matplotlib.pyplot as plt
 spacingarray = exp(linspace(-1., 1., 10))
@@ -583,8 +721,46 @@ plt.close()
 """
 
 
+sky_grid_cache = OrderedDict()
+
+def sky_grid(i):
+    """Oversampled (RAs, Decs) grids of image i. With lazy_grids, regenerated from all_data["grid_to_sky"] and
+    kept in an LRU of lazy_grids images (one per worker)."""
+
+    if not settings["lazy_grids"]:
+        return all_data["RAs"][i], all_data["Decs"][i]
+
+    if i in sky_grid_cache:
+        sky_grid_cache.move_to_end(i)
+    else:
+        sky_grid_cache[i] = grid_to_sky(all_data["grid_to_sky"][i], settings["RA0"][i], settings["Dec0"][i], [settings["padsize"]]*2)
+        if len(sky_grid_cache) > settings["lazy_grids"]:
+            sky_grid_cache.popitem(last = False)
+    return sky_grid_cache[i]
+
+
+def sky_offsets(i, parsed):
+    """Offsets (dRA*cos(Dec), dDec; degrees) of image i's oversampled grid from the galaxy center."""
+    RAs, Decs = sky_grid(i)
+    dx = (RAs - (settings["RA0"][i] + parsed["dRA"][i]))*cos(settings["Dec0"][i]/(180./pi))
+    dy = Decs - (settings["Dec0"][i] + parsed["dDec"][i])
+    return dx, dy
+
+
+def spline_coords(i, parsed, gal_ind):
+    """Spline-grid coordinates of image i's oversampled grid for a 2D galaxy."""
+
+    # map_coordinates numbers starting from 0. E.g., radius = 3 => 0, 1, 2, (3), 4, 5, 6
+    dx, dy = sky_offsets(i, parsed)
+    xs = dx/settings["splinepixelscale"][gal_ind] + settings["splineradius"][gal_ind]
+    ys = dy/settings["splinepixelscale"][gal_ind] + settings["splineradius"][gal_ind]
+    return xs, ys
+
+
 def indiv_model(args):
-    [i, parsed, just_pt_flux] = args
+    """Model of image i. With a fourth element return_derivs = 1 in args, returns (model, indiv_position_derivs)."""
+    [i, parsed, just_pt_flux] = args[:3]
+    return_derivs = args[3] if len(args) > 3 else 0
 
     if just_pt_flux:
         pixelized_psf = make_pixelized_PSF(parsed, i)
@@ -592,66 +768,160 @@ def indiv_model(args):
             convolved_model = (pixelized_psf/all_data["pixel_area_map"][i])*(parsed["SN_ampl"][settings["epochs"][i] - 1])
         else:
             convolved_model = pixelized_psf*0.
-        return convolved_model
+    else:
+        convolved_model = indiv_convolve(i, indiv_subsampled_model((i, parsed)))
+        convolved_model = indiv_finish_model((i, parsed, convolved_model))
+
+    if return_derivs:
+        return convolved_model, indiv_position_derivs(i, parsed, just_pt_flux)
+    return convolved_model
+
+
+def galaxy_shape_derivs(parsed, gal_ind, dx, dy):
+    """d(galaxy_model)/d(coeffs[0], coeffs[1]) of a 1D galaxy (axis ratio, orientation), through the elliptical radius."""
+
+    q = parsed["coeffs"][gal_ind][0]
+    newxs, newys, rarray = elliptical_radius(parsed, gal_ind, dx, dy)
+
+    dS_dr = oneD_spline_deriv(amplarray = parsed["coeffs"][gal_ind][2:], spacingarray = settings["spacingarray"], rarray = rarray)
+    dS_dr /= where(rarray > 0, rarray, inf)
+
+    # r dr/dq = -newxs^2/q; d(newxs)/dth = -newys/q, d(newys)/dth = q newxs
+    return -dS_dr*newxs**2./q, dS_dr*newxs*newys*(q - 1./q)
 
 
+def indiv_convolve(i, subsampled_model):
+    """Convolves an oversampled (padsize x padsize) model with image i's PSF and samples it at the pixel centers."""
+    subsampled_convolved_model = ft.ifft2(ft.fft2(subsampled_model) * all_data["psf_FFTs"][settings["psfs"][i]])
+    subsampled_convolved_model = array(real(subsampled_convolved_model), dtype=float64)
+
+    #save_img(subsampled_convolved_model, "subsampled_convolved_model.fits")
+
+    convolved_model = subsampled_convolved_model[settings["oversample2"]::settings["oversample"], settings["oversample2"]::settings["oversample"]]
+    return convolved_model[:settings["patch"], :settings["patch"]]# + parsed["sky"][i]
+
+
+def indiv_convolve_adjoint(i, pixels):
+    """Adjoint of indiv_convolve: puts pixels back on the oversampled grid and correlates with image i's PSF."""
+    upsampled = zeros([settings["padsize"]]*2, dtype=float64)
+    upsampled[settings["oversample2"]::settings["oversample"], settings["oversample2"]::settings["oversample"]][:settings["patch"], :settings["patch"]] = pixels
+    return array(real(ft.ifft2(ft.fft2(upsampled) * conj(all_data["psf_FFTs"][settings["psfs"][i]]))), dtype=float64)
+
+
+def indiv_position_derivs(i, parsed, just_pt_flux = 0):
+    """Analytic d(indiv_model)/d(dRA[i], dDec[i], sndRA_offset, sndDec_offset): the galaxy through the derivatives of
+    its spline (or 1D profile), convolved like the model, the SN through pixelized_PSF_derivs, then the sky
+    re-estimate of indiv_finish_model. parsed needs filtered_coeffs (prefilter_coeffs)."""
+
+    derivs = [zeros([settings["patch"]]*2, dtype=float64) for k in range(4)]
+
+    if not just_pt_flux:
+        dx, dy = sky_offsets(i, parsed)
+        dmodel_ddx, dmodel_ddy = galaxy_model_derivs(parsed, dx, dy)
+
+        # dx = (RAs - (RA0 + dRA))*cos(Dec0), dy = Decs - (Dec0 + dDec)
+        derivs[0] += indiv_convolve(i, -dmodel_ddx*cos(settings["Dec0"][i]/(180./pi)))
+        derivs[1] += indiv_convolve(i, -dmodel_ddy)
+
+    if settings["epochs"][i] > 0:
+        # pt_RA = RA0 + dRA + sndRA_offset, likewise for Dec
+        psf_derivs = pixelized_PSF_derivs(parsed, i)
+        SN_scale = parsed["SN_ampl"][settings["epochs"][i] - 1]/all_data["pixel_area_map"][i]
+        for k in range(4):
+            derivs[k] += psf_derivs[k % 2]*SN_scale
+
+    if not just_pt_flux and any(all_data["invvars"][i] != 0):
+        derivs = [deriv - sum(deriv*all_data["invvars"][i])/sum(all_data["invvars"][i]) for deriv in derivs]
+    return derivs
+
+
+def indiv_subsampled_model(args):
+    """The galaxy model for image i on the oversampled (padsize x padsize) grid, before convolution."""
+    [i, parsed] = args
+
+    dx, dy = sky_offsets(i, parsed)
+    return galaxy_model(parsed, dx, dy)
+
+
+def elliptical_radius(parsed, gal_ind, dx, dy):
+    """Rotated, axis-ratio-scaled coordinates and radius (in spline pixels) of a 1D galaxy: coeffs[0] is the axis
+    ratio, coeffs[1] the orientation."""
+    xs = dx/settings["splinepixelscale"][gal_ind]
+    ys = dy/settings["splinepixelscale"][gal_ind]
+
+    th = parsed["coeffs"][gal_ind][1]
+
+    newxs = (xs*cos(th) - ys*sin(th))/parsed["coeffs"][gal_ind][0]
+    newys = xs*sin(th) + ys*cos(th)
+    return newxs, newys, sqrt(newxs**2. + newys**2.)
+
+
+def galaxy_model(parsed, dx, dy):
+    """The (unconvolved) galaxy model at offsets dx = dRA*cos(Dec), dy = dDec (degrees) from the galaxy center."""
+
     subsampled_model = 0.
 
     for gal_ind in range(settings["n_gal"]):
         if settings["gal_type"][gal_ind] == "2D":
 
             # map_coordinates numbers starting from 0. E.g., radius = 3 => 0, 1, 2, (3), 4, 5, 6
-            xs = (all_data["RAs"][i] - (settings["RA0"][i] + parsed["dRA"][i]))*cos(settings["Dec0"][i]/(180./pi))/settings["splinepixelscale"][gal_ind] + settings["splineradius"][gal_ind]
-            ys = (all_data["Decs"][i] - (settings["Dec0"][i] + parsed["dDec"][i]))/settings["splinepixelscale"][gal_ind] + settings["splineradius"][gal_ind]
-
-            #xs = (RAs - settings["RA0"])*cos(settings["Dec0"]/(180./pi))/settings["splinepixelscale"] + settings["splineradius"]
-            #ys = (Decs - settings["Dec0"])/settings["splinepixelscale"] + settings["splineradius"]
-
+            xs = dx/settings["splinepixelscale"][gal_ind] + settings["splineradius"][gal_ind]
+            ys = dy/settings["splinepixelscale"][gal_ind] + settings["splineradius"][gal_ind]
 
             #save_img(xs, "RA_frame.fits")
             #save_img(ys, "Dec_frame.fits")
 
-            xs1D = reshape(xs, settings["padsize"]**2)
-            ys1D = reshape(ys, settings["padsize"]**2)
-
-            coords = array([xs1D, ys1D])
-            #print coords.shape
+            coords = array([ravel(xs), ravel(ys)])
 
-            #print parsed["coeffs"].shape
-            this_subsampled_model = map_coordinates(parsed["coeffs"][gal_ind], coordinates = coords, order = 2, mode="constant", cval = 0, prefilter = True)
+            this_subsampled_model = map_coordinates(parsed["filtered_coeffs"][gal_ind], coordinates = coords, order = 2, mode="constant", cval = 0, prefilter = False)
 
-            this_subsampled_model = reshape(this_subsampled_model, [settings["padsize"], settings["padsize"]])
+            this_subsampled_model = reshape(this_subsampled_model, dx.shape)
         elif settings["gal_type"][gal_ind] == "1D":
-            xs = (all_data["RAs"][i] - (settings["RA0"][i] + parsed["dRA"][i]))*cos(settings["Dec0"][i]/(180./pi))
-            ys = all_data["Decs"][i] - (settings["Dec0"][i] + parsed["dDec"][i])
-
-            xs /= (settings["splinepixelscale"][gal_ind])#*parsed["coeffs"][gal_ind][0]) # want 0th parameter > 1
-            ys /= settings["splinepixelscale"][gal_ind]
-            
-            th = parsed["coeffs"][gal_ind][1]
-            
-            newxs = (xs*cos(th) - ys*sin(th))/parsed["coeffs"][gal_ind][0]
-            newys = xs*sin(th) + ys*cos(th)
-
-            rarray = sqrt(newxs**2. + newys**2.)
+            newxs, newys, rarray = elliptical_radius(parsed, gal_ind, dx, dy)
 
             this_subsampled_model = oneD_spline(amplarray = parsed["coeffs"][gal_ind][2:], # 0th parameter controls ellipticity, 1st parameter is orientation
                                                 spacingarray = settings["spacingarray"], rarray = rarray)
         
         subsampled_model += this_subsampled_model
 
+    return subsampled_model
 
 
-    #save_img(subsampled_model, "subsampled_model.fits")
-    subsampled_convolved_model = ft.ifft2(ft.fft2(subsampled_model) * all_data["psf_FFTs"][settings["psfs"][i]])
-    subsampled_convolved_model = array(real(subsampled_convolved_model), dtype=float64)
+def galaxy_model_derivs(parsed, dx, dy):
+    """d(galaxy_model)/d(dx), d(galaxy_model)/d(dy): order-2 spline gradients for 2D galaxies, the chain rule
+    through the elliptical radius for 1D ones."""
 
-    #save_img(subsampled_convolved_model, "subsampled_convolved_model.fits")
+    dmodel_ddx = 0.
+    dmodel_ddy = 0.
 
-    convolved_model = subsampled_convolved_model[settings["oversample2"]::settings["oversample"], settings["oversample2"]::settings["oversample"]]
-    convolved_model = convolved_model[:settings["patch"], :settings["patch"]]# + parsed["sky"][i]
+    for gal_ind in range(settings["n_gal"]):
+        if settings["gal_type"][gal_ind] == "2D":
+            xs = dx/settings["splinepixelscale"][gal_ind] + settings["splineradius"][gal_ind]
+            ys = dy/settings["splinepixelscale"][gal_ind] + settings["splineradius"][gal_ind]
+
+            d_dxs, d_dys = spline_gradient(parsed["filtered_coeffs"][gal_ind], xs, ys)
+        elif settings["gal_type"][gal_ind] == "1D":
+            th = parsed["coeffs"][gal_ind][1]
+            q = parsed["coeffs"][gal_ind][0]
+
+            newxs, newys, rarray = elliptical_radius(parsed, gal_ind, dx, dy)
+
+            dS_dr = oneD_spline_deriv(amplarray = parsed["coeffs"][gal_ind][2:], spacingarray = settings["spacingarray"], rarray = rarray)
+            dS_dr /= where(rarray > 0, rarray, inf)
+
+            d_dxs = dS_dr*(newxs*cos(th)/q + newys*sin(th))
+            d_dys = dS_dr*(-newxs*sin(th)/q + newys*cos(th))
+
+        dmodel_ddx += d_dxs/settings["splinepixelscale"][gal_ind]
+        dmodel_ddy += d_dys/settings["splinepixelscale"][gal_ind]
+
+    return dmodel_ddx, dmodel_ddy
 
 
+def indiv_finish_model(args):
+    """Adds the SN and the sky to the convolved, pixel-sampled galaxy model for image i."""
+    [i, parsed, convolved_model] = args
+
     #print "psf ", i, settings["epochs"][i], parsed["SN_ampl"], (parsed["SN_ampl"][settings["epochs"][i] - 1])
     
     if settings["epochs"][i] > 0:
@@ -669,6 +939,152 @@ def indiv_model(args):
  
     return convolved_model
 
+fourier_cache = dict(key = None, spectra = {})
+
+def indiv_zero_offset_spectrum(args):
+    """rfft2 of image i's galaxy model translated by origin grid steps (from dRA = dDec = 0), times the PSF
+    half-spectrum (fourier_shift)."""
+    [i, parsed, origin] = args
+
+    parsed = dict(parsed)
+    parsed["dRA"] = zeros(settings["n_img"], dtype=float64)
+    parsed["dDec"] = zeros(settings["n_img"], dtype=float64)
+    parsed["dRA"][i], parsed["dDec"][i] = dot(all_data["subpix_to_sky"][i], origin)
+
+    return sp_fft.rfft2(indiv_subsampled_model((i, parsed))) * all_data["psf_rFFTs"][settings["psfs"][i]]
+
+
+def fourier_shift_spectra(parsed, im_ind):
+    """(origin, spectrum) for im_ind, recomputed only when the galaxy coefficients change or a shift leaves its margin.
+    The phase ramp wraps around the padded box, so each spectrum is rendered with the galaxy translated by origin =
+    margin + (the shift rounded to grid steps): then the patch only ever reads the model from within the box."""
+
+    key = b"".join([array(coeffs).tobytes() for coeffs in parsed["coeffs"]])
+    if key != fourier_cache["key"]:
+        fourier_cache["key"] = key
+        fourier_cache["spectra"].clear()
+
+    margin = (settings["padsize"] - settings["patch"]*settings["oversample"])//2
+
+    todo = []
+    for i in im_ind:
+        shift = fourier_shift(parsed, i)
+        if i not in fourier_cache["spectra"] or any(abs(shift - fourier_cache["spectra"][i][0] + margin) > margin):
+            todo.append((i, around(shift) + margin))
+
+    if len(todo) > 0 and "filtered_coeffs" not in parsed:
+        parsed = prefilter_coeffs(parsed)
+    for (i, origin), spectrum in zip(todo, pool.map(indiv_zero_offset_spectrum, [(i, parsed, origin) for i, origin in todo])):
+        fourier_cache["spectra"][i] = (origin, spectrum)
+
+    return [fourier_cache["spectra"][i] for i in im_ind]
+
+
+def fourier_shift(parsed, i):
+    """Grid shift of image i's galaxy for its dRA, dDec (the shift theorem only needs the local linear WCS)."""
+    return linalg.solve(all_data["subpix_to_sky"][i], [parsed["dRA"][i], parsed["dDec"][i]])
+
+
+def pixel_sample(subsampled_convolved_model):
+    return subsampled_convolved_model[settings["oversample2"]::settings["oversample"], settings["oversample2"]::settings["oversample"]][:settings["patch"], :settings["patch"]]
+
+
+def fourier_shift_models(parsed, im_ind, chunk = 32):
+    """Convolved, pixel-sampled galaxy models: the spectra translated the rest of the way to dRA, dDec with a phase ramp."""
+
+    spectra = fourier_shift_spectra(parsed, im_ind)
+    shape = [settings["padsize"]]*2
+
+    models = []
+    for start in range(0, len(im_ind), chunk):
+        shifted = [spectra[k][1]*shift_phase_ramp(shape, fourier_shift(parsed, im_ind[k]) - spectra[k][0]) for k in range(start, min(start + chunk, len(im_ind)))]
+        models.extend([pixel_sample(model) for model in sp_fft.irfft2(array(shifted), s = shape, workers = settings["n_cpu"])])
+    return models
+
+
+convolve_once_cache = dict(key = None, filtered_model = None)
+
+def reference_grid_offsets():
+    """Offsets (dRA*cos(Dec), dDec; degrees) from the galaxy center of the grid convolve_once renders on: image 0's
+    (linearized) oversampled grid, centered on the galaxy, so the PSF applies to it unchanged."""
+
+    center = settings["padsize"]//2
+    ind0, ind1 = meshgrid(arange(settings["padsize"], dtype=float64) - center, arange(settings["padsize"], dtype=float64) - center, indexing = "ij")
+    M = all_data["subpix_to_sky"][0]
+
+    dx = (M[0, 0]*ind0 + M[0, 1]*ind1)*cos(settings["Dec0"][0]/(180./pi))
+    dy = M[1, 0]*ind0 + M[1, 1]*ind1
+    return dx, dy
+
+
+def convolve_once_models(parsed, im_ind):
+    """Convolved, pixel-sampled galaxy models from one convolution on the reference grid, interpolated at each image's
+    pixel centers through its WCS. The PSF is applied at image 0's orientation, so finish_settings only leaves
+    convolve_once on when the images share it."""
+
+    key = b"".join([array(coeffs).tobytes() for coeffs in parsed["coeffs"]])
+    if key != convolve_once_cache["key"]:
+        if "filtered_coeffs" not in parsed:
+            parsed = prefilter_coeffs(parsed)
+        dx, dy = reference_grid_offsets()
+        convolved = sp_fft.irfft2(sp_fft.rfft2(galaxy_model(parsed, dx, dy)) * all_data["psf_rFFTs"][settings["psfs"][0]], s = dx.shape)
+
+        convolve_once_cache["key"] = key
+        convolve_once_cache["filtered_model"] = spline_filter(convolved, order = 3, mode = "mirror")
+
+    Minv = linalg.inv(all_data["subpix_to_sky"][0])
+    coords = []
+    for i in im_ind:
+        RAs, Decs = sky_grid(i)
+        offsets = array([ravel(pixel_sample(RAs)) - (settings["RA0"][i] + parsed["dRA"][i]),
+                         ravel(pixel_sample(Decs)) - (settings["Dec0"][i] + parsed["dDec"][i])])
+        coords.append(dot(Minv, offsets) + settings["padsize"]//2)
+
+    sampled = map_coordinates(convolve_once_cache["filtered_model"], coordinates = concatenate(coords, axis = 1), order = 3, mode = "mirror", prefilter = False)
+    return list(reshape(sampled, [len(im_ind), settings["patch"], settings["patch"]]))
+
+
+def prefilter_coeffs(parsed):
+    """Spline-filters the 2D coefficient grids once, so the workers can sample them with prefilter = False."""
+    parsed = dict(parsed)
+    parsed["filtered_coeffs"] = []
+    for gal_ind in range(settings["n_gal"]):
+        if settings["gal_type"][gal_ind] == "2D":
+            parsed["filtered_coeffs"].append(spline_filter(parsed["coeffs"][gal_ind], order = 2, mode = "constant"))
+        else:
+            parsed["filtered_coeffs"].append(None)
+    return parsed
+
+def indiv_convolved_galaxy(args):
+    """Image i's galaxy model, convolved and pixel-sampled (no SN, no sky)."""
+    [i, parsed] = args
+    return indiv_convolve(i, indiv_subsampled_model((i, parsed)))
+
+
+component_cache = OrderedDict()
+
+def cached_galaxy_models(parsed, im_ind):
+    """Convolved galaxy models for im_ind, from an LRU of the last component_cache ones. The cache lives in this
+    process, so a hit doesn't depend on which worker gets the image; only the misses are rendered in the pool.
+    A convolved galaxy only depends on the coeffs and dRA[i], dDec[i]."""
+    digest = hashlib.sha1(b"".join([array(coeffs, dtype=float64).tobytes() for coeffs in parsed["coeffs"]])).hexdigest()
+    keys = [(i, digest, parsed["dRA"][i], parsed["dDec"][i]) for i in im_ind]
+
+    missing = [k for k in range(len(keys)) if keys[k] not in component_cache]
+    rendered = pool.map(indiv_convolved_galaxy, [(im_ind[k], parsed) for k in missing])
+    for k, convolved_model in zip(missing, rendered):
+        component_cache[keys[k]] = convolved_model
+
+    convolved_models = []
+    for key in keys:
+        component_cache.move_to_end(key)
+        convolved_models.append(component_cache[key])
+
+    while len(component_cache) > settings["component_cache"]:
+        component_cache.popitem(last = False)
+    return convolved_models
+
+
 def modelfn(parsed, im_ind = None, just_pt_flux = 0):#, all_data, settings):
     """Construct the model."""
 
@@ -680,7 +1096,25 @@ def modelfn(parsed, im_ind = None, just_pt_flux = 0):#, all_data, settings):
     if im_ind == None:
         im_ind = list(range(settings["n_img"]))
 
-    models = pool.map(indiv_model, [(i, parsed, just_pt_flux) for i in im_ind])
+    parsed = prefilter_coeffs(parsed)
+
+    if settings["fourier_shift"] and not just_pt_flux:
+        convolved_models = fourier_shift_models(parsed, im_ind)
+        models = pool.map(indiv_finish_model, [(i, parsed, convolved_models[k]) for k, i in enumerate(im_ind)])
+    elif settings["convolve_once"] and not just_pt_flux:
+        convolved_models = convolve_once_models(parsed, im_ind)
+        models = pool.map(indiv_finish_model, [(i, parsed, convolved_models[k]) for k, i in enumerate(im_ind)])
+    elif settings["fft_backend"] == "rfft" and not just_pt_flux:
+        subsampled_models = pool.map(indiv_subsampled_model, [(i, parsed) for i in im_ind])
+        convolved_models = batch_convolve(subsampled_models, [settings["psfs"][i] for i in im_ind], all_data["psf_rFFTs"], workers = settings["n_cpu"])
+        convolved_models = [pixel_sample(convolved_model) for convolved_model in convolved_models]
+
+        models = pool.map(indiv_finish_model, [(i, parsed, convolved_models[k]) for k, i in enumerate(im_ind)])
+    elif settings["component_cache"] and not just_pt_flux:
+        convolved_models = cached_galaxy_models(parsed, im_ind)
+        models = pool.map(indiv_finish_model, [(i, parsed, convolved_models[k]) for k, i in enumerate(im_ind)])
+    else:
+        models = pool.map(indiv_model, [(i, parsed, just_pt_flux) for i in im_ind])
 
     return array(models)
 
@@ -691,9 +1125,38 @@ def default_im_ind(im_ind):
         im_ind = [im_ind]
     return im_ind
 
-def pull_FN(parsed, im_ind = None):
-    im_ind = default_im_ind(im_ind)
-    
+def valid_pixels(i):
+    """Flattened indices of image i's pixels in the pulls: all of them, or with packed_pulls, those with invvar > 0."""
+    if settings["packed_pulls"]:
+        return all_data["valid_pix"][i]
+    return arange(settings["patch"]**2)
+
+
+def n_pixel_pulls(im_ind):
+    return sum([len(valid_pixels(i)) for i in im_ind])
+
+
+def packed_pixel_pulls(parsed, im_ind):
+    """Pixel pulls for only the valid pixels, concatenated image by image. Images with no valid pixels are skipped."""
+    im_ind = [i for i in im_ind if all_data["flag_invvars"][i]]
+    if len(im_ind) == 0:
+        return zeros(0, dtype=float64)
+
+    models = modelfn(parsed, im_ind = im_ind)
+
+    pulls = []
+    for k, i in enumerate(im_ind):
+        valid = all_data["valid_pix"][i]
+        pulls.append((ravel(all_data["scidata"][i])[valid] - ravel(models[k])[valid])*sqrt(ravel(all_data["invvars"][i])[valid]))
+    return concatenate(pulls)
+
+
+def pixel_pulls(parsed, im_ind):
+    """The pixel part of the pulls, image by image (see valid_pixels)."""
+
+    if settings["packed_pulls"]:
+        return packed_pixel_pulls(parsed, im_ind)
+
     models = modelfn(parsed, im_ind = im_ind)
 
     pulls = []
@@ -702,14 +1165,18 @@ def pull_FN(parsed, im_ind = None):
         #assert 1 - any(isnan(pulls[-1])), str(pulls[-1]) + " " + str(len(pulls)) + " " + str(list(all_data["scidata"][im])) + " " + str(list(all_data["invvars"][im]))
 
     pulls = array(pulls)
-    pulls = reshape(pulls, settings["patch"]**2 * len(im_ind))
-    
+    return reshape(pulls, settings["patch"]**2 * len(im_ind))
+
+
+def prior_pulls(parsed):
+    """The non-pixel part of the pulls: SN centroid priors (always all images), then 1D-galaxy positivity."""
+
     #print parsed["pt_RA"].shape, settings["RA0"]
     #fff
     dRA_arcsec = (parsed["pt_RA"] - settings["RA0"])*cos(settings["Dec0"]/57.2957795)*3600.
     dDec_arcsec = (parsed["pt_Dec"] - settings["Dec0"])*3600.
 
-    pulls = concatenate((pulls, dRA_arcsec/settings["SN_centroid_prior_arcsec"], dDec_arcsec/settings["SN_centroid_prior_arcsec"]))
+    pulls = concatenate((dRA_arcsec/settings["SN_centroid_prior_arcsec"], dDec_arcsec/settings["SN_centroid_prior_arcsec"]))
 
     for gal_ind in range(settings["n_gal"]):
         if settings["gal_type"][gal_ind] == "1D":
@@ -719,6 +1186,11 @@ def pull_FN(parsed, im_ind = None):
     return pulls
 
 
+def pull_FN(parsed, im_ind = None):
+    im_ind = default_im_ind(im_ind)
+    return concatenate((pixel_pulls(parsed, im_ind), prior_pulls(parsed)))
+
+
 def pull_FN_wrapper(P, im_ind_wrap, makechi2 = 0):
     """For L-M"""
     im_ind = im_ind_wrap[0]
@@ -732,9 +1204,632 @@ def pull_FN_wrapper(P, im_ind_wrap, makechi2 = 0):
     else:
         return pulls #dot(pulls, pulls)
     
+def pull_FN_batch(P_list, im_ind_wrap):
+    """pull_FN_wrapper for several parameter vectors (miniLM's lambda_ladder trials). With the default rendering,
+    every (P, image) pair goes to the pool in one map, so the trials run concurrently."""
+    im_ind = im_ind_wrap[0]
+    parsed_list = [parseP(P, settings) for P in P_list]
+
+    if settings["fourier_shift"] or settings["convolve_once"] or settings["fft_backend"] == "rfft":
+        return [pull_FN(parsed, im_ind) for parsed in parsed_list]
+
+    if settings["packed_pulls"]:
+        im_ind = [i for i in im_ind if all_data["flag_invvars"][i]]
+
+    filtered_list = [prefilter_coeffs(parsed) for parsed in parsed_list]
+    models = pool.map(indiv_model, [(i, filtered, 0) for filtered in filtered_list for i in im_ind])
+
+    all_pulls = []
+    for k, parsed in enumerate(parsed_list):
+        pulls = []
+        for m, i in enumerate(im_ind):
+            valid = valid_pixels(i)
+            pulls.append((ravel(all_data["scidata"][i])[valid] - ravel(models[k*len(im_ind) + m])[valid])*sqrt(ravel(all_data["invvars"][i])[valid]))
+        all_pulls.append(concatenate(pulls + [prior_pulls(parsed)]))
+    return all_pulls
+
+
 def chi2_FN_wrapper(P, im_ind_wrap):
     return pull_FN_wrapper(P, im_ind_wrap, makechi2 = 1)
 
+
+def chi2_FN_batch(P_list, im_ind_wrap):
+    """chi2_FN_wrapper for several points (miniNM's batch_chi2fn with parallel_simplex)."""
+    return [dot(pulls, pulls) for pulls in pull_FN_batch(P_list, im_ind_wrap)]
+
+
+def param_index(settings):
+    """Indices of each group of parameters in P (same layout as parseP)."""
+
+    inds = {}
+    ind = 0
+
+    inds["coeffs"] = []
+    for gal_ind in range(settings["n_gal"]):
+        if settings["gal_type"][gal_ind] == "2D":
+            n_coeff = settings["n_coeff"][gal_ind]
+        else:
+            n_coeff = len(settings["spacingarray"]) + 2
+        inds["coeffs"].append(arange(ind, ind + n_coeff))
+        ind += n_coeff
+
+    inds["dRA"] = arange(ind, ind + settings["n_img"])
+    ind += settings["n_img"]
+    inds["dDec"] = arange(ind, ind + settings["n_img"])
+    ind += settings["n_img"]
+
+    inds["sndRA_offset"] = ind
+    ind += 1
+    inds["sndDec_offset"] = ind
+    ind += 1
+
+    inds["SN_ampl"] = arange(ind, ind + settings["n_epoch"])
+    ind += settings["n_epoch"]
+
+    inds["n_param"] = ind
+    return inds
+
+
+def param_image_map(settings):
+    """For each parameter in P, the images whose pixels it changes: dRA[i], dDec[i] only move image i, an SN
+    amplitude only shows up in its epoch, the SN offset in every image with SN light, the galaxy everywhere."""
+
+    inds = param_index(settings)
+    all_images = arange(settings["n_img"])
+    SN_images = where(settings["epochs"] > 0)[0]
+
+    image_map = [all_images for j in range(inds["n_param"])]
+    for i in range(settings["n_img"]):
+        image_map[inds["dRA"][i]] = array([i])
+        image_map[inds["dDec"][i]] = array([i])
+    for name in ["sndRA_offset", "sndDec_offset"]:
+        image_map[inds[name]] = SN_images
+    for ep in range(settings["n_epoch"]):
+        image_map[inds["SN_ampl"][ep]] = where(settings["epochs"] == ep + 1)[0]
+    return image_map
+
+
+def pull_sparsity(displ_list, im_ind):
+    """For each free parameter (displ_list != 0), the rows of pull_FN(parsed, im_ind) it can change (for DavidsNM's
+    column coloring)."""
+
+    inds = param_index(settings)
+    image_map = param_image_map(settings)
+
+    block_sizes = [len(valid_pixels(i)) for i in im_ind]
+    block_starts = concatenate(([0], cumsum(block_sizes)[:-1]))
+    n_pix = sum(block_sizes)
+
+    # Rows after the pixels: prior_pulls
+    prior_rows = [[] for j in range(inds["n_param"])]
+    for i in range(settings["n_img"]):
+        prior_rows[inds["dRA"][i]] = [n_pix + i]
+        prior_rows[inds["dDec"][i]] = [n_pix + settings["n_img"] + i]
+    prior_rows[inds["sndRA_offset"]] = list(n_pix + arange(settings["n_img"]))
+    prior_rows[inds["sndDec_offset"]] = list(n_pix + settings["n_img"] + arange(settings["n_img"]))
+
+    row = n_pix + 2*settings["n_img"]
+    for gal_ind in range(settings["n_gal"]):
+        if settings["gal_type"][gal_ind] == "1D":
+            prior_rows[inds["coeffs"][gal_ind][0]] = [row]
+            row += 1
+
+    sparsity = []
+    for j in where(displ_list != 0)[0]:
+        rows = [arange(block_starts[k], block_starts[k] + block_sizes[k]) for k, i in enumerate(im_ind) if i in image_map[j]]
+        sparsity.append(array(concatenate(rows + [prior_rows[j]]), dtype=int64))
+    return sparsity
+
+
+def sparse_fd_jacobian(P, displ_list, merged_list):
+    """Same finite differences as DavidsNM.Jacobian (steps of displ*1e-6), but each column only re-renders the images
+    its parameter affects (param_image_map); the other pixel rows of that column are exactly zero. The (cheap)
+    prior rows are recomputed for every column."""
+
+    im_ind = merged_list[0]
+    image_map = param_image_map(settings)
+
+    block_sizes = [len(valid_pixels(i)) for i in im_ind]
+    block_starts = dict(zip(im_ind, concatenate(([0], cumsum(block_sizes)[:-1]))))
+    n_pix = sum(block_sizes)
+
+    parsed = parseP(P, settings)
+    base_pixel_pulls = pixel_pulls(parsed, im_ind)
+    base_prior_pulls = prior_pulls(parsed)
+
+    free = where(displ_list != 0)[0]
+    J = zeros([n_pix + len(base_prior_pulls), len(free)], dtype=float64, order = 'F')
+
+    for col, j in enumerate(free):
+        step = displ_list[j]*1.e-6
+        dP = array(P, dtype=float64)
+        dP[j] += step
+        dparsed = parseP(dP, settings)
+
+        affected = [i for i in im_ind if i in image_map[j]]
+        if len(affected) > 0:
+            dpulls = pixel_pulls(dparsed, affected)
+            ind = 0
+            for i in affected:
+                rows = slice(block_starts[i], block_starts[i] + len(valid_pixels(i)))
+                J[rows, col] = (dpulls[ind: ind + len(valid_pixels(i))] - base_pixel_pulls[rows])/step
+                ind += len(valid_pixels(i))
+
+        J[n_pix:, col] = (prior_pulls(dparsed) - base_prior_pulls)/step
+
+    return J
+
+
+def linear_params(settings):
+    """Boolean mask over P: the parameters the model is linear in (2D spline coeffs, 1D profile amplitudes, SN amplitudes)."""
+    inds = param_index(settings)
+    linear = zeros(inds["n_param"], dtype=bool)
+    for gal_ind in range(settings["n_gal"]):
+        if settings["gal_type"][gal_ind] == "2D":
+            linear[inds["coeffs"][gal_ind]] = True
+        else:
+            # Not the axis ratio and orientation (coeffs[:2])
+            linear[inds["coeffs"][gal_ind][2:]] = True
+    linear[inds["SN_ampl"]] = True
+    return linear
+
+
+def indiv_image_pulls(i, parsed):
+    """Pixel pulls of image i alone (indiv_model), over valid_pixels(i)."""
+    model = indiv_model((i, prefilter_coeffs(parsed), 0))
+    valid = valid_pixels(i)
+    return (ravel(all_data["scidata"][i])[valid] - ravel(model)[valid])*sqrt(ravel(all_data["invvars"][i])[valid])
+
+
+def indiv_jacobian_rows(i, P, displ_list):
+    """Image i's rows of the pull Jacobian over the free parameters (displ_list != 0), and its pulls: exact for the
+    linear parameters, finite differences of this image alone for the rest, zero for parameters that don't touch it."""
+
+    parsed = parseP(P, settings)
+    image_map = param_image_map(settings)
+    linear = linear_params(settings)
+
+    free = where(displ_list != 0)[0]
+    relevant = array([k for k, j in enumerate(free) if i in image_map[j]], dtype=int64)
+    exact = relevant[linear[free[relevant]]]
+
+    rows = zeros([len(valid_pixels(i)), len(free)], dtype=float64, order = 'F')
+    if len(exact) > 0:
+        rows[:, exact] = indiv_linear_jacobian((i, parsed, free[exact]))
+
+    base_pulls = indiv_image_pulls(i, parsed)
+    for k in relevant[~linear[free[relevant]]]:
+        step = displ_list[free[k]]*1.e-6
+        dP = array(P, dtype=float64)
+        dP[free[k]] += step
+        rows[:, k] = (indiv_image_pulls(i, parseP(dP, settings)) - base_pulls)/step
+    return rows, base_pulls
+
+
+def prior_jacobian(P, displ_list):
+    """Finite-difference Jacobian of prior_pulls over the free parameters (it's cheap)."""
+    free = where(displ_list != 0)[0]
+    base_prior_pulls = prior_pulls(parseP(P, settings))
+
+    J = zeros([len(base_prior_pulls), len(free)], dtype=float64)
+    for k, j in enumerate(free):
+        step = displ_list[j]*1.e-6
+        dP = array(P, dtype=float64)
+        dP[j] += step
+        J[:, k] = (prior_pulls(parseP(dP, settings)) - base_prior_pulls)/step
+    return J, base_prior_pulls
+
+
+def indiv_jacobian_product(args):
+    """Image i's share of J.v (vec over P) or, transposed, of J^T.u (vec = u_i, can have several columns), without
+    its Jacobian rows: the linear parameters through galaxy_operator, the 1D basis profiles and the pixelized PSF
+    (or their adjoints), the others by finite differences of this image alone (as in indiv_jacobian_rows)."""
+    [i, P, displ_list, vec, transposed] = args
+
+    if transposed and vec.ndim > 1:
+        return transpose([indiv_jacobian_product((i, P, displ_list, vec[:, k], 1)) for k in range(vec.shape[1])])
+
+    parsed = parseP(P, settings)
+    inds = param_index(settings)
+    image_map = param_image_map(settings)
+    linear = linear_params(settings)
+
+    relevant = array([j for j in where(displ_list != 0)[0] if i in image_map[j]], dtype=int64)
+    exact = relevant[linear[relevant]]
+    other = relevant[~linear[relevant]]
+
+    invvars = ravel(all_data["invvars"][i])
+    valid = valid_pixels(i)
+
+    if transposed:
+        # Adjoint of the pixel weights and of indiv_model's sky re-estimate (subtracting the weighted mean)
+        pixels = zeros(settings["patch"]**2, dtype=float64)
+        pixels[valid] = -vec*sqrt(invvars[valid])
+        if any(invvars != 0):
+            pixels -= invvars*sum(pixels)/sum(invvars)
+        pixels = reshape(pixels, [settings["patch"]]*2)
+        JTu = zeros(len(P), dtype=float64)
+    else:
+        dmodel = zeros([settings["patch"]]*2, dtype=float64)
+
+    for gal_ind in range(settings["n_gal"]):
+        params = exact[in1d(exact, inds["coeffs"][gal_ind])]
+        if len(params) == 0:
+            continue
+        coeff_inds = params - inds["coeffs"][gal_ind][0]
+
+        if settings["gal_type"][gal_ind] == "2D":
+            xs, ys = spline_coords(i, parsed, gal_ind)
+            G = galaxy_operator(xs, ys, settings["splineradius"][gal_ind], all_data["psf_FFTs"][settings["psfs"][i]],
+                                settings["oversample"], settings["patch"])
+            mask = coeff_mask(settings["splineradius"][gal_ind])
+            if transposed:
+                JTu[params] = G.rmatvec(pixels)[mask][coeff_inds]
+            else:
+                coeffs = zeros(mask.sum(), dtype=float64)
+                coeffs[coeff_inds] = vec[params]
+                grid = zeros(mask.shape, dtype=float64)
+                grid[mask] = coeffs
+                dmodel += G.matvec(grid)
+        else:
+            # The amplitudes are coeffs[2:]
+            dx, dy = sky_offsets(i, parsed)
+            basis = oneD_spline_basis(settings["spacingarray"], elliptical_radius(parsed, gal_ind, dx, dy)[2])[coeff_inds - 2]
+            if transposed:
+                JTu[params] = tensordot(basis, indiv_convolve_adjoint(i, pixels), 2)
+            else:
+                dmodel += indiv_convolve(i, tensordot(vec[params], basis, 1))
+
+    if settings["epochs"][i] > 0 and inds["SN_ampl"][settings["epochs"][i] - 1] in exact:
+        j = inds["SN_ampl"][settings["epochs"][i] - 1]
+        psf = make_pixelized_PSF(parsed, i)/all_data["pixel_area_map"][i]
+        if transposed:
+            JTu[j] = sum(psf*pixels)
+        else:
+            dmodel = dmodel + psf*vec[j]
+
+    if not transposed:
+        dmodel = ravel(dmodel)
+        if any(invvars != 0):
+            dmodel -= dot(invvars, dmodel)/sum(invvars)
+        Jv = -dmodel[valid]*sqrt(invvars[valid])
+
+    if len(other) > 0:
+        # One column at a time (a few per image), so that J.v and J^T.u stay each other's transpose
+        base_pulls = indiv_image_pulls(i, parsed)
+        for j in other:
+            if not transposed and vec[j] == 0:
+                continue
+            step = displ_list[j]*1.e-6
+            dP = array(P, dtype=float64)
+            dP[j] += step
+            column = (indiv_image_pulls(i, parseP(dP, settings)) - base_pulls)/step
+            if transposed:
+                JTu[j] = dot(column, vec)
+            else:
+                Jv += column*vec[j]
+
+    return JTu if transposed else Jv
+
+
+def indiv_pull_vjp(args):
+    """Image i's share of J^T.u and of the squared column norms of J; its Jacobian rows are made once and dropped."""
+    [i, P, displ_list, u_i] = args
+
+    rows = indiv_jacobian_rows(i, P, displ_list)[0]
+    JTu = zeros((len(P),) + u_i.shape[1:], dtype=float64)
+    JTu[displ_list != 0] = dot(transpose(rows), u_i)
+    colnorms2 = zeros(len(P), dtype=float64)
+    colnorms2[displ_list != 0] = sum(rows**2., axis = 0)
+    return JTu, colnorms2
+
+
+def pull_jvp(P, v, displ_list, merged_list):
+    """J.v for pull_FN_wrapper (miniLM_matrix_free's jvp_fn): images go to the pool (indiv_jacobian_product), the
+    prior rows are done here."""
+
+    im_ind = merged_list[0]
+    rendered = [i for i in im_ind if len(valid_pixels(i)) > 0]
+
+    Jv = pool.map(indiv_jacobian_product, [(i, P, displ_list, v, 0) for i in rendered])
+
+    J_prior = prior_jacobian(P, displ_list)[0]
+    return concatenate([zeros(0, dtype=float64)] + Jv + [dot(J_prior, v[displ_list != 0])])
+
+
+def pull_vjp(P, u, displ_list, merged_list, colnorms = False):
+    """J^T.u for pull_FN_wrapper (miniLM_matrix_free's vjp_fn); u can have several columns. Images go to the pool
+    (indiv_jacobian_product), the prior rows are done here. With colnorms, also returns the column norms of J: the
+    workers then make each image's rows once (indiv_pull_vjp) and return both from that pass."""
+
+    im_ind = merged_list[0]
+    u = array(u, dtype=float64)
+
+    block_sizes = [len(valid_pixels(i)) for i in im_ind]
+    block_starts = concatenate(([0], cumsum(block_sizes)[:-1]))
+    n_pix = sum(block_sizes)
+
+    rendered = [k for k in range(len(im_ind)) if block_sizes[k] > 0]
+    if colnorms:
+        results = pool.map(indiv_pull_vjp, [(im_ind[k], P, displ_list, u[block_starts[k]: block_starts[k] + block_sizes[k]]) for k in rendered])
+        JTu = sum([item[0] for item in results], axis = 0)
+        colnorms2 = sum([item[1] for item in results], axis = 0)
+    else:
+        JTu = sum(pool.map(indiv_jacobian_product, [(im_ind[k], P, displ_list, u[block_starts[k]: block_starts[k] + block_sizes[k]], 1) for k in rendered]), axis = 0)
+
+    J_prior = prior_jacobian(P, displ_list)[0]
+    JTu[displ_list != 0] += dot(transpose(J_prior), u[n_pix:])
+
+    if colnorms:
+        colnorms2[displ_list != 0] += sum(J_prior**2., axis = 0)
+        return JTu, sqrt(colnorms2)
+    return JTu
+
+
+def indiv_normal_equations(args):
+    """JtJ and J^T r over a group of images, accumulated chunk_size images at a time (only their rows are held)."""
+    [group, P, displ_list, chunk_size] = args
+
+    n_free = sum(displ_list != 0)
+    JtJ = zeros([n_free, n_free], dtype=float64)
+    Jtr = zeros(n_free, dtype=float64)
+
+    for start in range(0, len(group), chunk_size):
+        chunk = [indiv_jacobian_rows(i, P, displ_list) for i in group[start: start + chunk_size]]
+        rows = concatenate([item[0] for item in chunk])
+        pulls = concatenate([item[1] for item in chunk])
+        JtJ += dot(transpose(rows), rows)
+        Jtr += dot(transpose(rows), pulls)
+    return JtJ, Jtr
+
+
+def streamed_normal_equations(P, displ_list, merged_list):
+    """JtJ and J^T r of pull_FN_wrapper for miniLM's normal_eq_fn, without the full Jacobian. Each worker accumulates
+    its share of the images in chunks sized so that all workers together hold at most stream_jacobian_MB of rows."""
+
+    im_ind = [i for i in merged_list[0] if len(valid_pixels(i)) > 0]
+    n_free = sum(displ_list != 0)
+
+    bytes_per_image = 8.*settings["patch"]**2*n_free
+    chunk_size = max(1, int(settings["stream_jacobian_MB"]*1.e6/(settings["n_cpu"]*bytes_per_image)))
+
+    groups = [list(group) for group in array_split(im_ind, settings["n_cpu"]) if len(group) > 0]
+    partial_sums = pool.map(indiv_normal_equations, [(group, P, displ_list, chunk_size) for group in groups])
+
+    J_prior, base_prior_pulls = prior_jacobian(P, displ_list)
+    JtJ = dot(transpose(J_prior), J_prior) + sum([item[0] for item in partial_sums], axis = 0)
+    Jtr = dot(transpose(J_prior), base_prior_pulls) + sum([item[1] for item in partial_sums], axis = 0)
+    return JtJ, Jtr
+
+
+def image_offset_blocks(settings):
+    """(dRA[i], dDec[i]) for each image: they only couple to the galaxy/SN parameters through image i, so the
+    normal equations are block-arrow (for miniLM's local_blocks)."""
+    if not settings["schur_solver"]:
+        return None
+
+    inds = param_index(settings)
+    return [[inds["dRA"][i], inds["dDec"][i]] for i in range(settings["n_img"])]
+
+
+def lm_options(settings):
+    """Linear-algebra options for miniLM_new (the same for every LM fit)."""
+    return dict(local_blocks = image_offset_blocks(settings), reuse_factorization = settings["reuse_factorization"],
+                lambda_ladder = settings["lambda_ladder"], batch_residfn = pull_FN_batch,
+                matrix_free = settings["matrix_free"], jvp_fn = pull_jvp, vjp_fn = pull_vjp,
+                normal_eq_fn = streamed_normal_equations if (settings["stream_jacobian_MB"] or settings["matrix_free"]) else None,
+                broyden_updates = settings["broyden_updates"], broyden_tolerance = settings["broyden_tolerance"])
+
+
+def indiv_linear_jacobian(args):
+    """d(pulls)/dP for image i, for the parameters the model is linear in (2D spline coeffs, 1D amplitudes, SN amplitudes).
+    With analytic_centroids, also dRA[i], dDec[i] and the SN offsets from indiv_position_derivs."""
+    [i, parsed, lin_params] = args
+
+    inds = param_index(settings)
+    dmodel = zeros([settings["patch"]**2, len(lin_params)], dtype=float64)
+
+    for gal_ind in range(settings["n_gal"]):
+        cols = where(in1d(lin_params, inds["coeffs"][gal_ind]))[0]
+        if len(cols) == 0:
+            continue
+
+        if settings["gal_type"][gal_ind] == "2D":
+            xs, ys = spline_coords(i, parsed, gal_ind)
+            G = galaxy_operator(xs, ys, settings["splineradius"][gal_ind], all_data["psf_FFTs"][settings["psfs"][i]],
+                                settings["oversample"], settings["patch"]).dense()
+            dmodel[:, cols] = G[:, lin_params[cols] - inds["coeffs"][gal_ind][0]]
+        else:
+            # Each amplitude's basis profile (and with gradient_1D_prefit, the axis ratio / orientation derivatives), convolved like the model
+            dx, dy = sky_offsets(i, parsed)
+            coeff_inds = lin_params[cols] - inds["coeffs"][gal_ind][0]
+
+            components = [None]*len(parsed["coeffs"][gal_ind])
+            if any(coeff_inds < 2):
+                components[:2] = galaxy_shape_derivs(parsed, gal_ind, dx, dy)
+            if any(coeff_inds >= 2):
+                components[2:] = oneD_spline_basis(settings["spacingarray"], elliptical_radius(parsed, gal_ind, dx, dy)[2])
+
+            for col, coeff_ind in zip(cols, coeff_inds):
+                dmodel[:, col] = reshape(indiv_convolve(i, components[coeff_ind]), settings["patch"]**2)
+
+    if settings["epochs"][i] > 0:
+        cols = where(lin_params == inds["SN_ampl"][settings["epochs"][i] - 1])[0]
+        if len(cols) > 0:
+            dmodel[:, cols[0]] = reshape(make_pixelized_PSF(parsed, i)/all_data["pixel_area_map"][i], settings["patch"]**2)
+
+    # analytic_centroids: image offset and SN offset columns straight from indiv_position_derivs
+    position_params = [inds["dRA"][i], inds["dDec"][i], inds["sndRA_offset"], inds["sndDec_offset"]]
+    if any(in1d(lin_params, position_params)):
+        position_derivs = indiv_position_derivs(i, prefilter_coeffs(parsed))
+        for k, j in enumerate(position_params):
+            cols = where(lin_params == j)[0]
+            if len(cols) > 0:
+                dmodel[:, cols[0]] = reshape(position_derivs[k], settings["patch"]**2)
+
+    invvars = reshape(all_data["invvars"][i], settings["patch"]**2)
+    if any(invvars != 0):
+        # indiv_model re-estimates the sky from the residuals, i.e., subtracts the weighted mean of the model
+        dmodel -= dot(invvars, dmodel)/sum(invvars)
+
+    valid = valid_pixels(i)
+    return -dmodel[valid]*sqrt(invvars[valid])[:, None]
+
+
+def linear_jacobian(P, displ_list, merged_list):
+    """Jacobian of pull_FN_wrapper for miniLM (jacobian_fn). Columns for 2D spline coeffs, 1D amplitudes and SN amplitudes are
+    exact (galaxy_operator / pixelized PSF), so they cost no model evaluations; so are, with analytic_centroids, the
+    dRA/dDec and SN offset columns, and with gradient_1D_prefit the 1D axis ratio and orientation columns. The rest
+    are finite differences."""
+
+    im_ind = merged_list[0]
+    parsed = parseP(P, settings)
+    inds = param_index(settings)
+
+    linear = linear_params(settings)
+    if settings["analytic_centroids"]:
+        for name in ["dRA", "dDec", "sndRA_offset", "sndDec_offset"]:
+            linear[inds[name]] = True
+    if settings["gradient_1D_prefit"]:
+        for gal_ind in range(settings["n_gal"]):
+            if settings["gal_type"][gal_ind] == "1D":
+                linear[inds["coeffs"][gal_ind][:2]] = True
+
+    free = where(displ_list != 0)[0]
+    exact = free[linear[free]]
+    other = free[~linear[free]]
+
+    n_pix = n_pixel_pulls(im_ind)
+    datalen = n_pix + 2*settings["n_img"] + sum(array(settings["gal_type"]) == "1D")
+
+    J = zeros([datalen, len(free)], dtype=float64, order = 'F')
+
+    if len(exact) > 0:
+        # Images without pixel pulls (packed_pulls) contribute no rows
+        rendered = [i for i in im_ind if len(valid_pixels(i)) > 0]
+
+        J_rows = pool.map(indiv_linear_jacobian, [(i, parsed, exact) for i in rendered])
+        J[:n_pix, searchsorted(free, exact)] = concatenate(J_rows)
+
+        # Centroid prior rows (see pull_FN)
+        for i in range(settings["n_img"]):
+            if displ_list[inds["dRA"][i]] != 0 and linear[inds["dRA"][i]]:
+                J[n_pix + i, searchsorted(free, inds["dRA"][i])] = cos(settings["Dec0"][i]/57.2957795)*3600./settings["SN_centroid_prior_arcsec"]
+            if displ_list[inds["dDec"][i]] != 0 and linear[inds["dDec"][i]]:
+                J[n_pix + settings["n_img"] + i, searchsorted(free, inds["dDec"][i])] = 3600./settings["SN_centroid_prior_arcsec"]
+        if displ_list[inds["sndRA_offset"]] != 0 and linear[inds["sndRA_offset"]]:
+            J[n_pix + arange(settings["n_img"]), searchsorted(free, inds["sndRA_offset"])] = cos(settings["Dec0"]/57.2957795)*3600./settings["SN_centroid_prior_arcsec"]
+        if displ_list[inds["sndDec_offset"]] != 0 and linear[inds["sndDec_offset"]]:
+            J[n_pix + settings["n_img"] + arange(settings["n_img"]), searchsorted(free, inds["sndDec_offset"])] = 3600./settings["SN_centroid_prior_arcsec"]
+
+        # 1D axis ratio positivity rows
+        prior_row = n_pix + 2*settings["n_img"]
+        for gal_ind in range(settings["n_gal"]):
+            if settings["gal_type"][gal_ind] == "1D":
+                j = inds["coeffs"][gal_ind][0]
+                if displ_list[j] != 0 and linear[j]:
+                    J[prior_row, searchsorted(free, j)] = 1e6*(parsed["coeffs"][gal_ind][0] < 1.)
+                prior_row += 1
+
+    if len(other) > 0:
+        other_displ = zeros(len(P), dtype=float64)
+        other_displ[other] = displ_list[other]
+        if settings["color_jacobian"]:
+            sparsity = pull_sparsity(other_displ, im_ind)
+            J[:, searchsorted(free, other)] = grouped_Jacobian(pull_FN_wrapper, displ_list[other]*1.e-6, merged_list, P[other],
+                                                               other_displ, P, datalen, True, sparsity, color_columns(sparsity, datalen))
+        elif settings["sparse_jacobian"]:
+            J[:, searchsorted(free, other)] = sparse_fd_jacobian(P, other_displ, merged_list)
+        else:
+            J[:, searchsorted(free, other)] = Jacobian(pull_FN_wrapper, displ_list[other]*1.e-6, merged_list, P[other],
+                                                       other_displ, P, datalen, use_dense_J = True)
+
+    return J
+
+
+varpro_cache = dict(keys = None, JtJ = None, Jtr = None, blocks = OrderedDict(), nbytes = 0)
+
+def indiv_varpro_normal_equations(args):
+    """Image i's J_i^T J_i and J_i^T r_i over the linear parameters, with r_i its pulls when they are zero (only the
+    profiled sky, so they don't depend on the renderer)."""
+    [i, parsed, lin_params] = args
+
+    J_rows = indiv_linear_jacobian((i, parsed, lin_params))
+    return dot(transpose(J_rows), J_rows), dot(transpose(J_rows), indiv_image_pulls(i, parsed))
+
+
+def varpro_blocks(parsed, lin_params, keys, im_ind):
+    """indiv_varpro_normal_equations of images im_ind, from the cache where possible (an LRU of at most varpro_cache_MB)."""
+
+    blocks = varpro_cache["blocks"]
+    todo = [i for i in im_ind if keys[i] not in blocks]
+
+    for i, block in zip(todo, pool.map(indiv_varpro_normal_equations, [(i, parsed, lin_params) for i in todo])):
+        blocks[keys[i]] = block
+        varpro_cache["nbytes"] += block[0].nbytes + block[1].nbytes
+
+    found = [blocks[keys[i]] for i in im_ind]
+    for i in im_ind:
+        blocks.move_to_end(keys[i])
+    while varpro_cache["nbytes"] > settings["varpro_cache_MB"]*1.e6 and len(blocks) > 0:
+        NA, block = blocks.popitem(last = False)
+        varpro_cache["nbytes"] -= block[0].nbytes + block[1].nbytes
+    return found
+
+
+def solve_linear_params(P):
+    """Variable projection: with the positions fixed, the 2D spline coeffs and SN amplitudes (and the profiled sky)
+    enter linearly, so solve for them exactly: the normal equations are summed from per-image blocks and solved by
+    Cholesky. Returns the updated P and its pulls."""
+
+    inds = param_index(settings)
+    lin_params = concatenate(inds["coeffs"] + [inds["SN_ampl"]])
+
+    P = array(P, dtype=float64)
+    P[lin_params] = 0.
+    parsed = parseP(P, settings)
+
+    # The blocks only depend on the positions. An LM Jacobian column in dRA[i] or dDec[i] only changes image i, so swap
+    # that image's contribution in and out of the last full sum.
+    keys = [(i, parsed["dRA"][i], parsed["dDec"][i], parsed["sndRA_offset"], parsed["sndDec_offset"]) for i in range(settings["n_img"])]
+    changed = [] if varpro_cache["keys"] is None else [i for i in range(settings["n_img"]) if keys[i] != varpro_cache["keys"][i]]
+
+    if varpro_cache["keys"] is None or len(changed) > settings["n_img"]/2:
+        blocks = varpro_blocks(parsed, lin_params, keys, range(settings["n_img"]))
+        JtJ = sum([block[0] for block in blocks], axis = 0)
+        Jtr = sum([block[1] for block in blocks], axis = 0)
+        varpro_cache.update(keys = keys, JtJ = JtJ, Jtr = Jtr)
+    else:
+        JtJ = array(varpro_cache["JtJ"])
+        Jtr = array(varpro_cache["Jtr"])
+
+        old_P = array(P)
+        old_P[inds["dRA"]] = [key[1] for key in varpro_cache["keys"]]
+        old_P[inds["dDec"]] = [key[2] for key in varpro_cache["keys"]]
+        old_P[inds["sndRA_offset"]], old_P[inds["sndDec_offset"]] = varpro_cache["keys"][0][3:]
+        old_parsed = parseP(old_P, settings)
+
+        for sign, these_parsed, these_keys in [(-1., old_parsed, varpro_cache["keys"]), (1., parsed, keys)]:
+            for block in varpro_blocks(these_parsed, lin_params, these_keys, changed):
+                JtJ += sign*block[0]
+                Jtr += sign*block[1]
+
+    try:
+        lin_fit = cho_solve(cho_factor(JtJ), -Jtr)
+    except linalg.LinAlgError:
+        # Coefficients no image constrains
+        lin_fit = linalg.lstsq(JtJ, -Jtr, rcond = None)[0]
+
+    P[lin_params] = lin_fit
+    return P, pull_FN(parseP(P, settings))
+
+
+def varpro_pull_FN_wrapper(P, im_ind_wrap):
+    """For L-M over the positions only (varpro). The linear parameters in P are ignored and re-solved."""
+    assert im_ind_wrap[0] == list(range(settings["n_img"])), "varpro fits all images at once!"
+    return solve_linear_params(P)[1]
+
+
 """    
 def lstsq_fit_for_spline(parsed):
     print "Making jacobian for spline..."
@@ -816,9 +1911,60 @@ def load_galaxy_coeffs(parsed, do_init, do_fit):
     return parsed
 
 
+def centroid_miniscale(i):
+    """miniscale for iterative_centroid's fit of image i: its dRA, dDec only."""
+    tmp_dpos = zeros(settings["n_img"], dtype=float64)
+    tmp_dpos[i] = 0.1
+
+    miniscale_parsed = dict(SN_ampl = zeros(settings["n_epoch"], dtype=float64),
+                            sndRA_offset = 0,
+                            sndDec_offset = 0,
+                            dRA = tmp_dpos,
+                            dDec = tmp_dpos)
+    miniscale_parsed = load_galaxy_coeffs(miniscale_parsed, do_init = 0, do_fit = [0]*settings["n_gal"])
+
+    return unparseP(miniscale_parsed, settings)
+
+
+def indiv_pull_FN_wrapper(P, im_ind_wrap):
+    """pull_FN_wrapper for passdata = [i], with image i rendered in this process (for fits run inside a worker)."""
+    i = im_ind_wrap[0][0]
+    parsed = parseP(P, settings)
+    return concatenate((indiv_image_pulls(i, parsed), prior_pulls(parsed)))
+
+
+def indiv_centroid_jacobian(P, displ_list, im_ind_wrap):
+    """Jacobian of indiv_pull_FN_wrapper with analytic_centroids, in this process: indiv_linear_jacobian's columns, then
+    the prior rows."""
+    i = im_ind_wrap[0][0]
+    free = where(displ_list != 0)[0]
+    return concatenate((indiv_linear_jacobian((i, parseP(P, settings), free)), prior_jacobian(P, displ_list)[0]))
+
+
+def indiv_centroid_fit(args):
+    """iterative_centroid's LM fit of image i's dRA, dDec, done entirely inside one worker (parallel_centroid).
+    Returns image i's dRA, dDec and the fit's Cmat."""
+    [i, P] = args
+
+    inds = param_index(settings)
+    P, F, Cmat = miniLM_new(ministart = P, miniscale = centroid_miniscale(i), residfn = indiv_pull_FN_wrapper, passdata = [i], verbose = False, maxiter = 3,
+                            jacobian_fn = indiv_centroid_jacobian if settings["analytic_centroids"] else None)
+    return P[inds["dRA"][i]], P[inds["dDec"][i]], Cmat
+
+
 def LM_fit_for_centroids(parsed, itr):
     P = unparseP(parsed, settings)
 
+    if settings["linear_jacobian"] or settings["analytic_centroids"]:
+        jacobian_fn = linear_jacobian
+    elif settings["sparse_jacobian"] and not settings["color_jacobian"]:
+        jacobian_fn = sparse_fd_jacobian
+    else:
+        jacobian_fn = None
+
+    # Otherwise, linear_jacobian colors its finite-difference columns itself
+    use_coloring = settings["color_jacobian"] and jacobian_fn == None
+
     pulls = pull_FN(parsed)
     print("chi^2 check before centroid", dot(pulls, pulls))
     assert 1 - isnan(dot(pulls, pulls))
@@ -840,8 +1986,20 @@ def LM_fit_for_centroids(parsed, itr):
 
         miniscale = unparseP(miniscale_parsed, settings)
 
-        P, F, NA = miniNM_new(ministart = P, miniscale = miniscale, chi2fn = chi2_FN_wrapper, passdata = list(range(settings["n_img"])), verbose = True, maxiter = 200, maxruncount = 3, compute_Cmat = False)
+        if settings["gradient_1D_prefit"]:
+            # Every free parameter (1D coeffs, SN amplitudes) has an exact linear_jacobian column
+            P, F, Cmat = miniLM_new(ministart = P, miniscale = miniscale, residfn = pull_FN_wrapper, passdata = list(range(settings["n_img"])), verbose = True, maxiter = 30, use_dense_J = True, jacobian_fn = linear_jacobian,
+                                    **lm_options(settings))
+        else:
+            P, F, Cmat = miniNM_new(ministart = P, miniscale = miniscale, chi2fn = chi2_FN_wrapper, passdata = list(range(settings["n_img"])), verbose = True, maxiter = 200, maxruncount = 3, compute_Cmat = False,
+                                    batch_chi2fn = chi2_FN_batch if settings["parallel_simplex"] else None)
         print("Done", time.asctime())
+        if settings["gradient_1D_prefit"]:
+            # LM's Gauss-Newton covariance (JtJ of the pulls) comes for free. The outer amplitudes can be degenerate with the profiled sky.
+            if Cmat is not None and all(diag(Cmat) > 0):
+                print("1D fit uncertainties", sqrt(diag(Cmat)))
+            else:
+                print("1D fit covariance is singular")
         print("SECONDS", time.time())
 
         #parsed = parseP(P, settings)
@@ -869,7 +2027,9 @@ def LM_fit_for_centroids(parsed, itr):
 
     print("Running galaxy+SN-only fit", time.asctime())
     print("SECONDS", time.time())
-    P, F, NA = miniLM_new(ministart = P, miniscale = miniscale, residfn = pull_FN_wrapper, passdata = list(range(settings["n_img"])), verbose = False, maxiter = 1, use_dense_J = True)
+    P, F, NA = miniLM_new(ministart = P, miniscale = miniscale, residfn = pull_FN_wrapper, passdata = list(range(settings["n_img"])), verbose = False, maxiter = 1, use_dense_J = True, jacobian_fn = jacobian_fn,
+                          jacobian_sparsity = pull_sparsity(miniscale, list(range(settings["n_img"]))) if use_coloring else None,
+                          **lm_options(settings))
     print("Done", time.asctime())
     print("SECONDS", time.time())
 
@@ -884,21 +2044,21 @@ def LM_fit_for_centroids(parsed, itr):
     if settings["iterative_centroid"]:
         assert settings["fitSNoffset"] == 0
 
-        for i in range(settings["n_img"]):
-            print("Centroiding ", i, "of", settings["n_img"])
-            tmp_dpos = zeros(settings["n_img"], dtype=float64)
-            tmp_dpos[i] = 0.1
+        if settings["parallel_centroid"]:
+            # With the galaxy fixed, each image's offsets only move its own pulls, so the fits are independent
+            print("Centroiding", settings["n_img"], "images in parallel")
+            inds = param_index(settings)
+            for i, (dRA, dDec, Cmat) in enumerate(pool.map(indiv_centroid_fit, [(i, P) for i in range(settings["n_img"])])):
+                P[inds["dRA"][i]] = dRA
+                P[inds["dDec"][i]] = dDec
+        else:
+            for i in range(settings["n_img"]):
+                print("Centroiding ", i, "of", settings["n_img"])
 
-            
-            miniscale_parsed = dict(SN_ampl = zeros(settings["n_epoch"], dtype=float64),
-                                    sndRA_offset = 0,
-                                    sndDec_offset = 0,
-                                    dRA = tmp_dpos,
-                                    dDec = tmp_dpos)
-            miniscale_parsed = load_galaxy_coeffs(miniscale_parsed, do_init = 0, do_fit = [0]*settings["n_gal"])
-
-            miniscale = unparseP(miniscale_parsed, settings)
-            P, F, Cmat = miniLM_new(ministart = P, miniscale = miniscale, residfn = pull_FN_wrapper, passdata = [i], verbose = False, maxiter = 3)
+                miniscale = centroid_miniscale(i)
+                P, F, Cmat = miniLM_new(ministart = P, miniscale = miniscale, residfn = pull_FN_wrapper, passdata = [i], verbose = False, maxiter = 3, jacobian_fn = jacobian_fn,
+                                        jacobian_sparsity = pull_sparsity(miniscale, [i]) if use_coloring else None,
+                                        **lm_options(settings))
     else:
         
         print("Running centroid-only fit", time.asctime())
@@ -913,7 +2073,9 @@ def LM_fit_for_centroids(parsed, itr):
         miniscale_parsed = load_galaxy_coeffs(miniscale_parsed, do_init = 0, do_fit = [0]*settings["n_gal"])
 
         miniscale = unparseP(miniscale_parsed, settings)
-        P, F, NA = miniLM_new(ministart = P, miniscale = miniscale, residfn = pull_FN_wrapper, passdata = list(range(settings["n_img"])), verbose = False, maxiter = 3, use_dense_J = True)
+        P, F, NA = miniLM_new(ministart = P, miniscale = miniscale, residfn = pull_FN_wrapper, passdata = list(range(settings["n_img"])), verbose = False, maxiter = 3, use_dense_J = True, jacobian_fn = jacobian_fn,
+                              jacobian_sparsity = pull_sparsity(miniscale, list(range(settings["n_img"]))) if use_coloring else None,
+                          **lm_options(settings))
         print("LM chi^2", F)
         
         print("Running everything fit", time.asctime())
@@ -928,7 +2090,9 @@ def LM_fit_for_centroids(parsed, itr):
         miniscale_parsed = load_galaxy_coeffs(miniscale_parsed, do_init = 0, do_fit = [1]*settings["n_gal"])
 
         miniscale = unparseP(miniscale_parsed, settings)
-        P, F, Cmat = miniLM_new(ministart = P, miniscale = miniscale, residfn = pull_FN_wrapper, passdata = list(range(settings["n_img"])), verbose = False, maxiter = 3, use_dense_J = True)
+        P, F, Cmat = miniLM_new(ministart = P, miniscale = miniscale, residfn = pull_FN_wrapper, passdata = list(range(settings["n_img"])), verbose = False, maxiter = 3, use_dense_J = True, jacobian_fn = jacobian_fn,
+                                jacobian_sparsity = pull_sparsity(miniscale, list(range(settings["n_img"]))) if use_coloring else None,
+                          **lm_options(settings))
         
         try:
             Cmat[0,0]
@@ -948,6 +2112,57 @@ def LM_fit_for_centroids(parsed, itr):
 
 
 
+def varpro_fit_for_centroids(parsed, itr):
+    """Same job as LM_fit_for_centroids, but the LM only iterates over dRA, dDec (and the SN offset if fitSNoffset);
+    the galaxy coeffs and SN amplitudes are solved exactly at every step. iterative_centroid isn't needed, as the
+    nonlinear problem only has 2*n_img + 2 parameters."""
+
+    inds = param_index(settings)
+    P = unparseP(parsed, settings)
+
+    miniscale = zeros(len(P), dtype=float64)
+    miniscale[inds["dRA"]] = 1.e-1
+    miniscale[inds["dDec"]] = 1.e-1
+    miniscale[inds["sndRA_offset"]] = 1.e-1 * settings["fitSNoffset"]
+    miniscale[inds["sndDec_offset"]] = 1.e-1 * settings["fitSNoffset"]
+
+    P, pulls = solve_linear_params(P)
+    print("chi^2 check before centroid", dot(pulls, pulls))
+    assert 1 - isnan(dot(pulls, pulls))
+
+    print("Running variable-projection centroid fit", time.asctime())
+    print("SECONDS", time.time())
+    P, F, NA = miniLM_new(ministart = P, miniscale = miniscale, residfn = varpro_pull_FN_wrapper, passdata = list(range(settings["n_img"])), verbose = False, maxiter = 10, use_dense_J = True, return_Cmat = False)
+    P, pulls = solve_linear_params(P)
+    print("Done", time.asctime())
+    print("SECONDS", time.time())
+    print("LM chi^2", F)
+
+    # One LM step over everything at the solution, for the covariance matrix (including the position uncertainties)
+    miniscale_parsed = dict(SN_ampl = ones(settings["n_epoch"], dtype=float64)*settings["flux_scale"],
+                            sndRA_offset = 1.e-1 * settings["fitSNoffset"],
+                            sndDec_offset = 1.e-1 * settings["fitSNoffset"],
+                            dRA = zeros(settings["n_img"], dtype=float64) + 1.e-1,
+                            dDec = zeros(settings["n_img"], dtype=float64) + 1.e-1)
+    miniscale_parsed = load_galaxy_coeffs(miniscale_parsed, do_init = 0, do_fit = [1]*settings["n_gal"])
+    miniscale = unparseP(miniscale_parsed, settings)
+
+    P, F, Cmat = miniLM_new(ministart = P, miniscale = miniscale, residfn = pull_FN_wrapper, passdata = list(range(settings["n_img"])), verbose = False, maxiter = 1, use_dense_J = True, jacobian_fn = linear_jacobian,
+                            **lm_options(settings))
+
+    try:
+        Cmat[0,0]
+    except:
+        Cmat = zeros([sum(miniscale != 0)]*2, dtype=float64)
+
+    parsed = parseP(P, settings)
+    pulls = pull_FN(parsed)
+    print("iteration ", itr, "dRA, dDec", parsed["dRA"], parsed["dDec"])
+    print("chi^2 check after centroid", dot(pulls, pulls))
+
+    return parsed, Cmat
+
+
 def get_loglike(P, all_data):
     """Compute the log likelihood."""
     return loglike
@@ -992,182 +2207,184 @@ def time_to_stop(parsed, last_flux, chi2, last_chi2, settings, itr):
     return 0
 
 if __name__ == "__main__":
-    pass
-settings = read_paramfile(sys.argv[1])
-settings = finish_settings(settings)
-
-
-all_data = get_PSFs(settings)
-all_data = get_data(settings, all_data)
-
+    settings = read_paramfile(sys.argv[1])
+    settings = finish_settings(settings)
 
-settings["flux_scale"] = scoreatpercentile(all_data["scidata"], 99)
-print('settings["flux_scale"]', settings["flux_scale"])
 
+    all_data = get_PSFs(settings)
+    all_data = get_data(settings, all_data)
 
-pool = multiprocessing.Pool(processes = settings["n_cpu"])
 
-parsed = {}
+    settings["flux_scale"] = scoreatpercentile(all_data["scidata"], 99)
+    print('settings["flux_scale"]', settings["flux_scale"])
 
-parsed = load_galaxy_coeffs(parsed, do_init = 1, do_fit = None)
 
-parsed["dRA"] = zeros(settings["n_img"], dtype=float64)
-parsed["dDec"] = zeros(settings["n_img"], dtype=float64)
-parsed["sndRA_offset"] = settings["sndRA_offset"]
-parsed["sndDec_offset"] = settings["sndDec_offset"]
-parsed["SN_ampl"] = ones(settings["n_epoch"], dtype=float64)*settings["flux_scale"]
-parsed = parseP(unparseP(parsed, settings), settings)
+    pool = multiprocessing.Pool(processes = settings["n_cpu"])
 
-#models = modelfn(parsed)#parsed, all_data, settings)
+    parsed = {}
 
+    parsed = load_galaxy_coeffs(parsed, do_init = 1, do_fit = None)
 
-save_img(all_data["invvars"], "invvars.fits")
-save_img(all_data["scidata"], "scidata.fits")
-save_img(all_data["pixel_area_map"], "pixel_area_map_cutout.fits")
-#save_img(all_data["RAs"], "RAs.fits")
-#save_img(all_data["Decs"], "Decs.fits")
-save_img(all_data["pixel_sampled_RAs"], "pixel_sampled_RAs.fits")
-save_img(all_data["pixel_sampled_Decs"],"pixel_sampled_Decs.fits")
+    parsed["dRA"] = zeros(settings["n_img"], dtype=float64)
+    parsed["dDec"] = zeros(settings["n_img"], dtype=float64)
+    parsed["sndRA_offset"] = settings["sndRA_offset"]
+    parsed["sndDec_offset"] = settings["sndDec_offset"]
+    parsed["SN_ampl"] = ones(settings["n_epoch"], dtype=float64)*settings["flux_scale"]
+    parsed = parseP(unparseP(parsed, settings), settings)
 
-"""
-some_RAs = settings["RA0"] + (random.random(size = 100) - 0.5)/3000.
-some_Decs = settings["Dec0"] + (random.random(size = 100) - 0.5)/3000.
+    #models = modelfn(parsed)#parsed, all_data, settings)
 
-from matplotlib import use
-use("PDF")
-import matplotlib.pyplot as plt
 
+    save_img(all_data["invvars"], "invvars.fits")
+    save_img(all_data["scidata"], "scidata.fits")
+    save_img(all_data["pixel_area_map"], "pixel_area_map_cutout.fits")
+    #save_img(all_data["RAs"], "RAs.fits")
+    #save_img(all_data["Decs"], "Decs.fits")
+    save_img(all_data["pixel_sampled_RAs"], "pixel_sampled_RAs.fits")
+    save_img(all_data["pixel_sampled_Decs"],"pixel_sampled_Decs.fits")
 
-some_is = array([all_data["RADec_to_i"][52](some_RAs[i], some_Decs[i]) for i in range(100)])
-print some_is.shape
-some_is = some_is[:,0,0]
-print some_is.shape
+    """
+    some_RAs = settings["RA0"] + (random.random(size = 100) - 0.5)/3000.
+    some_Decs = settings["Dec0"] + (random.random(size = 100) - 0.5)/3000.
 
+    from matplotlib import use
+    use("PDF")
+    import matplotlib.pyplot as plt
 
 
-plt.scatter(some_RAs, some_Decs, c = some_is)
-plt.xlim(settings["RA0"] - 0.0002, settings["RA0"] + 0.0002)
-plt.ylim(settings["Dec0"] - 0.0002, settings["Dec0"] + 0.0002)
-plt.colorbar()
-plt.savefig("tmp.pdf")
-plt.close()
-"""
+    some_is = array([all_data["RADec_to_i"][52](some_RAs[i], some_Decs[i]) for i in range(100)])
+    print some_is.shape
+    some_is = some_is[:,0,0]
+    print some_is.shape
 
-last_flux = zeros(len(parsed["SN_ampl"]), dtype=float64) - 2.
-last_chi2 = 1e101
-itr = 0
-chi2 = 1e100
 
-while time_to_stop(parsed, last_flux, chi2, last_chi2, settings, itr) == 0:
-    last_chi2 = chi2
-    last_flux = parsed["SN_ampl"]
 
-    #parsed = lstsq_fit_for_spline(parsed)
-    parsed, Cmat = LM_fit_for_centroids(parsed, itr)
+    plt.scatter(some_RAs, some_Decs, c = some_is)
+    plt.xlim(settings["RA0"] - 0.0002, settings["RA0"] + 0.0002)
+    plt.ylim(settings["Dec0"] - 0.0002, settings["Dec0"] + 0.0002)
+    plt.colorbar()
+    plt.savefig("tmp.pdf")
+    plt.close()
+    """
 
+    last_flux = zeros(len(parsed["SN_ampl"]), dtype=float64) - 2.
+    last_chi2 = 1e101
+    itr = 0
+    chi2 = 1e100
 
-    pulls = pull_FN(parsed)
-    print("iteration ", itr, "dRA, dDec", parsed["dRA"], parsed["dDec"])
-    chi2 = dot(pulls, pulls)
-    print("chi^2 ", chi2)
-    print("SN_ampl", parsed["SN_ampl"])
-    
-    itr += 1
-
-assert itr > 0, "No iterations run!"
-
-models = modelfn(parsed)#parsed, all_data, settings)
-save_img(models, "models.fits")
-save_img([(all_data["scidata"][i] - models[i])*(all_data["invvars"][i] > 0) for i in range(settings["n_img"])], "residuals.fits")
-pulls = array([(all_data["scidata"][i] - models[i])*sqrt(all_data["invvars"][i]) for i in range(settings["n_img"])])
-save_img(pulls, "pulls.fits")
+    while time_to_stop(parsed, last_flux, chi2, last_chi2, settings, itr) == 0:
+        last_chi2 = chi2
+        last_flux = parsed["SN_ampl"]
 
-pt_models = modelfn(parsed, just_pt_flux = 1)#parsed, all_data, settings)
-save_img(pt_models, "pt_models.fits")
+        #parsed = lstsq_fit_for_spline(parsed)
+        if settings["varpro"]:
+            parsed, Cmat = varpro_fit_for_centroids(parsed, itr)
+        else:
+            parsed, Cmat = LM_fit_for_centroids(parsed, itr)
 
-try:
-    SNCmat = parseCmat(Cmat, settings)
-except:
-    SNCmat = zeros([len(parsed["SN_ampl"])]*2)
 
-pickle.dump([all_data, parsed, settings, SNCmat, Cmat], gzip.open("fit_results.pickle", 'w'))
+        pulls = pull_FN(parsed)
+        print("iteration ", itr, "dRA, dDec", parsed["dRA"], parsed["dDec"])
+        chi2 = dot(pulls, pulls)
+        print("chi^2 ", chi2)
+        print("SN_ampl", parsed["SN_ampl"])
 
-print("parsed ", parsed)
-print("SNCmat ", SNCmat)
+        itr += 1
 
-f = open("results.txt", 'w')
+    assert itr > 0, "No iterations run!"
 
-f.write("version  " + str(version) + '\n') 
-f.write("chi^2  " + str(chi2) + '\n')
-n_pixels = (array(all_data["invvars"]) > 0).sum()
-f.write("Npixels  " + str(n_pixels) + '\n')
-f.write("DoF  " + str(n_pixels - len(Cmat)) + '\n')
-for pull_thresh in [5, 10, 20, 50]:
-    f.write("Npixels_with_pull_gt_" + str(pull_thresh) + "  " + str(sum(abs(pulls) > pull_thresh)) + '\n')
+    models = modelfn(parsed)#parsed, all_data, settings)
+    save_img(models, "models.fits")
+    save_img([(all_data["scidata"][i] - models[i])*(all_data["invvars"][i] > 0) for i in range(settings["n_img"])], "residuals.fits")
+    pulls = array([(all_data["scidata"][i] - models[i])*sqrt(all_data["invvars"][i]) for i in range(settings["n_img"])])
+    save_img(pulls, "pulls.fits")
 
+    pt_models = modelfn(parsed, just_pt_flux = 1)#parsed, all_data, settings)
+    save_img(pt_models, "pt_models.fits")
 
-f.write('\n')
-for i in range(settings["n_epoch"]):
     try:
-        f.write("SN_A%s  %f  %f\n" % (settings["epoch_names"][i+1], parsed["SN_ampl"][i], sqrt(SNCmat[i,i])))
-    except IndexError:
-        print(f'ERROR: SNCmat does not have supernova data')
-        continue
-
-f.write('\n')
-
+        SNCmat = parseCmat(Cmat, settings)
+    except:
+        SNCmat = zeros([len(parsed["SN_ampl"])]*2)
 
+    pickle.dump([all_data, parsed, settings, SNCmat, Cmat], gzip.open("fit_results.pickle", 'w'))
 
+    print("parsed ", parsed)
+    print("SNCmat ", SNCmat)
 
-for i in range(settings["n_epoch"]):
-    inds = where(settings["epochs"] == i+1)
+    f = open("results.txt", 'w')
 
-    f.write("MJD_%s  %f\n" % (settings["epoch_names"][i+1], mean(array(all_data["mjd"])[inds])))
+    f.write("version  " + str(version) + '\n') 
+    f.write("chi^2  " + str(chi2) + '\n')
+    n_pixels = (array(all_data["invvars"]) > 0).sum()
+    f.write("Npixels  " + str(n_pixels) + '\n')
+    f.write("DoF  " + str(n_pixels - len(Cmat)) + '\n')
+    for pull_thresh in [5, 10, 20, 50]:
+        f.write("Npixels_with_pull_gt_" + str(pull_thresh) + "  " + str(sum(abs(pulls) > pull_thresh)) + '\n')
 
-f.write('\n')
-f.write('\nCmat:\n')
 
-for i in range(settings["n_epoch"]):
-    for j in range(settings["n_epoch"]):
+    f.write('\n')
+    for i in range(settings["n_epoch"]):
         try:
-            f.write(str(SNCmat[i,j]) + "  ")
+            f.write("SN_A%s  %f  %f\n" % (settings["epoch_names"][i+1], parsed["SN_ampl"][i], sqrt(SNCmat[i,i])))
         except IndexError:
             print(f'ERROR: SNCmat does not have supernova data')
             continue
+
     f.write('\n')
 
-try:
-    SNWmat = linalg.inv(SNCmat)
-except:
-    SNWmat = SNCmat*0
 
-f.write('\nWmat:\n')
-for i in range(settings["n_epoch"]):
-    for j in range(settings["n_epoch"]):
-        try:
-            f.write(str(SNWmat[i,j]) + "  ")
-        except IndexError:
-            print(f'ERROR: SNWmat does not have supernova data')
-            continue
-    f.write('\n')
 
-f.write("PARSED_JSON_BELOW\n")
 
-for gal_ind in range(settings["n_gal"]):
-    parsed["coeffs"][gal_ind] = parsed["coeffs"][gal_ind].tolist()
+    for i in range(settings["n_epoch"]):
+        inds = where(settings["epochs"] == i+1)
+
+        f.write("MJD_%s  %f\n" % (settings["epoch_names"][i+1], mean(array(all_data["mjd"])[inds])))
+
+    f.write('\n')
+    f.write('\nCmat:\n')
+
+    for i in range(settings["n_epoch"]):
+        for j in range(settings["n_epoch"]):
+            try:
+                f.write(str(SNCmat[i,j]) + "  ")
+            except IndexError:
+                print(f'ERROR: SNCmat does not have supernova data')
+                continue
+        f.write('\n')
 
-for key in parsed:
     try:
-        parsed[key] = parsed[key].tolist()
+        SNWmat = linalg.inv(SNCmat)
     except:
-        pass
-    
+        SNWmat = SNCmat*0
 
-f.write(json.dumps(parsed) + '\n')
+    f.write('\nWmat:\n')
+    for i in range(settings["n_epoch"]):
+        for j in range(settings["n_epoch"]):
+            try:
+                f.write(str(SNWmat[i,j]) + "  ")
+            except IndexError:
+                print(f'ERROR: SNWmat does not have supernova data')
+                continue
+        f.write('\n')
+
+    f.write("PARSED_JSON_BELOW\n")
+
+    for gal_ind in range(settings["n_gal"]):
+        parsed["coeffs"][gal_ind] = parsed["coeffs"][gal_ind].tolist()
 
-f.close()
+    for key in parsed:
+        try:
+            parsed[key] = parsed[key].tolist()
+        except:
+            pass
+
+
+    f.write(json.dumps(parsed) + '\n')
+
+    f.close()
 
-print("Done!")
+    print("Done!")
 
 #P = initialize_fit(settings, all_data)
 #P = do_fit(P, all_data, settings)
@@ -1179,5 +2396,6 @@ print("Done!")
 # WFC3 IR: 2000 spline nodes * 1000 pixels * 100 images * 8 bytes/entry = 1.6 GB
 
 # Data volume for 5x oversampling: 1000 images * 256**2 * 8 bytes/entry * 2 RA/Dec = 1 GB
+# With lazy_grids: 1000 images * 2 * 6 coefficients * 8 bytes/entry = 96 kB, plus lazy_grids * 256**2 * 8 * 2 per worker
 
 # Speed test: 9 ms per model per image at 5x. So 18 s per image to build jacobian explictly (5 hours for Spitzer). Clear approach: parallelize over images.
@@ -102,4 +102,29 @@ base_dir            BBBBB
 
 SN_centroid_prior_arcsec    10
 iterative_centroid          1
+
+linear_jacobian             0   # 1 => exact Jacobian columns for 2D spline coeffs and SN amplitudes
+varpro                      0   # 1 => variable projection: LM over positions, linear parameters solved exactly (2D galaxies only)
+varpro_cache_MB             1000   # varpro keeps per-image JtJ, J^T r blocks up to this many MB (LRU)
+fft_backend                 "fftpack"   # "rfft" => batched real FFTs per PSF (python model_tools.py benchmarks both)
+fourier_shift               0   # 1 => render each galaxy once, apply dRA/dDec as FFT phase ramps (turns off linear_jacobian, analytic_centroids, varpro, gradient_1D_prefit)
+convolve_once               0   # 1 => one PSF for all images at one orientation: convolve the galaxy once, resample into each image
+psf_phases                  0   # N > 0 => pixelized PSFs interpolated from a table of N x N sub-pixel phases
+local_wcs                   0   # 1 => closed-form quadratic sky-to-pixel transforms instead of per-image RADec_to_i/j splines
+lazy_grids                  0   # N > 0 => store one quadratic per image instead of the oversampled RA/Dec grids; keep N regenerated grids per worker
+packed_pulls                0   # 1 => pulls/Jacobian rows only for pixels with invvar > 0 (images with none are skipped)
+sparse_jacobian             0   # 1 => finite-difference Jacobian columns only re-render the images each parameter affects
+color_jacobian              0   # 1 => difference parameters with disjoint pulls (e.g., all dRAs) in one model evaluation
+schur_solver                0   # 1 => solve LM steps by eliminating the per-image (dRA, dDec) blocks (Schur complement)
+reuse_factorization         0   # 1 => one eigendecomposition per LM Jacobian for all damping trials (no effect with schur_solver)
+lambda_ladder               0   # n > 0 => each LM Jacobian tries n damping values at once (lam/2, lam, 2 lam, ...), keeps the best
+matrix_free                 0   # k > 0 => matrix-free LM: steps from a k-dimensional Krylov subspace of J.v, J^T.u products, no stored Jacobian (not with fourier_shift / convolve_once)
+stream_jacobian_MB          0   # M > 0 => LM accumulates JtJ, J^T r over chunks of images (at most M MB of Jacobian rows in memory)
+broyden_updates             0   # n > 0 => up to n rank-one (Broyden) LM Jacobian updates between full rebuilds
+broyden_tolerance           0.5 # rebuild the Jacobian when |actual/predicted chi^2 reduction - 1| exceeds this
+parallel_simplex            0   # 1 => 1D pre-fit evaluates all simplex trial points (and shrinks, starts) in one pool.map
+analytic_centroids          0   # 1 => dRA/dDec and SN-offset Jacobian columns from spline/PSF gradients (uses linear_jacobian)
+component_cache             0   # N > 0 => keep the last N convolved galaxies (per image, coeffs, dRA/dDec) and only re-render the rest; N >= n_img to hit every image
+gradient_1D_prefit          0   # 1 => the 1D pre-fit is an LM fit with analytic derivatives (amplitudes, axis ratio, orientation) instead of Nelder-Mead
+parallel_centroid           0   # 1 => with iterative_centroid, the per-image centroid fits run concurrently, one image per worker
 """.format(data_dir=data_dir)
@@ -21,11 +21,17 @@ from scipy.stats import scoreatpercentile
 from astropy import wcs
 from scipy import fftpack as ft
 from DavidsNM import save_img, miniLM_new, miniNM_new
+from model_tools import psf_phase_table
 import gzip
 import pickle as pickle
 import time
 import json
 
+version = 1.35
+
+# version history (numbered like new_phot.py, which this script follows):
+# 1.35 10-17-2026: Added psf_phases: pixelized PSFs looked up in a table of sub-pixel phases instead of resampled each call
+
 def parse_line(line):
     parsed = line.split("#")[0]
     parsed = parsed.split(None)
@@ -86,6 +92,11 @@ def finish_settings(settings):
     except:
         settings["iterative_centroid"] = 0
 
+    try:
+        settings["psf_phases"]
+    except:
+        settings["psf_phases"] = 0
+
     if settings["iterative_centroid"] and settings["fitSNoffset"]:
         assert 0, "Can't iterate a SN centroid. All images must be fit!"
 
@@ -273,6 +284,7 @@ def get_PSFs(settings):
 
     all_data["psf_FFTs"] = {}
     all_data["psf_subpixelized"] = {}
+    all_data["psf_tables"] = {}
 
     basedir = settings["base_dir"]
 
@@ -338,6 +350,8 @@ def get_PSFs(settings):
         psfdata = array(real(ft.ifft2(ft.fft2(psfdata_odd) * ft.fft2(recenter))), dtype=float64)
 
         all_data["psf_subpixelized"][psf] = psfdata
+        if settings["psf_phases"]:
+            all_data["psf_tables"][psf] = psf_phase_table(psfdata, settings["oversample"], settings["psf_phases"])
 
         save_img(all_data["psf_subpixelized"][psf], os.path.join(basedir, "psf_subpixelized.fits"))
 
@@ -430,6 +444,9 @@ def make_pixelized_PSF(parsed, i):
     icoord = all_data["RADec_to_i"][i](parsed["pt_RA"][i], parsed["pt_Dec"][i])[0,0]
     jcoord = all_data["RADec_to_j"][i](parsed["pt_RA"][i], parsed["pt_Dec"][i])[0,0]
 
+    if settings["psf_phases"]:
+        return all_data["psf_tables"][settings["psfs"][i]](icoord, jcoord, settings["patch"])
+
     j2d, i2d = meshgrid(arange(settings["patch"], dtype=float64)*settings["oversample"],
                         arange(settings["patch"], dtype=float64)*settings["oversample"])
 
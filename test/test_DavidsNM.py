@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# Checks of the linear-algebra helpers in analysis/DavidsNM.py.
+# Run with: python test/test_DavidsNM.py (or python -m pytest test/test_DavidsNM.py)
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from numpy import *
+import analysis.DavidsNM as DavidsNM
+import analysis.NM as NM
+import multiprocessing
+from analysis.DavidsNM import color_columns, block_arrow_system, scaled_eigen_system, miniLM, miniNM_new
+
+
+def test_color_columns():
+    random.seed(4)
+    datalen = 60
+    sparsity = [sort(random.choice(datalen, size = random.randint(1, 8), replace = False)) for j in range(40)]
+
+    groups = color_columns(sparsity, datalen)
+
+    # Every column exactly once
+    assert sorted(concatenate(groups)) == list(range(len(sparsity)))
+
+    # No two columns in a group share a row
+    for group in groups:
+        rows = concatenate([sparsity[j] for j in group])
+        assert len(unique(rows)) == len(rows)
+
+    # Disjoint columns (e.g., per-image offsets) all go in one group
+    assert len(color_columns([arange(5*j, 5*j + 5) for j in range(10)], 50)) == 1
+
+
+def damped(JtJ, lam):
+    """miniLM's damping: the diagonal scaled by 1 + lam."""
+    JtJ_lam = array(JtJ)
+    JtJ_lam[diag_indices(len(JtJ))] *= 1. + lam
+    return JtJ_lam
+
+
+def block_arrow_setup(n_glob = 4, n_block = 5, block_size = 2, rows_per_block = 12):
+    """JtJ of a Jacobian whose rows for image k depend on the global parameters and image k's own block only. The
+    global parameters are interleaved with the blocks, as in new_phot_elliptical's parameter layout."""
+    random.seed(5)
+    n_param = n_glob + n_block*block_size
+    order = random.permutation(n_param)
+    glob = order[:n_glob]
+    blocks = [order[n_glob + k*block_size: n_glob + (k + 1)*block_size] for k in range(n_block)]
+
+    J = zeros([n_block*rows_per_block, n_param], dtype=float64)
+    for k, block in enumerate(blocks):
+        rows = slice(k*rows_per_block, (k + 1)*rows_per_block)
+        J[rows, glob] = random.normal(size = [rows_per_block, n_glob])
+        J[rows, block] = random.normal(size = [rows_per_block, block_size])*10.**random.uniform(-2, 2)
+    return dot(transpose(J), J), blocks
+
+
+def test_block_arrow_system():
+    JtJ, blocks = block_arrow_setup()
+    system = block_arrow_system(JtJ, blocks)
+    rhs = random.normal(size = len(JtJ))
+
+    for lam in [0., 1e-3, 1., 1e3]:
+        reference = linalg.solve(damped(JtJ, lam), rhs)
+        assert abs(system.solve(rhs, lam) - reference).max() < 1e-8*abs(reference).max(), lam
+
+    reference = linalg.inv(JtJ)
+    assert abs(system.inverse() - reference).max() < 1e-8*abs(reference).max()
+
+
+def test_scaled_eigen_system():
+    random.seed(6)
+    # Badly scaled columns, as with spline coeffs next to SN amplitudes and offsets
+    J = random.normal(size = [40, 12])*10.**random.uniform(-3, 3, size = 12)
+    JtJ = dot(transpose(J), J)
+    system = scaled_eigen_system(JtJ)
+    rhs = random.normal(size = len(JtJ))
+
+    for lam in [0., 1e-3, 1., 1e3]:
+        reference = linalg.solve(damped(JtJ, lam), rhs)
+        assert abs(system.solve(rhs, lam) - reference).max() < 1e-8*abs(reference).max(), lam
+
+
+def exp_residuals(P, merged_list):
+    xs, ys = merged_list[0]
+    return P[0]*exp(-P[1]*xs) + P[2] - ys
+
+
+def exp_jacobian(P, xs):
+    return transpose([exp(-P[1]*xs), -P[0]*xs*exp(-P[1]*xs), ones(len(xs))])
+
+
+def test_miniLM_broyden_wmat():
+    random.seed(7)
+    xs = linspace(0., 4., 30)
+    ys = 3.*exp(-1.3*xs) + 0.5 + random.normal(size = len(xs))*0.01
+
+    # Broyden updates for every step the linearization allows; the loop ends on maxlam, not maxiter
+    P, F, JtJ = miniLM([1., 1., 0.], [exp_residuals, None, (xs, ys)], [0.1, 0.1, 0.1], False, maxiter = 1000,
+                       return_wmat = True, use_dense_J = True, save_jacobian = False, broyden_updates = 1000,
+                       broyden_tolerance = 10.)
+
+    J = exp_jacobian(P[0], xs)
+    assert abs(JtJ - dot(transpose(J), J)).max() < 1e-5*abs(dot(transpose(J), J)).max()
+
+
+def test_miniLM_ladder_keeps_system():
+    random.seed(7)
+    xs = linspace(0., 4., 30)
+    ys = 3.*exp(-1.3*xs) + 0.5 + random.normal(size = len(xs))*0.01
+
+    calls = dict(jacobian = 0, system = 0)
+    def counted_jacobian(P, displ_list, merged_list):
+        calls["jacobian"] += 1
+        return exp_jacobian(P, xs)
+    def counted_system(JtJ):
+        calls["system"] += 1
+        return scaled_eigen_system(JtJ)
+
+    # The fit ends with failed ladders raising lam to maxlam; those must reuse the last factorization
+    DavidsNM.scaled_eigen_system = counted_system
+    try:
+        P, F = miniLM([1., 1., 0.], [exp_residuals, None, (xs, ys)], [0.1, 0.1, 0.1], False, use_dense_J = True,
+                      save_jacobian = False, jacobian_fn = counted_jacobian, reuse_factorization = True, lambda_ladder = 3)
+    finally:
+        DavidsNM.scaled_eigen_system = scaled_eigen_system
+
+    assert calls["system"] == calls["jacobian"]
+    assert abs(P[0] - [3., 1.3, 0.5]).max() < 0.05
+
+
+def blocks_residuals(P, merged_list):
+    # Two global parameters, then (decay rate, offset) for each of three curves: a block-arrow problem
+    xs, ys = merged_list[0]
+    return concatenate([P[0]*exp(-P[2 + 2*k]*xs) + P[1]*xs + P[3 + 2*k] - ys[k] for k in range(len(ys))])
+
+
+def test_miniLM_broyden_local_blocks():
+    random.seed(5)
+    xs = linspace(0., 4., 20)
+    ys = [2.*exp(-rate*xs) + 0.3*xs + offset + random.normal(size = len(xs))*0.01 for rate, offset in [(0.8, 0.1), (1.2, -0.2), (1.6, 0.4)]]
+    local_blocks = [[2 + 2*k, 3 + 2*k] for k in range(3)]
+
+    # A rank-one update fills the cross-blocks block_arrow_system drops, so Broyden is off with local_blocks
+    fits = [miniLM([1., 0., 1., 0., 1., 0., 1., 0.], [blocks_residuals, None, (xs, ys)], [0.1]*8, False, use_dense_J = True,
+                   save_jacobian = False, local_blocks = local_blocks, broyden_updates = broyden_updates, broyden_tolerance = 10.)
+            for broyden_updates in [0, 1000]]
+    assert all(fits[0][0] == fits[1][0])
+    assert abs(fits[0][0][0][[0, 1, 2, 4, 6]] - [2., 0.3, 0.8, 1.2, 1.6]).max() < 0.05
+
+    # NM.py's copy (residuals called as modelfn(P, *merged_list, pool = pool))
+    NM_residuals = lambda P, xs, ys, pool = None: blocks_residuals(P, [(xs, ys)])
+    NM_fits = [NM.miniLM([1., 0., 1., 0., 1., 0., 1., 0.], [NM_residuals, xs, ys], [0.1]*8, False, use_dense_J = True,
+                         save_jacobian = False, local_blocks = local_blocks, broyden_updates = broyden_updates, broyden_tolerance = 10.)
+               for broyden_updates in [0, 1000]]
+    assert all(NM_fits[0][0] == NM_fits[1][0])
+    assert abs(NM_fits[0][0] - fits[0][0]).max() < 1e-10
+
+
+def quadratic_chi2(P, merged_list):
+    center, scales = merged_list[0]
+    return sum(((P - center)/scales)**2.) + 0.3*(P[0] - center[0])*(P[1] - center[1])/(scales[0]*scales[1])
+
+
+def quadratic_chi2_batch(P_list, merged_list):
+    return [quadratic_chi2(P, merged_list) for P in P_list]
+
+
+def test_parallel_miniNM_matches_serial():
+    passdata = (array([1., -2., 0.5]), array([1., 3., 0.2]))
+    serial = miniNM_new([0., 0., 0.], [0.5, 0.5, 0.5], passdata, chi2fn = quadratic_chi2, compute_Cmat = False)
+    assert abs(serial[0] - passdata[0]).max() < 1e-3
+
+    # Batched trial points, then the same over a pool
+    batched = miniNM_new([0., 0., 0.], [0.5, 0.5, 0.5], passdata, chi2fn = quadratic_chi2, compute_Cmat = False, batch_chi2fn = quadratic_chi2_batch)
+    pool = multiprocessing.Pool(processes = 2)
+    try:
+        pooled = miniNM_new([0., 0., 0.], [0.5, 0.5, 0.5], passdata, chi2fn = quadratic_chi2, compute_Cmat = False, pool = pool)
+    finally:
+        pool.terminate()
+
+    for fit in [batched, pooled]:
+        assert all(fit[0] == serial[0]) and fit[1] == serial[1]
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_"):
+            fn()
+            print(name, "passed")
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# Checks of analysis/model_tools.py against the direct computations in new_phot_elliptical.py.
+# Run with: python test/test_model_tools.py (or python -m pytest test/test_model_tools.py)
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from numpy import *
+from scipy.ndimage import map_coordinates, spline_filter
+from scipy import fftpack as ft
+from astropy import wcs
+from analysis.model_tools import galaxy_operator, coeff_mask, psf_phase_table, fit_sky_to_pixel, sky_to_pixel, sky_to_pixel_derivs, spline_gradient, oneD_spline, oneD_spline_deriv, oneD_spline_basis, shift_phase_ramp
+
+
+def make_psf_FFT(padsize, width = 2.5):
+    """FFT of a normalized Gaussian centered on pixel 0 (what get_PSFs hands indiv_model)."""
+    offsets = (arange(padsize) + padsize//2) % padsize - padsize//2
+    xs, ys = meshgrid(offsets, offsets, indexing = "ij")
+    psf = exp(-0.5*(xs**2. + ys**2.)/width**2.)
+    return ft.fft2(psf/psf.sum())
+
+
+def galaxy_setup(radius = 4, oversample = 3, patch = 7, seed = 1):
+    random.seed(seed)
+    padsize = oversample*patch + 4
+    xs, ys = meshgrid(arange(padsize, dtype=float64), arange(padsize, dtype=float64), indexing = "ij")
+    # Rotated, slightly sheared grid, running off the edges of the spline grid
+    xs, ys = 0.37*xs + 0.05*ys - 1.3, -0.04*xs + 0.41*ys - 0.8
+    coeffs = random.normal(size = [2*radius + 1]*2)*coeff_mask(radius)
+    psf_FFT = make_psf_FFT(padsize)
+    return galaxy_operator(xs, ys, radius, psf_FFT, oversample, patch), coeffs, xs, ys, psf_FFT
+
+
+def test_galaxy_operator_matvec():
+    G, coeffs, xs, ys, psf_FFT = galaxy_setup()
+
+    # What indiv_model does
+    filtered = spline_filter(coeffs, order = 2, mode = "constant")
+    subsampled_model = map_coordinates(filtered, coordinates = [ravel(xs), ravel(ys)], order = 2, mode = "constant", cval = 0, prefilter = False)
+    convolved = real(ft.ifft2(ft.fft2(reshape(subsampled_model, xs.shape))*psf_FFT))
+    convolved = convolved[G.oversample2::G.oversample, G.oversample2::G.oversample][:G.patch, :G.patch]
+
+    assert abs(G.matvec(coeffs) - convolved).max() < 1e-10*abs(convolved).max()
+
+
+def test_galaxy_operator_dense():
+    G, coeffs, xs, ys, psf_FFT = galaxy_setup()
+    mask = coeff_mask(G.radius)
+
+    dense = G.dense()
+    assert dense.shape == (G.patch**2, mask.sum())
+    assert abs(dot(dense, coeffs[mask]) - ravel(G.matvec(coeffs))).max() < 1e-10*abs(G.matvec(coeffs)).max()
+
+
+def test_galaxy_operator_adjoint():
+    G, coeffs, xs, ys, psf_FFT = galaxy_setup()
+    pixels = random.normal(size = [G.patch]*2)
+
+    lhs = sum(pixels*G.matvec(coeffs))
+    rhs = sum(coeffs*G.rmatvec(pixels))
+    assert abs(lhs - rhs) < 1e-10*abs(lhs)
+
+
+def test_spline_gradient():
+    random.seed(3)
+    filtered = spline_filter(random.normal(size = [9, 9]), order = 2, mode = "constant")
+    # Inside the grid, including next to its edges (where map_coordinates mirrors the coefficients)
+    xs = concatenate((random.uniform(0.5, 7.5, size = 20), [0.2, 7.8, 3.3, 0.1]))
+    ys = concatenate((random.uniform(0.5, 7.5, size = 20), [4.1, 2.6, 7.9, 0.3]))
+
+    sample = lambda xs, ys: map_coordinates(filtered, coordinates = [xs, ys], order = 2, mode = "constant", cval = 0, prefilter = False)
+    h = 1e-6
+    d_dxs, d_dys = spline_gradient(filtered, xs, ys)
+    assert abs(d_dxs - (sample(xs + h, ys) - sample(xs - h, ys))/(2*h)).max() < 1e-6*abs(d_dxs).max()
+    assert abs(d_dys - (sample(xs, ys + h) - sample(xs, ys - h))/(2*h)).max() < 1e-6*abs(d_dys).max()
+
+    # Zero off the grid (map_coordinates returns cval there)
+    d_dxs, d_dys = spline_gradient(filtered, array([-0.5, 3., 8.5]), array([3., 9.2, 3.]))
+    assert all(d_dxs == 0) and all(d_dys == 0)
+
+
+def pixelized_PSF(psf_subpixelized, icoord, jcoord, oversample, patch):
+    """What make_pixelized_PSF does without psf_phases."""
+    j2d, i2d = meshgrid(arange(patch, dtype=float64)*oversample, arange(patch, dtype=float64)*oversample)
+    i2d -= icoord*oversample - floor(len(psf_subpixelized)/2.)
+    j2d -= jcoord*oversample - floor(len(psf_subpixelized)/2.)
+
+    filtered = spline_filter(psf_subpixelized, order = 2, mode = "constant")
+    return reshape(map_coordinates(filtered, coordinates = [ravel(i2d), ravel(j2d)], order = 2, mode = "constant", cval = 0, prefilter = False), [patch, patch])
+
+
+def phase_setup(oversample = 3, patch = 9, n_phase = 32):
+    offsets = arange(43, dtype=float64) - 21
+    xs, ys = meshgrid(offsets, offsets, indexing = "ij")
+    psf = exp(-0.5*((xs - 0.3)**2. + ys**2.)/4.**2.)*(1 + 0.2*xs/21.)
+    return psf, psf_phase_table(psf, oversample, n_phase)
+
+
+def test_psf_phase_table():
+    psf, table = phase_setup()
+
+    # Exact on the tabulated phases, bilinear in between
+    for icoord, jcoord, tolerance in [(4. + 5./32, 3. + 20./32, 1e-10), (4.37, 3.81, 2e-4), (0.6, 7.9, 2e-4)]:
+        reference = pixelized_PSF(psf, icoord, jcoord, 3, 9)
+        assert abs(table(icoord, jcoord, 9) - reference).max() < tolerance*reference.max(), (icoord, jcoord)
+
+
+def test_psf_phase_table_derivs():
+    psf, table = phase_setup()
+    icoord, jcoord, h = 4.37, 3.81, 1e-5
+
+    dpsf_di, dpsf_dj = table.derivs(icoord, jcoord, 9)
+
+    # Derivatives of the interpolant itself (both points inside one phase cell)...
+    fd_i = (table(icoord + h, jcoord, 9) - table(icoord - h, jcoord, 9))/(2*h)
+    fd_j = (table(icoord, jcoord + h, 9) - table(icoord, jcoord - h, 9))/(2*h)
+    assert abs(dpsf_di - fd_i).max() < 1e-7*abs(fd_i).max()
+    assert abs(dpsf_dj - fd_j).max() < 1e-7*abs(fd_j).max()
+
+    # ... which approximate those of make_pixelized_PSF
+    fd_i = (pixelized_PSF(psf, icoord + h, jcoord, 3, 9) - pixelized_PSF(psf, icoord - h, jcoord, 3, 9))/(2*h)
+    fd_j = (pixelized_PSF(psf, icoord, jcoord + h, 3, 9) - pixelized_PSF(psf, icoord, jcoord - h, 3, 9))/(2*h)
+    assert abs(dpsf_di - fd_i).max() < 0.03*abs(fd_i).max()
+    assert abs(dpsf_dj - fd_j).max() < 0.03*abs(fd_j).max()
+
+
+def wcs_setup(patch = 15, Dec0 = 62.):
+    w = wcs.WCS(naxis = 2)
+    w.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+    w.wcs.crval = [150.1, Dec0]
+    w.wcs.crpix = [40., 60.]
+    # 0.6"/pixel, rotated by 20 degrees, slightly sheared
+    w.wcs.cd = 0.6/3600.*array([[-cos(0.35), sin(0.35)], [sin(0.35) + 0.02, cos(0.35)]])
+
+    # The patch read_image samples: pixel_sampled_RAs[i, j] is at x = j + x0, y = i + y0 (FITS pixels)
+    x0, y0 = 52.3 - (patch - 1)/2., 71.8 - (patch - 1)/2.
+    subxs, subys = meshgrid(arange(patch, dtype=float64) + x0, arange(patch, dtype=float64) + y0)
+    RAs, Decs = w.all_pix2world(subxs, subys, 1)
+    RA0, Dec0 = w.all_pix2world([[52.3, 71.8]], 1)[0]
+    return w, RAs, Decs, RA0, Dec0, x0, y0
+
+
+def test_fit_sky_to_pixel():
+    w, RAs, Decs, RA0, Dec0, x0, y0 = wcs_setup()
+    sky_to_pix = fit_sky_to_pixel(RAs, Decs, RA0, Dec0)
+
+    random.seed(2)
+    xs = x0 + random.uniform(0, 14, size = 5)
+    ys = y0 + random.uniform(0, 14, size = 5)
+    test_RAs, test_Decs = w.all_pix2world(xs, ys, 1)
+
+    n = len(xs)
+    icoords, jcoords = sky_to_pixel(array([sky_to_pix]*n), array([RA0]*n), array([Dec0]*n), test_RAs, test_Decs)
+    assert abs(icoords - (ys - y0)).max() < 1e-7
+    assert abs(jcoords - (xs - x0)).max() < 1e-7
+
+    derivs = sky_to_pixel_derivs(array([sky_to_pix]*n), array([RA0]*n), array([Dec0]*n), test_RAs, test_Decs)
+    h = 1e-6
+    for k, (dRA, dDec) in enumerate([(h, 0.), (0., h)]):
+        plus = w.all_world2pix(test_RAs + dRA, test_Decs + dDec, 1)
+        minus = w.all_world2pix(test_RAs - dRA, test_Decs - dDec, 1)
+        assert abs(derivs[:, 0, k] - (plus[1] - minus[1])/(2*h)).max() < 1e-6*abs(derivs).max()
+        assert abs(derivs[:, 1, k] - (plus[0] - minus[0])/(2*h)).max() < 1e-6*abs(derivs).max()
+
+
+def loop_oneD_spline(amplarray, spacingarray, rarray, deriv_not_value = 0):
+    """new_phot_elliptical.py's oneD_spline / oneD_spline_deriv before they were vectorized: one pass per segment."""
+    deriv = 0. # flat at infinity
+    sarray = 0.*rarray
+
+    for i in range(len(amplarray) - 1)[::-1]:
+        d2 = deriv
+        x1 = spacingarray[i]
+        x2 = spacingarray[i + 1] # larger
+        y1 = amplarray[i]
+        y2 = amplarray[i + 1]
+
+        A = (d2*(-x1 + x2) + y1 - y2)/(x1 - x2)**2.
+        B = (d2*(x1**2. - x2**2.) + 2.*x2*(-y1 + y2))/(x1 - x2)**2.
+        C = (d2*x1*x2*(-x1 + x2) + x2**2.*y1 + x1**2.*y2 - 2.*x1*x2*y2)/(x1 - x2)**2.
+
+        if deriv_not_value:
+            sarray += (2.*A*rarray + B)*(rarray >= x1)*(rarray < x2)
+        else:
+            sarray += (A*rarray**2. + B*rarray + C)*(rarray >= x1)*(rarray < x2)
+
+        deriv = (-(d2*x1) + d2*x2 + 2.*y1 - 2.*y2)/(x1 - x2)
+
+    if not deriv_not_value:
+        sarray += amplarray[-1]*(rarray >= spacingarray[-1]) # constant after last space
+    return sarray
+
+
+def oneD_setup():
+    # The spacing finish_settings uses for patch = 15
+    spacingarray = 10.*sinh(arange(0., 30.)/10.)
+    spacingarray = spacingarray[where(spacingarray < 15*0.7)]
+
+    random.seed(8)
+    amplarray = exp(-spacingarray/3.) + random.normal(size = len(spacingarray))*0.05
+    # A 2D grid of radii, including the knots themselves and radii past the last one
+    rarray = array([concatenate((random.uniform(0., 14., size = 40), spacingarray, [0., 12., 20.]))]*2)
+    return amplarray, spacingarray, rarray
+
+
+def test_oneD_spline():
+    amplarray, spacingarray, rarray = oneD_setup()
+
+    reference = loop_oneD_spline(amplarray, spacingarray, rarray)
+    assert oneD_spline(amplarray, spacingarray, rarray).shape == rarray.shape
+    assert abs(oneD_spline(amplarray, spacingarray, rarray) - reference).max() < 1e-12*abs(reference).max()
+
+    reference = loop_oneD_spline(amplarray, spacingarray, rarray, deriv_not_value = 1)
+    assert abs(oneD_spline_deriv(amplarray, spacingarray, rarray) - reference).max() < 1e-12*abs(reference).max()
+
+
+def test_oneD_spline_basis():
+    amplarray, spacingarray, rarray = oneD_setup()
+
+    basis = oneD_spline_basis(spacingarray, rarray)
+    assert basis.shape == (len(amplarray),) + rarray.shape
+    for k in range(len(amplarray)):
+        assert abs(basis[k] - loop_oneD_spline(identity(len(amplarray))[k], spacingarray, rarray)).max() < 1e-12
+
+    assert abs(tensordot(amplarray, basis, 1) - oneD_spline(amplarray, spacingarray, rarray)).max() < 1e-12
+
+
+def test_shift_phase_ramp():
+    from scipy import fft as sp_fft
+    random.seed(2)
+    img = random.random(size = [16, 12])
+
+    # Two half-step shifts are one whole step, and a whole step is a roll (but for the zeroed Nyquist terms)
+    half = sp_fft.irfft2(sp_fft.rfft2(img)*shift_phase_ramp(img.shape, [0.5, -0.5]), s = img.shape)
+    twice = sp_fft.irfft2(sp_fft.rfft2(half)*shift_phase_ramp(img.shape, [0.5, -0.5]), s = img.shape)
+    whole = sp_fft.irfft2(sp_fft.rfft2(img)*shift_phase_ramp(img.shape, [1., -1.]), s = img.shape)
+    assert abs(twice - whole).max() < 1e-12
+
+    assert abs(whole - roll(sp_fft.irfft2(sp_fft.rfft2(img)*shift_phase_ramp(img.shape, [0., 0.]), s = img.shape), (1, -1), axis = (0, 1))).max() < 1e-12
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_"):
+            fn()
+            print(name, "passed")
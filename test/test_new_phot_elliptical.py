@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# Checks of the model and Jacobian functions in analysis/new_phot_elliptical.py, on a small synthetic dataset.
+# Run with: python test/test_new_phot_elliptical.py (or python -m pytest test/test_new_phot_elliptical.py)
+import os
+import sys
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "analysis"))
+import multiprocessing
+from numpy import *
+from astropy.io import fits
+from astropy import wcs
+from scipy.stats import scoreatpercentile
+import new_phot_elliptical as npe
+from DavidsNM import miniLM_new, Jacobian, grouped_Jacobian, color_columns, normal_matrix
+
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+
+
+def write_dataset(outdir, n_img = 4, rotations = (0., 15., 30., 40.), oversample = 3, gal_type = "2D", extra = ""):
+    """A galaxy plus a SN in n_img 48x48 frames (rotated by rotations, in degrees), a Gaussian PSF and a paramfile."""
+    rng = random.RandomState(1)
+    RA0, Dec0 = 150., 2.
+
+    offsets = arange(-20*oversample, 20*oversample + 1)
+    xs, ys = meshgrid(offsets, offsets)
+    psf = exp(-0.5*(xs**2. + (1.1*ys)**2.)/(1.1*oversample)**2.)
+    psf /= psf.sum()/oversample**2.
+    fits.PrimaryHDU(psf).writeto(os.path.join(outdir, "psf.fits"), overwrite = True)
+
+    images = []
+    epochs = []
+    for i in range(n_img):
+        w = wcs.WCS(naxis = 2)
+        w.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+        w.wcs.crval = [RA0, Dec0]
+        w.wcs.crpix = [24.3 + rng.uniform(-2, 2), 23.7 + rng.uniform(-2, 2)]
+        theta = radians(rotations[i % len(rotations)])
+        scale = 1.2/3600.
+        w.wcs.cd = array([[-scale*cos(theta), scale*sin(theta)], [scale*sin(theta), scale*cos(theta)]])
+
+        yy, xx = mgrid[:48, :48]
+        RAs, Decs = w.all_pix2world(xx, yy, 0)
+        dx = (RAs - RA0)*cos(radians(Dec0))*3600.
+        dy = (Decs - Dec0)*3600.
+        epoch = [0, 1, 1, 2][i % 4]
+        SN = [0., 30., 60.][epoch]*exp(-0.5*((dx - 1.)**2. + (dy + 0.5)**2.)/1.5**2.)/(2*pi*(1.5/1.2)**2.)
+        err = ones([48, 48])*0.5
+        sci = 50.*exp(-0.5*(dx**2./4.**2. + dy**2./2.5**2.)) + SN + 3. + rng.normal(size = [48, 48])*err
+        dq = zeros([48, 48], dtype = int32)
+        dq[22, 25] = 4
+
+        primary = fits.PrimaryHDU()
+        primary.header["EXPSTART"] = 58000. + 10*epoch
+        primary.header["EXPEND"] = 58000.01 + 10*epoch
+        header = w.to_header()
+        images.append(os.path.join(outdir, "img%i.fits" % i))
+        fits.HDUList([primary, fits.ImageHDU(sci, header = header), fits.ImageHDU(err, header = header), fits.ImageHDU(dq, header = header)]).writeto(images[-1], overwrite = True)
+        epochs.append(epoch)
+
+    paramfile = os.path.join(outdir, "paramfile.txt")
+    f = open(paramfile, 'w')
+    f.write('\n'.join(["oversample  %i" % oversample, "renormpsf  0", "psf_has_pix  1", "fitSNoffset  0", "patch  11", "n_cpu  2", "n_iter  2",
+                       "n_gal  1", 'gal_type  "%s"' % gal_type, "sndRA_offset  0.0", "sndDec_offset  0.0", "RA0  %f" % RA0, "Dec0  %f" % Dec0,
+                       "images  " + str(images), "sciext  1", "errext  2", "dqext  3", "okaydqs  [0]", "maskdqs  [32]", "errscale  1.0",
+                       "epochs  " + str(epochs), "psfs  " + str([os.path.join(outdir, "psf.fits")]*n_img), "splineradius  3",
+                       "splinepixelscale  0.00035", "apodize  1", 'pixel_area_map  "%s"' % os.path.join(data_dir, "blank_pam.fits"),
+                       'bad_pixel_list  "%s"' % os.path.join(data_dir, "blank_bad_pixel_list.txt"), 'base_dir  "%s"' % outdir,
+                       "SN_centroid_prior_arcsec  10", "iterative_centroid  0", extra, ""]))
+    f.close()
+    return paramfile
+
+
+def setup(extra = "", **kwargs):
+    """Read a fresh synthetic dataset into new_phot_elliptical's globals the way its driver does (with new worker
+    processes, which see the globals as they are now), and return the driver's starting parsed, with the images offset."""
+
+    outdir = tempfile.mkdtemp()
+    paramfile = write_dataset(outdir, extra = extra, **kwargs)
+
+    cwd = os.getcwd()
+    os.chdir(outdir) # get_PSFs saves its subpixelized PSF in the working directory
+    try:
+        settings = npe.finish_settings(npe.read_paramfile(paramfile))
+        all_data = npe.get_data(settings, npe.get_PSFs(settings))
+    finally:
+        os.chdir(cwd)
+    settings["flux_scale"] = scoreatpercentile(all_data["scidata"], 99)
+
+    if getattr(npe, "pool", None) is not None:
+        npe.pool.terminate()
+    npe.component_cache.clear()
+    npe.sky_grid_cache.clear()
+    npe.fourier_cache.update(key = None, spectra = {})
+    npe.convolve_once_cache.update(key = None, filtered_model = None)
+    npe.varpro_cache.update(keys = None, JtJ = None, Jtr = None, blocks = npe.OrderedDict(), nbytes = 0)
+
+    npe.settings = settings
+    npe.all_data = all_data
+    npe.pool = multiprocessing.Pool(processes = 2)
+
+    parsed = npe.load_galaxy_coeffs({}, do_init = 1, do_fit = None)
+    parsed["dRA"] = linspace(-1., 1., settings["n_img"])*0.2/3600.
+    parsed["dDec"] = linspace(1., -1., settings["n_img"])*0.1/3600.
+    parsed["sndRA_offset"] = settings["sndRA_offset"]
+    parsed["sndDec_offset"] = settings["sndDec_offset"]
+    parsed["SN_ampl"] = ones(settings["n_epoch"], dtype=float64)*settings["flux_scale"]
+    return npe.parseP(npe.unparseP(parsed, settings), settings)
+
+
+def linear_miniscale():
+    """LM step scales over the parameters the model is linear in (the 2D spline coeffs and SN amplitudes)."""
+    miniscale_parsed = dict(SN_ampl = ones(npe.settings["n_epoch"], dtype=float64)*npe.settings["flux_scale"], sndRA_offset = 0, sndDec_offset = 0,
+                            dRA = zeros(npe.settings["n_img"], dtype=float64), dDec = zeros(npe.settings["n_img"], dtype=float64))
+    return npe.unparseP(npe.load_galaxy_coeffs(miniscale_parsed, do_init = 0, do_fit = [1]), npe.settings)
+
+
+def test_varpro_matches_LM():
+    parsed = setup("varpro  1")
+    P = npe.unparseP(parsed, npe.settings)
+
+    P_varpro, pulls_varpro = npe.solve_linear_params(P)
+
+    P_LM, F, NA = miniLM_new(ministart = P, miniscale = linear_miniscale(), residfn = npe.pull_FN_wrapper, passdata = list(range(npe.settings["n_img"])),
+                             maxiter = 20, use_dense_J = True, jacobian_fn = npe.linear_jacobian)
+    pulls_LM = npe.pull_FN(npe.parseP(P_LM, npe.settings))
+
+    assert abs(dot(pulls_varpro, pulls_varpro)/dot(pulls_LM, pulls_LM) - 1.) < 1e-6
+    assert abs(npe.parseP(P_varpro, npe.settings)["SN_ampl"] - npe.parseP(P_LM, npe.settings)["SN_ampl"]).max() < 1e-4*npe.settings["flux_scale"]
+
+
+def test_fourier_shift_matches_indiv_model():
+    parsed = setup("fourier_shift  1")
+
+    for pixels in [0.1, 0.45, 0.8]:
+        parsed["dRA"] = linspace(-1., 1., npe.settings["n_img"])*pixels*1.2/3600.
+        parsed["dDec"] = linspace(0.7, -1., npe.settings["n_img"])*pixels*1.2/3600.
+
+        models = npe.modelfn(parsed)
+        filtered = npe.prefilter_coeffs(parsed)
+        for i in range(npe.settings["n_img"]):
+            direct = npe.indiv_model((i, filtered, 0))
+            assert abs(models[i] - direct).max() < 3e-3*ptp(direct)
+
+
+def test_convolve_once_rotated_frames():
+    # Frames rotated relative to image 0 fall back to the per-image render
+    parsed = setup("convolve_once  1")
+    assert npe.settings["convolve_once"] == 0
+
+    models = npe.modelfn(parsed)
+    filtered = npe.prefilter_coeffs(parsed)
+    for i in range(npe.settings["n_img"]):
+        assert all(models[i] == npe.indiv_model((i, filtered, 0)))
+
+    # Frames sharing image 0's orientation keep convolve_once, which then matches it
+    parsed = setup("convolve_once  1", rotations = (20.,))
+    assert npe.settings["convolve_once"] == 1
+
+    models = npe.modelfn(parsed)
+    filtered = npe.prefilter_coeffs(parsed)
+    for i in range(npe.settings["n_img"]):
+        direct = npe.indiv_model((i, filtered, 0))
+        assert abs(models[i] - direct).max() < 1e-4*ptp(direct)
+
+
+def test_lazy_grids_match_stored_grids():
+    parsed = setup()
+    stored = [(npe.all_data["RAs"][i], npe.all_data["Decs"][i]) for i in range(npe.settings["n_img"])]
+    stored_models = npe.modelfn(parsed)
+
+    parsed = setup("lazy_grids  2")
+    for i in range(npe.settings["n_img"]):
+        RAs, Decs = npe.sky_grid(i)
+        assert abs(RAs - stored[i][0]).max()*3600. < 1e-5 and abs(Decs - stored[i][1]).max()*3600. < 1e-5
+    assert len(npe.sky_grid_cache) == 2
+    assert abs(npe.modelfn(parsed) - stored_models).max() < 1e-6*ptp(stored_models)
+
+
+def test_packed_pulls_match_masked_pulls():
+    parsed = setup()
+    P = npe.unparseP(parsed, npe.settings)
+    displ = linear_miniscale()
+    pulls = npe.pull_FN(parsed)
+    J = npe.linear_jacobian(P, displ, [list(range(npe.settings["n_img"]))])
+
+    # Pixel rows with invvar > 0, then all the prior rows
+    keep = concatenate([ravel(invvars) > 0 for invvars in npe.all_data["invvars"]] + [ones(len(pulls) - npe.settings["n_img"]*npe.settings["patch"]**2, dtype=bool)])
+    assert not all(keep)
+
+    parsed = setup("packed_pulls  1")
+    assert abs(npe.pull_FN(parsed) - pulls[keep]).max() < 1e-10
+    assert abs(npe.linear_jacobian(P, displ, [list(range(npe.settings["n_img"]))]) - J[keep]).max() < 1e-10
+
+
+def test_gradient_1D_prefit_jacobian():
+    # The 1D pre-fit's columns (axis ratio, orientation, amplitudes, SN amplitudes) against the dense differenced Jacobian
+    parsed = setup("gradient_1D_prefit  1", gal_type = "1D")
+    P = npe.unparseP(parsed, npe.settings)
+    miniscale_parsed = dict(SN_ampl = ones(npe.settings["n_epoch"], dtype=float64)*npe.settings["flux_scale"], sndRA_offset = 0, sndDec_offset = 0,
+                            dRA = zeros(npe.settings["n_img"], dtype=float64), dDec = zeros(npe.settings["n_img"], dtype=float64))
+    displ = npe.unparseP(npe.load_galaxy_coeffs(miniscale_parsed, do_init = 0, do_fit = [1]), npe.settings)
+    free = where(displ != 0)[0]
+
+    merged_list = [list(range(npe.settings["n_img"]))]
+    J = Jacobian(npe.pull_FN_wrapper, displ[free]*1.e-6, merged_list, P[free], displ, P, len(npe.pull_FN(parsed)), use_dense_J = True)
+    assert abs(npe.linear_jacobian(P, displ, merged_list) - J).max() < 1e-4*abs(J).max()
+
+
+def test_parallel_centroid_matches_serial():
+    # The per-image fits in the workers against LM_fit_for_centroids' serial loop, from the same offset start
+    parsed = setup("iterative_centroid  1\nparallel_centroid  1")
+    assert npe.settings["parallel_centroid"] == 1
+    P = npe.unparseP(parsed, npe.settings)
+    inds = npe.param_index(npe.settings)
+
+    parallel = npe.pool.map(npe.indiv_centroid_fit, [(i, P) for i in range(npe.settings["n_img"])])
+
+    P_serial = array(P)
+    for i in range(npe.settings["n_img"]):
+        P_serial, F, Cmat = miniLM_new(ministart = P_serial, miniscale = npe.centroid_miniscale(i), residfn = npe.pull_FN_wrapper, passdata = [i],
+                                       verbose = False, maxiter = 3, jacobian_fn = None, **npe.lm_options(npe.settings))
+
+    for i, (dRA, dDec, Cmat) in enumerate(parallel):
+        assert abs(dRA - P_serial[inds["dRA"][i]])*3600. < 1e-4
+        assert abs(dDec - P_serial[inds["dDec"][i]])*3600. < 1e-4
+        # ... and the fits moved the offsets
+        assert abs(dRA - P[inds["dRA"][i]]) + abs(dDec - P[inds["dDec"][i]]) > 0
+
+
+def fd_setup(extra = ""):
+    """setup, P and step scales over the linear parameters and the image offsets, and the dense DavidsNM.Jacobian of
+    pull_FN_wrapper over them."""
+    parsed = setup(extra)
+    P = npe.unparseP(parsed, npe.settings)
+    inds = npe.param_index(npe.settings)
+
+    displ = linear_miniscale()
+    displ[inds["dRA"]] = 0.1/3600.
+    displ[inds["dDec"]] = 0.1/3600.
+    free = where(displ != 0)[0]
+
+    merged_list = [list(range(npe.settings["n_img"]))]
+    J = Jacobian(npe.pull_FN_wrapper, displ[free]*1.e-6, merged_list, P[free], displ, P, len(npe.pull_FN(parsed)), use_dense_J = True)
+    return P, displ, merged_list, J
+
+
+def test_sparse_fd_jacobian_matches_dense():
+    P, displ, merged_list, J = fd_setup("sparse_jacobian  1")
+    assert abs(npe.sparse_fd_jacobian(P, displ, merged_list) - J).max() < 1e-8*abs(J).max()
+
+
+def test_colored_jacobian_matches_dense():
+    P, displ, merged_list, J = fd_setup("color_jacobian  1")
+    free = where(displ != 0)[0]
+
+    sparsity = npe.pull_sparsity(displ, merged_list[0])
+    for col in range(len(free)):
+        assert all(in1d(where(J[:, col] != 0)[0], sparsity[col]))
+
+    groups = color_columns(sparsity, len(J))
+    assert len(groups) < len(free)
+    J_colored = grouped_Jacobian(npe.pull_FN_wrapper, displ[free]*1.e-6, merged_list, P[free], displ, P, len(J), True, sparsity, groups)
+    assert abs(J_colored - J).max() < 1e-8*abs(J).max()
+
+
+def test_pull_jvp_vjp():
+    P, displ, merged_list, NA = fd_setup("matrix_free  5")
+    free = displ != 0
+    J = npe.linear_jacobian(P, displ, merged_list)
+
+    random.seed(3)
+    v = zeros(len(P), dtype=float64)
+    v[free] = random.normal(size = sum(free))*displ[free]
+    u = random.normal(size = len(J))
+
+    Jv = npe.pull_jvp(P, v, displ, merged_list)
+    JTu = npe.pull_vjp(P, u, displ, merged_list)
+    assert abs(Jv - dot(J, v[free])).max() < 1e-10*abs(Jv).max()
+    assert abs(JTu[free] - dot(transpose(J), u)).max() < 1e-10*abs(JTu).max()
+    assert all(JTu[~free] == 0)
+
+    # Exact transposes of each other
+    assert abs(dot(u, Jv) - dot(JTu, v)) < 1e-10*abs(u).sum()*abs(Jv).max()
+
+    JTu_with_norms, colnorms = npe.pull_vjp(P, u, displ, merged_list, colnorms = True)
+    assert abs(JTu_with_norms - JTu).max() < 1e-10*abs(JTu).max()
+    assert abs(colnorms[free] - sqrt(sum(J**2., axis = 0))).max() < 1e-10*colnorms.max()
+
+
+def test_streamed_normal_equations_match_dense():
+    # stream_jacobian_MB small enough for one image per chunk
+    P, displ, merged_list, NA = fd_setup("stream_jacobian_MB  0.001")
+    J = npe.linear_jacobian(P, displ, merged_list)
+    pulls = npe.pull_FN_wrapper(P, merged_list)
+
+    JtJ, Jtr = npe.streamed_normal_equations(P, displ, merged_list)
+    dense_JtJ = normal_matrix(J, None, True, False)
+    assert abs(JtJ - dense_JtJ).max() < 1e-10*abs(dense_JtJ).max()
+    assert abs(Jtr - dot(transpose(J), pulls)).max() < 1e-10*abs(Jtr).max()
+
+
+class RecordingPool:
+    """Passes map through to a pool, recording the function and number of arguments of each call."""
+    def __init__(self, pool):
+        self.pool = pool
+        self.calls = []
+
+    def map(self, fn, args):
+        args = list(args)
+        self.calls.append((fn.__name__, len(args)))
+        return self.pool.map(fn, args)
+
+    def terminate(self):
+        self.pool.terminate()
+
+
+def test_component_cache_hits():
+    parsed = setup("component_cache  8")
+    direct = array(npe.pool.map(npe.indiv_model, [(i, npe.prefilter_coeffs(parsed), 0) for i in range(npe.settings["n_img"])]))
+    npe.pool = RecordingPool(npe.pool)
+
+    first = npe.modelfn(parsed)
+    assert ("indiv_convolved_galaxy", npe.settings["n_img"]) in npe.pool.calls
+    assert abs(first - direct).max() < 1e-10*abs(direct).max()
+
+    # Same coeffs and offsets: every galaxy comes from the cache
+    npe.pool.calls = []
+    second = npe.modelfn(dict(parsed, coeffs = [array(coeffs) for coeffs in parsed["coeffs"]]))
+    assert ("indiv_convolved_galaxy", 0) in npe.pool.calls
+    assert abs(second - first).max() == 0
+
+    # Moving image 0 only re-renders image 0; changing a coeff re-renders all of them
+    npe.pool.calls = []
+    moved = dict(parsed, dRA = array(parsed["dRA"]))
+    moved["dRA"][0] += 0.05/3600.
+    npe.modelfn(moved)
+    assert ("indiv_convolved_galaxy", 1) in npe.pool.calls
+
+    npe.pool.calls = []
+    changed = dict(parsed, coeffs = [array(coeffs) for coeffs in parsed["coeffs"]])
+    changed["coeffs"][0][3, 3] += 1.
+    npe.modelfn(changed)
+    assert ("indiv_convolved_galaxy", npe.settings["n_img"]) in npe.pool.calls
+    assert len(npe.component_cache) == 8
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_"):
+            fn()
+            print(name, "passed")
+    npe.pool.terminate()